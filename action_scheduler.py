@@ -0,0 +1,372 @@
+# action_scheduler.py
+from collections import Counter, deque
+import heapq
+import itertools
+import logging
+import threading
+import time
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+import config
+import metrics
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lower value runs first: deletes beat penalties beat messages
+PRIORITY_DELETE = 0
+PRIORITY_PENALTY = 1
+PRIORITY_NOTIFY = 2
+PRIORITY_ALERT = 3
+PRIORITIES = (PRIORITY_DELETE, PRIORITY_PENALTY, PRIORITY_NOTIFY, PRIORITY_ALERT)
+
+# Kinds that send a chat message and count against per-chat limits
+MESSAGE_KINDS = ("notify", "alert")
+
+DIGEST_PREVIEW = 5
+
+# Telegram rejects longer messages with BadRequest
+MAX_MESSAGE_LENGTH = 4096
+
+API_SECONDS = metrics.histogram(
+    "hate_speech_telegram_api_seconds",
+    "Telegram Bot API call latency",
+    ["method", "outcome"],
+)
+
+
+class _Action:
+    __slots__ = (
+        "kind",
+        "priority",
+        "chat_id",
+        "kwargs",
+        "texts",
+        "enqueued_at",
+        "not_before",
+        "attempts",
+        "seq",
+    )
+
+    def __init__(self, kind, priority, chat_id, kwargs, seq):
+        self.kind = kind
+        self.priority = priority
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.texts = []
+        self.enqueued_at = time.monotonic()
+        self.not_before = 0.0
+        self.attempts = 0
+        self.seq = seq
+
+    def call(self, bot):
+        if self.kind == "delete":
+            return bot.delete_message(chat_id=self.chat_id, **self.kwargs)
+        if self.kind == "restrict":
+            return bot.restrict_chat_member(chat_id=self.chat_id, **self.kwargs)
+        if self.kind == "kick":
+            return bot.kick_chat_member(chat_id=self.chat_id, **self.kwargs)
+        return bot.send_message(chat_id=self.chat_id, text=self.text())
+
+    def text(self):
+        if len(self.texts) == 1:
+            return _truncate(self.texts[0], MAX_MESSAGE_LENGTH)
+        # Alerts merged while queued are delivered as one digest. The oldest
+        # shown alerts move into "(+N more)" until it fits in one message.
+        header = f"⚠️ {len(self.texts)} alerts:\n\n"
+        shown = self.texts[-DIGEST_PREVIEW:]
+        while True:
+            more = len(self.texts) - len(shown)
+            suffix = f"\n\n(+{more} more)" if more > 0 else ""
+            body = "\n\n".join(shown)
+            budget = MAX_MESSAGE_LENGTH - len(header) - len(suffix)
+            if len(body) <= budget or len(shown) == 1:
+                return header + _truncate(body, budget) + suffix
+            shown = shown[1:]
+
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def _chat_rate(chat_id):
+    # Telegram allows ~20 messages/minute into a group, ~1/second per private chat
+    if str(chat_id).startswith("-"):
+        return config.TG_GROUP_RATE / 60.0, config.TG_GROUP_BURST
+    return config.TG_PRIVATE_RATE, config.TG_PRIVATE_BURST
+
+
+# Queues Telegram moderation actions off the dispatcher thread and sends them
+# within Telegram's flood limits: a global token bucket for every API call and
+# per-chat buckets for messages. Deletes go first; admin alerts that pile up
+# for the same admin are merged into a digest. RetryAfter pauses sending for
+# the time Telegram asks for.
+#
+# Each priority keeps one FIFO per chat and a heap of those chats keyed on when
+# their head action can go (now for API calls, the chat bucket's wait time for
+# messages), so a dispatch never scans past actions that are not ready yet.
+# Actions backing off after an error wait in a separate heap until due.
+class ModerationScheduler:
+    def __init__(self, bot=None, workers=None, max_retries=None):
+        self.bot = bot
+        self.max_retries = (
+            max_retries if max_retries is not None else config.TG_ACTION_MAX_RETRIES
+        )
+        self._lanes = {}  # (priority, chat_id) -> deque of _Action
+        self._ready = {priority: [] for priority in PRIORITIES}
+        self._delayed = []  # (not_before, seq, _Action)
+        self._depth = Counter()  # priority -> queued actions
+        self._queued_alerts = {}  # admin chat_id -> queued alert _Action
+        self._global = TokenBucket(config.TG_GLOBAL_RATE, config.TG_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._closed = False
+        self._threads = []
+        self._workers = workers or config.TG_SCHEDULER_WORKERS
+
+        self.counters = Counter()
+        self._latencies = {}  # kind -> deque of seconds
+
+    def start(self, bot=None):
+        if bot is not None:
+            self.bot = bot
+        self._threads = [
+            threading.Thread(target=self._run, name=f"tg-actions-{i}", daemon=True)
+            for i in range(self._workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def delete_message(self, chat_id, message_id):
+        self._submit("delete", PRIORITY_DELETE, chat_id, {"message_id": message_id})
+
+    def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None):
+        self._submit(
+            "restrict",
+            PRIORITY_PENALTY,
+            chat_id,
+            {"user_id": user_id, "permissions": permissions, "until_date": until_date},
+        )
+
+    def kick_chat_member(self, chat_id, user_id):
+        self._submit("kick", PRIORITY_PENALTY, chat_id, {"user_id": user_id})
+
+    def send_message(self, chat_id, text):
+        self._submit("notify", PRIORITY_NOTIFY, chat_id, {}, text)
+
+    def alert_admin(self, admin_id, text):
+        with self._cond:
+            queued = self._queued_alerts.get(admin_id)
+            if queued is not None:
+                queued.texts.append(text)
+                self.counters["alerts_merged"] += 1
+                return
+            action = self._make("alert", PRIORITY_ALERT, admin_id, {}, text)
+            self._queued_alerts[admin_id] = action
+            self._push(action)
+
+    def stats(self):
+        with self._cond:
+            depth = {p: self._depth[p] for p in PRIORITIES}
+            latencies = {
+                kind: _summarize(samples) for kind, samples in self._latencies.items()
+            }
+            return {
+                "queue_depth": sum(depth.values()),
+                "queue_depth_by_priority": depth,
+                "paused_for": max(0.0, self._paused_until - time.monotonic()),
+                "latency_ms": latencies,
+                **self.counters,
+            }
+
+    def close(self, timeout=10.0):
+        # Sends what is still queued (within limits), then stops the workers
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while sum(self._depth.values()) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _make(self, kind, priority, chat_id, kwargs, text=None):
+        action = _Action(kind, priority, chat_id, kwargs, next(self._seq))
+        if text is not None:
+            action.texts.append(text)
+        return action
+
+    def _submit(self, kind, priority, chat_id, kwargs, text=None):
+        with self._cond:
+            self._push(self._make(kind, priority, chat_id, kwargs, text))
+
+    def _push(self, action, front=False):
+        self._depth[action.priority] += 1
+        self.counters["enqueued"] += 1
+        if action.not_before > time.monotonic():
+            heapq.heappush(self._delayed, (action.not_before, action.seq, action))
+        else:
+            self._enqueue(action, front)
+        self._cond.notify()
+
+    def _enqueue(self, action, front=False):
+        key = (action.priority, action.chat_id)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+        if front:
+            lane.appendleft(action)
+        else:
+            lane.append(action)
+        if len(lane) == 1 or front:
+            # A new head needs its own heap entry; the old one goes stale
+            self._schedule(action, time.monotonic())
+
+    def _schedule(self, action, now):
+        ready_at = 0.0
+        if action.kind in MESSAGE_KINDS:
+            ready_at = now + self._chat_bucket(action.chat_id, now).wait_time(now)
+        heapq.heappush(
+            self._ready[action.priority], (ready_at, action.seq, action.chat_id)
+        )
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > config.TG_MAX_CHAT_BUCKETS:
+                # Idle (full) buckets carry no state worth keeping
+                for key in [k for k, b in self._chat_buckets.items() if b.is_full(now)]:
+                    del self._chat_buckets[key]
+            rate, burst = _chat_rate(chat_id)
+            bucket = TokenBucket(rate, burst, now)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_ready(self, now):
+        # Returns (action, None) or (None, seconds to wait)
+        while self._delayed and self._delayed[0][0] <= now:
+            self._enqueue(heapq.heappop(self._delayed)[2])
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        if not self._global.available(now):
+            return None, self._global.wait_time(now)
+        wait = self._delayed[0][0] - now if self._delayed else None
+        for priority in PRIORITIES:
+            heap = self._ready[priority]
+            blocked = []
+            action = None
+            while heap:
+                ready_at, seq, chat_id = heap[0]
+                lane = self._lanes.get((priority, chat_id))
+                if lane is None or lane[0].seq != seq:
+                    heapq.heappop(heap)  # stale: that head already went
+                    continue
+                if ready_at > now:
+                    break
+                heapq.heappop(heap)
+                head = lane[0]
+                if head.kind in MESSAGE_KINDS:
+                    bucket = self._chat_bucket(chat_id, now)
+                    if not bucket.try_acquire(now):
+                        # Another lane for this chat took the token first
+                        blocked.append((now + bucket.wait_time(now), seq, chat_id))
+                        continue
+                action = head
+                break
+            for entry in blocked:
+                heapq.heappush(heap, entry)
+            if action is not None:
+                lane.popleft()
+                if lane:
+                    self._schedule(lane[0], now)
+                else:
+                    del self._lanes[(priority, action.chat_id)]
+                self._depth[priority] -= 1
+                if self._queued_alerts.get(action.chat_id) is action:
+                    del self._queued_alerts[action.chat_id]
+                self._global.try_acquire(now)
+                return action, None
+            if heap:
+                delay = max(0.0, heap[0][0] - now)
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    action, wait = self._next_ready(time.monotonic())
+                    if action is not None:
+                        break
+                    self._cond.wait(wait)
+            self._execute(action)
+
+    def _execute(self, action):
+        action.attempts += 1
+        try:
+            self._call(action)
+        except RetryAfter as e:
+            # Flood limit hit: pause everything for as long as Telegram asks
+            logger.warning(f"Telegram flood limit, retrying in {e.retry_after}s")
+            with self._cond:
+                self.counters["retry_after"] += 1
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + float(e.retry_after)
+                )
+                self._push(action, front=True)
+            return
+        except (BadRequest, Unauthorized) as e:
+            # e.g. message already deleted or bot lacks rights; retrying won't help
+            logger.error(f"Telegram {action.kind} in {action.chat_id} failed: {e}")
+            self._finish(action, "failed")
+            return
+        except Exception as e:
+            if action.attempts > self.max_retries:
+                logger.error(f"Telegram {action.kind} in {action.chat_id} failed: {e}")
+                self._finish(action, "failed")
+                return
+            with self._cond:
+                self.counters["retries"] += 1
+                action.not_before = time.monotonic() + 2 ** (action.attempts - 1)
+                self._push(action)
+            return
+        self._finish(action, "completed")
+
+    def _call(self, action):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            action.call(self.bot)
+            outcome = "ok"
+        except RetryAfter:
+            outcome = "retry_after"
+            raise
+        except (BadRequest, Unauthorized):
+            outcome = "rejected"
+            raise
+        finally:
+            API_SECONDS.observe(
+                time.perf_counter() - started, method=action.kind, outcome=outcome
+            )
+
+    def _finish(self, action, outcome):
+        latency = time.monotonic() - action.enqueued_at
+        with self._cond:
+            self.counters[outcome] += 1
+            samples = self._latencies.setdefault(action.kind, deque(maxlen=1024))
+            samples.append(latency)
+            self._cond.notify_all()
+
+
+def _summarize(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {
+        "p50": ordered[len(ordered) // 2] * 1000.0,
+        "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000.0,
+        "max": ordered[-1] * 1000.0,
+    }
@@ -0,0 +1,121 @@
+# admin_directory.py
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+
+# In-process cache of registered admins per group, so the moderation hot path
+# finds who to alert without touching SQLite. Entries expire after ttl seconds
+# and are invalidated by Database.add_admin/remove_admin. Each invalidation
+# bumps a generation, and a load that started before it is returned but not
+# cached, so a slow read can never put stale admins back. Failed loads are
+# never cached.
+class AdminDirectory:
+    def __init__(self, loader, ttl=None, member_ttl=None):
+        # loader(group_id) -> [(admin_id, username), ...] in one query
+        self._loader = loader
+        self.ttl = ttl or config.ADMIN_CACHE_TTL
+        self.member_ttl = member_ttl or config.ADMIN_MEMBER_CACHE_TTL
+        self._groups = {}  # group_id -> (loaded_at, [(admin_id, username)])
+        self._members = {}  # (group_id, admin_id) -> (fetched_at, user or None)
+        self._generations = {}  # group_id -> invalidations of that group
+        self._epoch = 0  # invalidations of every group
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, group_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._groups.get(group_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            generation = self._generation(group_id)
+        try:
+            admins = self._loader(group_id)
+        except Exception as e:
+            # Nothing is cached for a failed load; an expired list is still
+            # better than none
+            if entry is None:
+                raise
+            logger.warning(f"Using expired admins of group {group_id}: {e}")
+            return entry[1]
+        with self._lock:
+            self.loads += 1
+            if self._generation(group_id) == generation:
+                self._groups[group_id] = (now, admins)
+        return admins
+
+    def _generation(self, group_id):
+        return self._epoch, self._generations.get(group_id, 0)
+
+    def admin_ids(self, group_id):
+        return [admin_id for admin_id, _ in self.get(group_id)]
+
+    def prime(self, admins_by_group):
+        # Loads many groups at once, e.g. every group at startup
+        now = time.monotonic()
+        with self._lock:
+            for group_id, admins in admins_by_group.items():
+                self._groups[group_id] = (now, admins)
+
+    def invalidate(self, group_id=None):
+        with self._lock:
+            if group_id is None:
+                self._epoch += 1
+                self._groups.clear()
+                self._members.clear()
+                return
+            self._generations[group_id] = self._generations.get(group_id, 0) + 1
+            self._groups.pop(group_id, None)
+            for key in [key for key in self._members if key[0] == group_id]:
+                del self._members[key]
+
+    def resolve_members(self, bot, group_id):
+        # Telegram users for every admin of the group ({admin_id: user or None}).
+        # Uncached admins are looked up concurrently and the results cached.
+        now = time.monotonic()
+        admin_ids = self.admin_ids(group_id)
+        resolved = {}
+        missing = []
+        with self._lock:
+            generation = self._generation(group_id)
+            for admin_id in admin_ids:
+                cached = self._members.get((group_id, admin_id))
+                if cached is not None and now - cached[0] < self.member_ttl:
+                    resolved[admin_id] = cached[1]
+                else:
+                    missing.append(admin_id)
+
+        def lookup(admin_id):
+            try:
+                return bot.get_chat_member(group_id, admin_id).user
+            except Exception as e:
+                logger.info(f"Could not resolve admin {admin_id}: {e}")
+                return None
+
+        if missing:
+            workers = min(len(missing), config.ADMIN_LOOKUP_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                users = list(pool.map(lookup, missing))
+            with self._lock:
+                current = self._generation(group_id) == generation
+                for admin_id, user in zip(missing, users):
+                    if current:
+                        self._members[(group_id, admin_id)] = (now, user)
+                    resolved[admin_id] = user
+        return resolved
+
+    def stats(self):
+        with self._lock:
+            return {
+                "groups": len(self._groups),
+                "members": len(self._members),
+                "hits": self.hits,
+                "loads": self.loads,
+            }
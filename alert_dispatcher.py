@@ -0,0 +1,220 @@
+# alert_dispatcher.py
+from collections import Counter
+import heapq
+import logging
+import queue
+import random
+import threading
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+DIGEST_PREVIEW = 5
+
+
+def format_alert(sender, text):
+    return f"⚠️ Alert: Sender {sender} sent hate speech:\n{text}"
+
+
+def format_digest(sender, texts):
+    lines = "\n".join(f"- {text}" for text in texts[-DIGEST_PREVIEW:])
+    more = len(texts) - DIGEST_PREVIEW
+    suffix = f"\n(+{more} more)" if more > 0 else ""
+    return (
+        f"⚠️ Alert digest: Sender {sender} sent {len(texts)} more hate speech "
+        f"messages:\n{lines}{suffix}"
+    )
+
+
+def is_retryable(error):
+    # Client errors (bad number, auth, ...) won't succeed on retry; 429 will
+    status = getattr(error, "status", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status != 429)
+
+
+class _SenderState:
+    __slots__ = ("last_sent", "buffer", "callbacks", "scheduled")
+
+    def __init__(self, last_sent):
+        self.last_sent = last_sent
+        self.buffer = []
+        self.callbacks = []
+        self.scheduled = False
+
+
+def _notify(callbacks, delivered):
+    for done in callbacks:
+        try:
+            done(delivered)
+        except Exception as e:
+            logger.error(f"Alert callback failed: {e}")
+
+
+# Background fan-out of admin alerts. submit() only enqueues, so callers return
+# immediately; a worker pool delivers through send(to, body) with retries and
+# exponential backoff. The first alert per (admin, sender) goes out at once;
+# further alerts within coalesce_window seconds are merged into one digest.
+# An optional done(delivered) callback is called once the message (or the
+# digest it was merged into) has been sent or given up on.
+class AlertDispatcher:
+    def __init__(
+        self,
+        send,
+        workers=None,
+        queue_size=None,
+        max_retries=None,
+        backoff=None,
+        coalesce_window=None,
+    ):
+        self.send = send
+        self.max_retries = (
+            max_retries if max_retries is not None else config.ALERT_MAX_RETRIES
+        )
+        self.backoff = backoff if backoff is not None else config.ALERT_BACKOFF
+        self.coalesce_window = (
+            coalesce_window
+            if coalesce_window is not None
+            else config.ALERT_COALESCE_WINDOW
+        )
+        self._queue = queue.Queue(maxsize=queue_size or config.ALERT_QUEUE_SIZE)
+        self._senders = {}  # (to, sender) -> _SenderState
+        self._due = []  # heap of (due_at, to, sender) digests
+        self._cond = threading.Condition()
+        self._closed = False
+        self.counters = Counter()
+
+        self._workers = [
+            threading.Thread(target=self._work, name=f"alert-worker-{i}", daemon=True)
+            for i in range(workers or config.ALERT_WORKERS)
+        ]
+        self._timer = threading.Thread(
+            target=self._schedule_digests, name="alert-digests", daemon=True
+        )
+        for thread in self._workers + [self._timer]:
+            thread.start()
+
+    def submit(self, to, sender, text, done=None):
+        now = time.monotonic()
+        key = (to, sender)
+        callbacks = [done] if done is not None else []
+        with self._cond:
+            state = self._senders.get(key)
+            if state is None or (
+                not state.buffer and now - state.last_sent >= self.coalesce_window
+            ):
+                self._senders[key] = _SenderState(now)
+                return self._enqueue(to, format_alert(sender, text), callbacks)
+            # Sender is flooding this admin: fold into the next digest
+            state.buffer.append(text)
+            state.callbacks += callbacks
+            self.counters["coalesced"] += 1
+            if not state.scheduled:
+                state.scheduled = True
+                due = state.last_sent + self.coalesce_window
+                heapq.heappush(self._due, (due, to, sender))
+                self._cond.notify()
+            return True
+
+    def submit_all(self, recipients, sender, text):
+        for to in recipients:
+            self.submit(to, sender, text)
+
+    def submit_message(self, to, body, done=None):
+        # Delivers body as is, e.g. a reply to a sender, with no coalescing
+        with self._cond:
+            return self._enqueue(to, body, [done] if done is not None else [])
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": self._queue.qsize(),
+                "pending_digests": len(self._due),
+                **self.counters,
+            }
+
+    def close(self, timeout=10.0):
+        # Flushes pending digests, lets workers drain the queue, then stops
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._timer.join(timeout)
+        for _ in self._workers:
+            self._queue.put(None)
+        for thread in self._workers:
+            thread.join(timeout)
+
+    def _enqueue(self, to, body, callbacks=()):
+        try:
+            self._queue.put_nowait((to, body, callbacks))
+        except queue.Full:
+            self.counters["dropped"] += 1
+            logger.error(f"Alert queue full; dropped alert to {to}")
+            _notify(callbacks, False)
+            return False
+        self.counters["enqueued"] += 1
+        return True
+
+    def _schedule_digests(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._due and (self._closed or self._due[0][0] <= now):
+                    _, to, sender = heapq.heappop(self._due)
+                    self._release_digest(to, sender, now)
+                if self._closed:
+                    return
+                self._prune(now)
+                # Wake up at least every window so quiet senders get pruned
+                timeout = max(self.coalesce_window, 1.0)
+                if self._due:
+                    timeout = min(timeout, self._due[0][0] - now)
+                self._cond.wait(timeout)
+
+    def _release_digest(self, to, sender, now):
+        state = self._senders.get((to, sender))
+        if state is None or not state.buffer:
+            return
+        texts, state.buffer = state.buffer, []
+        callbacks, state.callbacks = state.callbacks, []
+        state.scheduled = False
+        state.last_sent = now
+        self.counters["digests"] += 1
+        self._enqueue(to, format_digest(sender, texts), callbacks)
+
+    def _prune(self, now):
+        # Forget senders that have been quiet for a full window
+        for key in [
+            key
+            for key, state in self._senders.items()
+            if not state.buffer and now - state.last_sent >= self.coalesce_window
+        ]:
+            del self._senders[key]
+
+    def _count(self, name):
+        with self._cond:
+            self.counters[name] += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._deliver(*item)
+
+    def _deliver(self, to, body, callbacks=()):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.send(to, body)
+                self._count("sent")
+                _notify(callbacks, True)
+                return
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    self._count("failed")
+                    logger.error(f"Failed to send alert to {to}: {e}")
+                    _notify(callbacks, False)
+                    return
+                self._count("retries")
+                delay = self.backoff * (2**attempt)
+                time.sleep(delay + random.uniform(0, delay / 2))
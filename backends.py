@@ -0,0 +1,173 @@
+# backends.py
+import logging
+import os
+import numpy as np
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_SEQUENCE_LENGTH = 512
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model.int8.onnx"}
+
+INFERENCE_SECONDS = metrics.histogram(
+    "hate_speech_inference_seconds",
+    "Detector time per stage (tokenize, pad, forward) and call",
+    ["stage"],
+)
+
+
+class ClassifierBackend:
+    # Subclasses set self.tokenizer, self.model_config and implement forward(),
+    # which maps a tokenized batch to a (batch, labels) array of logits.
+    name = None
+
+    def _init_labels(self):
+        cfg = self.model_config
+        self.labels = [cfg.id2label[i].lower() for i in range(cfg.num_labels)]
+        # Same activation the transformers text-classification pipeline picks
+        self.multi_label = (
+            cfg.problem_type == "multi_label_classification" or cfg.num_labels == 1
+        )
+
+    def encode(self, texts):
+        return self.tokenizer(
+            list(texts),
+            padding=True,
+            truncation=True,
+            max_length=MAX_SEQUENCE_LENGTH,
+            return_tensors="np",
+        )
+
+    def forward(self, encoded):
+        raise NotImplementedError
+
+    def score_ids(self, sequences):
+        # Scores already-tokenized sequences (special tokens included). Each
+        # call pads only to its own longest sequence.
+        with INFERENCE_SECONDS.time(stage="pad"):
+            length = max(len(ids) for ids in sequences)
+            input_ids = np.full(
+                (len(sequences), length),
+                self.tokenizer.pad_token_id or 0,
+                dtype=np.int64,
+            )
+            attention_mask = np.zeros((len(sequences), length), dtype=np.int64)
+            for row, ids in enumerate(sequences):
+                input_ids[row, : len(ids)] = ids
+                attention_mask[row, : len(ids)] = 1
+            encoded = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.tokenizer.model_input_names:
+                encoded["token_type_ids"] = np.zeros_like(input_ids)
+        with INFERENCE_SECONDS.time(stage="forward"):
+            logits = self.forward(encoded)
+        return self.to_scores(logits)
+
+    def score_many(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        with INFERENCE_SECONDS.time(stage="tokenize"):
+            encoded = self.encode(texts)
+        with INFERENCE_SECONDS.time(stage="forward"):
+            logits = self.forward(encoded)
+        return self.to_scores(logits)
+
+    def to_scores(self, logits):
+        logits = np.asarray(logits, dtype=np.float32)
+        if self.multi_label:
+            probs = 1.0 / (1.0 + np.exp(-logits))
+        else:
+            shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+            probs = shifted / shifted.sum(axis=-1, keepdims=True)
+        return [
+            {label: float(score) for label, score in zip(self.labels, row)}
+            for row in probs
+        ]
+
+
+class TorchBackend(ClassifierBackend):
+    name = "torch"
+
+    def __init__(self, model_name=None, num_threads=None, interop_threads=None):
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.torch = torch
+        num_threads = num_threads or config.TORCH_NUM_THREADS
+        interop_threads = interop_threads or config.TORCH_INTEROP_THREADS
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if interop_threads:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError as e:
+                # Only allowed before any inter-op parallel work has started
+                logger.warning(f"Could not set torch inter-op threads: {e}")
+
+        model_name = model_name or config.MODEL_NAME
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+        self.model_config = self.model.config
+        self._init_labels()
+
+    def forward(self, encoded):
+        inputs = {name: self.torch.from_numpy(value) for name, value in encoded.items()}
+        with self.torch.inference_mode():
+            return self.model(**inputs).logits.float().numpy()
+
+
+class OnnxBackend(ClassifierBackend):
+    def __init__(
+        self, variant="onnx", model_dir=None, intra_threads=None, inter_threads=None
+    ):
+        import onnxruntime as ort
+        from transformers import AutoConfig, AutoTokenizer
+
+        self.name = variant
+        model_dir = model_dir or config.ONNX_MODEL_DIR
+        path = os.path.join(model_dir, ONNX_FILES[variant])
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"{path} not found; run `python export_onnx.py` to create it"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        intra_threads = intra_threads or config.ONNX_INTRA_OP_THREADS
+        inter_threads = inter_threads or config.ONNX_INTER_OP_THREADS
+        if intra_threads:
+            options.intra_op_num_threads = intra_threads
+        if inter_threads:
+            options.inter_op_num_threads = inter_threads
+
+        self.session = ort.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model_config = AutoConfig.from_pretrained(model_dir)
+        self._init_labels()
+
+    def forward(self, encoded):
+        feed = {
+            name: encoded[name].astype(np.int64)
+            for name in self.input_names
+            if name in encoded
+        }
+        return self.session.run(None, feed)[0]
+
+
+def load_backend(name=None):
+    name = name or config.MODEL_BACKEND
+    logger.info(f"Loading {name} classifier backend")
+    if name == "torch":
+        return TorchBackend()
+    if name in ONNX_FILES:
+        return OnnxBackend(variant=name)
+    raise ValueError(
+        f"Unknown MODEL_BACKEND {name!r}; expected one of: torch, "
+        + ", ".join(ONNX_FILES)
+    )
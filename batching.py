@@ -0,0 +1,192 @@
+# batching.py
+from collections import Counter, deque
+from concurrent.futures import Future
+import logging
+import threading
+import time
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = metrics.histogram(
+    "hate_speech_batch_size",
+    "Texts per batched forward pass",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "hate_speech_batch_queue_wait_seconds", "Time texts wait for their batch"
+)
+
+
+class _Pending:
+    __slots__ = ("text", "token_ids", "future", "enqueued_at")
+
+    def __init__(self, text):
+        self.text = text
+        self.token_ids = None
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+# Groups concurrent detect calls into batched forward passes. Texts are
+# bucketed by token length so each batch pads to a similar size; a bucket is
+# flushed once it is full or its oldest text has waited max_wait_ms. Each
+# text is tokenized once, on submit, and its ids go with it to the batch.
+class BatchingDetector:
+    def __init__(
+        self, detector, max_batch_size=None, max_wait_ms=None, bucket_width=None
+    ):
+        self.detector = detector
+        self.max_batch_size = max_batch_size or config.BATCH_MAX_SIZE
+        self.max_wait = (
+            max_wait_ms if max_wait_ms is not None else config.BATCH_MAX_WAIT_MS
+        ) / 1000.0
+        self.bucket_width = bucket_width or config.BATCH_BUCKET_WIDTH
+
+        self._buckets = {}
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._batch_sizes = Counter()
+        self._waits = deque(maxlen=2048)
+        self._total_texts = 0
+        self._total_batches = 0
+        self._max_wait_seen = 0.0
+
+        self._worker = threading.Thread(
+            target=self._run, name="batching-detector", daemon=True
+        )
+        self._worker.start()
+
+    @property
+    def threshold(self):
+        return self.detector.threshold
+
+    def is_hate_speech(self, scores):
+        return self.detector.is_hate_speech(scores)
+
+    def submit(self, text):
+        # Returns a Future resolving to the {label: score} dict for text.
+        pending = _Pending(text)
+        cached = self.detector.lookup(text)
+        if cached is not None:
+            pending.future.set_result(cached)
+            return pending.future
+        pending.token_ids = self.detector.encode(text)
+        key = len(pending.token_ids) // self.bucket_width
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchingDetector is closed")
+            self._buckets.setdefault(key, []).append(pending)
+            self._cond.notify()
+        return pending.future
+
+    def lookup(self, text):
+        return self.detector.lookup(text)
+
+    def score_uncached(self, texts):
+        return self.detector.score_uncached(texts)
+
+    def score_many(self, texts):
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def detect(self, text):
+        return self.is_hate_speech(self.submit(text).result())
+
+    def detect_many(self, texts):
+        return [self.is_hate_speech(scores) for scores in self.score_many(texts)]
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            queued = sum(len(items) for items in self._buckets.values())
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            total_texts = self._total_texts
+            total_batches = self._total_batches
+            max_wait_seen = self._max_wait_seen
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000.0
+
+        return {
+            **self.detector.stats(),
+            "queued": queued,
+            "total_texts": total_texts,
+            "total_batches": total_batches,
+            "mean_batch_size": total_texts / total_batches if total_batches else 0.0,
+            "batch_sizes": batch_sizes,
+            "queue_wait_ms_p50": percentile(0.50),
+            "queue_wait_ms_p95": percentile(0.95),
+            "queue_wait_ms_max": max_wait_seen * 1000.0,
+        }
+
+    def close(self):
+        # Flushes whatever is still queued, then stops the worker thread.
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _take_ready(self, now):
+        ready = []
+        for key in list(self._buckets):
+            items = self._buckets[key]
+            if (
+                self._closed
+                or len(items) >= self.max_batch_size
+                or now - items[0].enqueued_at >= self.max_wait
+            ):
+                del self._buckets[key]
+                for start in range(0, len(items), self.max_batch_size):
+                    ready.append(items[start : start + self.max_batch_size])
+        return ready
+
+    def _next_timeout(self, now):
+        if not self._buckets:
+            return None
+        oldest = min(items[0].enqueued_at for items in self._buckets.values())
+        return max(0.0, oldest + self.max_wait - now)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = self._take_ready(now)
+                    if ready or (self._closed and not self._buckets):
+                        break
+                    self._cond.wait(self._next_timeout(now))
+            if not ready:
+                return
+            for batch in ready:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        started = time.monotonic()
+        waits = [started - pending.enqueued_at for pending in batch]
+        with self._cond:
+            self._batch_sizes[len(batch)] += 1
+            self._total_texts += len(batch)
+            self._total_batches += 1
+            self._waits.extend(waits)
+            self._max_wait_seen = max(self._max_wait_seen, max(waits))
+        BATCH_SIZE.observe(len(batch))
+        for wait in waits:
+            QUEUE_WAIT_SECONDS.observe(wait)
+
+        try:
+            results = self.detector.score_uncached(
+                [pending.text for pending in batch],
+                [pending.token_ids for pending in batch],
+            )
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} texts failed: {e}")
+            for pending in batch:
+                pending.future.set_exception(e)
+            return
+        for pending, scores in zip(batch, results):
+            pending.future.set_result(scores)
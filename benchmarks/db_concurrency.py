@@ -0,0 +1,113 @@
+# benchmarks/db_concurrency.py
+# Concurrency stress test for database.Database: reader threads hammer
+# get_stats/get_violation_count while writer threads record messages and
+# violations. Compares the original single shared connection against the
+# per-thread WAL pool, with and without write-behind.
+#
+#   python -m benchmarks.db_concurrency --readers 8 --writers 4 --seconds 5
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from database import Database
+
+
+class SingleConnectionDatabase(Database):
+    # The pre-pool design: one connection shared by every thread, default
+    # rollback journal and synchronous=FULL.
+    def __init__(self, db_name, **kwargs):
+        self._shared = sqlite3.connect(db_name, check_same_thread=False)
+        super().__init__(db_name, **kwargs)
+
+    @property
+    def conn(self):
+        return self._shared
+
+    def close(self):
+        super().close()
+        self._shared.close()
+
+
+def _worker(stop, fn, counts, errors, index):
+    done = 0
+    failed = 0
+    while not stop.is_set():
+        try:
+            fn()
+            done += 1
+        except Exception:
+            failed += 1
+    counts[index] = done
+    errors[index] = failed
+
+
+def run(design, readers, writers, seconds, groups, users):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    if design == "single":
+        db = SingleConnectionDatabase(path, write_behind=False)
+    else:
+        db = Database(path, write_behind=design == "pooled+write-behind")
+
+    def write():
+        group_id = f"g{random.randrange(groups)}"
+        db.increment_message_stats(group_id, is_hate_speech=random.random() < 0.1)
+        if random.random() < 0.1:
+            db.add_violation(f"u{random.randrange(users)}", "bench")
+
+    def read():
+        db.get_stats(f"g{random.randrange(groups)}")
+        db.get_violation_count(f"u{random.randrange(users)}")
+
+    jobs = [read] * readers + [write] * writers
+    counts = [0] * len(jobs)
+    errors = [0] * len(jobs)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=_worker, args=(stop, fn, counts, errors, i))
+        for i, fn in enumerate(jobs)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    db.close()
+
+    return {
+        "design": design,
+        "reads_per_sec": sum(counts[:readers]) / seconds,
+        "writes_per_sec": sum(counts[readers:]) / seconds,
+        "read_errors": sum(errors[:readers]),
+        "write_errors": sum(errors[readers:]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database concurrency benchmark")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument(
+        "--design",
+        action="append",
+        choices=["single", "pooled", "pooled+write-behind"],
+        help="Designs to run (default: all)",
+    )
+    args = parser.parse_args()
+
+    for design in args.design or ["single", "pooled", "pooled+write-behind"]:
+        result = run(
+            design, args.readers, args.writers, args.seconds, args.groups, args.users
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# benchmarks/fakes.py
+# Local stand-ins for the external APIs, for benchmarks and manual testing.
+import random
+import threading
+import time
+from twilio.base.exceptions import TwilioRestException
+
+
+class FakeTwilioMessages:
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=503):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.sent = []
+        self.attempts = 0
+        self._lock = threading.Lock()
+
+    def create(self, from_=None, to=None, body=None, **kwargs):
+        with self._lock:
+            self.attempts += 1
+            sid = f"SM{self.attempts:032d}"
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise TwilioRestException(
+                self.failure_status, "/Messages.json", msg="Injected failure"
+            )
+        with self._lock:
+            self.sent.append({"from_": from_, "to": to, "body": body, "sid": sid})
+        return type("Message", (), {"sid": sid, "to": to, "body": body})()
+
+
+class FakeTwilioClient:
+    # Mimics twilio.rest.Client.messages.create with configurable round-trip
+    # latency and injected failures (503 by default, so they are retried).
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=503):
+        self.messages = FakeTwilioMessages(latency, failure_rate, failure_status)
+
+
+class FakeDetector:
+    # Stands in for the detector: flags texts containing a toxic word and
+    # spends cpu_ms of pure-Python (GIL-holding) work per text, the part of
+    # message handling that threads in one process cannot spread over cores.
+    # With record_path, appends "<monotonic time>\t<text>" for every text.
+    threshold = 0.5
+
+    def __init__(
+        self,
+        cpu_ms=1.0,
+        toxic_words=("idiot", "stupid", "moron", "hate"),
+        record_path=None,
+    ):
+        self.cpu_seconds = cpu_ms / 1000.0
+        self.toxic_words = toxic_words
+        self.texts = 0
+        self._record = open(record_path, "a") if record_path else None
+        self._lock = threading.Lock()
+
+    def _spin(self, seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    def lookup(self, text):
+        return None
+
+    def score_many(self, texts):
+        self._spin(self.cpu_seconds * len(texts))
+        with self._lock:
+            self.texts += len(texts)
+            if self._record is not None:
+                now = time.monotonic()
+                self._record.writelines(f"{now}\t{text}\n" for text in texts)
+                self._record.flush()
+        return [
+            {"toxic": 0.9 if any(w in text.lower() for w in self.toxic_words) else 0.05}
+            for text in texts
+        ]
+
+    score_uncached = score_many
+
+    def is_hate_speech(self, scores):
+        return scores["toxic"] > self.threshold
+
+    def detect(self, text):
+        return self.is_hate_speech(self.score_many([text])[0])
+
+    def detect_many(self, texts):
+        return [self.is_hate_speech(scores) for scores in self.score_many(texts)]
+
+    def stats(self):
+        return {"texts": self.texts}
+
+    def close(self):
+        if self._record is not None:
+            self._record.close()
@@ -0,0 +1,397 @@
+# benchmarks/replay.py
+# Offline replay benchmark for the moderation pipeline. Replays a JSONL corpus
+# of chat messages through each stage (detector, database, Telegram
+# handle_message, WhatsApp webhook) with stub Telegram objects and a fake
+# Twilio client, and stores p50/p95/p99 latency, messages/sec, peak RSS and
+# model-load time as JSON so builds can be compared.
+#
+#   python -m benchmarks.replay generate corpus.jsonl --count 5000
+#   python -m benchmarks.replay run corpus.jsonl --output runs/base.json
+#   python -m benchmarks.replay compare runs/base.json runs/new.json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+STAGES = ("detector", "database", "handle_message", "whatsapp_webhook")
+
+BENIGN = [
+    "good morning everyone",
+    "did anyone see the match last night?",
+    "the meeting moved to 3pm, see you there",
+    "thanks for sharing 🙏",
+    "lol",
+    "can someone send me the notes from today",
+    "happy birthday!! 🎉🎂",
+    "I think the second option is better, to be honest",
+]
+TOXIC = [
+    "you are an idiot and everyone hates you",
+    "shut up you stupid moron",
+    "nobody wants your kind here, get out",
+    "I will find you and make you regret it",
+]
+
+
+def generate(path, count, groups, users, seed):
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            roll = rng.random()
+            if roll < 0.1:
+                text = rng.choice(TOXIC)
+            elif roll < 0.12:
+                # Long paste, occasionally with abuse at the very end
+                text = " ".join(rng.choice(BENIGN) for _ in range(rng.randint(60, 200)))
+                if rng.random() < 0.5:
+                    text += " " + rng.choice(TOXIC)
+            elif roll < 0.15:
+                text = "🔥" * rng.randint(1, 8)
+            else:
+                text = rng.choice(BENIGN)
+            if rng.random() < 0.2:
+                # Light obfuscation, as raiders do
+                text = text.replace("o", "0") + "!" * rng.randint(1, 3)
+            row = {
+                "message_id": i + 1,
+                "chat_id": -1000000000000 - rng.randrange(groups),
+                "user_id": 1000 + rng.randrange(users),
+                "username": f"user{rng.randrange(users)}",
+                "text": text,
+            }
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def load_corpus(path, limit=None):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+                if limit and len(rows) >= limit:
+                    break
+    return rows
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def run_stage(fn, rows, concurrency):
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(row):
+        started = time.perf_counter()
+        fn(row)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, rows))
+    else:
+        for row in rows:
+            timed(row)
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "messages": len(rows),
+        "seconds": wall,
+        "messages_per_sec": len(rows) / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000.0,
+        "p95_ms": percentile(latencies, 0.95) * 1000.0,
+        "p99_ms": percentile(latencies, 0.99) * 1000.0,
+        "max_ms": latencies[-1] * 1000.0 if latencies else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+class StubBot:
+    # Records Telegram API calls instead of sending them
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record(self, name, **kwargs):
+        with self._lock:
+            self.calls.append(name)
+
+    def delete_message(self, chat_id, message_id):
+        self._record("delete_message")
+
+    def send_message(self, chat_id, text):
+        self._record("send_message")
+
+    def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None):
+        self._record("restrict_chat_member")
+
+    def kick_chat_member(self, chat_id, user_id):
+        self._record("kick_chat_member")
+
+    def get_chat_member(self, chat_id, user_id):
+        self._record("get_chat_member")
+        return SimpleNamespace(
+            status="member", user=SimpleNamespace(username=None, first_name="stub")
+        )
+
+
+def stub_update(row):
+    user = SimpleNamespace(
+        id=row["user_id"], username=row.get("username"), first_name="stub"
+    )
+    chat = SimpleNamespace(id=row["chat_id"])
+    message = SimpleNamespace(
+        message_id=row["message_id"],
+        text=row["text"],
+        chat_id=row["chat_id"],
+        from_user=user,
+        reply_text=lambda text: None,
+    )
+    return SimpleNamespace(message=message, effective_chat=chat, effective_user=user)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    corpus_path = os.path.abspath(args.corpus)
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Everything (SQLite files, caches) lands in a scratch directory
+    os.environ.setdefault("PREFILTER_LEXICON", os.path.join(repo_root, "lexicon.json"))
+    for override in args.env or []:
+        key, _, value = override.partition("=")
+        os.environ[key] = value
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    os.chdir(workdir)
+    # Per-message INFO logging from the bots would dominate the timings
+    logging.disable(logging.INFO)
+
+    rows = load_corpus(corpus_path, args.limit)
+    stages = args.stage or list(STAGES)
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "corpus": corpus_path,
+        "messages": len(rows),
+        "concurrency": args.concurrency,
+        "env": args.env or [],
+        "stages": {},
+    }
+
+    from batching import BatchingDetector
+    from hate_speech_model import HateSpeechDetector
+
+    started = time.perf_counter()
+    model = HateSpeechDetector()
+    model.detect("warm up")
+    result["model_load_seconds"] = time.perf_counter() - started
+    result["rss_after_model_load_mb"] = peak_rss_mb()
+    detector = BatchingDetector(model)
+
+    if "detector" in stages:
+        result["stages"]["detector"] = run_stage(
+            lambda row: detector.detect(row["text"]), rows, args.concurrency
+        )
+
+    if "database" in stages:
+        from database import Database
+
+        db = Database(os.path.join(workdir, "replay.db"))
+
+        def database_ops(row):
+            group_id, user_id = str(row["chat_id"]), str(row["user_id"])
+            db.increment_message_stats(group_id)
+            if row["message_id"] % 10 == 0:
+                db.increment_message_stats(group_id, is_hate_speech=True)
+                db.add_violation(user_id, row.get("username"))
+                db.get_group_admins(group_id)
+            db.get_stats(group_id)
+            db.get_violation_count(user_id)
+
+        result["stages"]["database"] = run_stage(database_ops, rows, args.concurrency)
+        db.close()
+
+    if "handle_message" in stages:
+        import telegram_bot
+
+        bot = StubBot()
+        context = SimpleNamespace(bot=bot, args=[])
+        telegram_bot.detector = detector
+        telegram_bot.scheduler.start(bot)
+        result["stages"]["handle_message"] = run_stage(
+            lambda row: telegram_bot.handle_message(stub_update(row), context),
+            rows,
+            args.concurrency,
+        )
+        telegram_bot.flush_deferred()
+        telegram_bot.scheduler.close(timeout=1.0)
+        result["stages"]["handle_message"]["scheduler"] = telegram_bot.scheduler.stats()
+        if telegram_bot.flood is not None:
+            result["stages"]["handle_message"]["flood"] = telegram_bot.flood.stats()
+        telegram_bot.db.close()
+
+    if "whatsapp_webhook" in stages:
+        import whatsapp_bot
+        from benchmarks.fakes import FakeTwilioClient
+
+        whatsapp_bot.client = FakeTwilioClient(latency=args.twilio_latency)
+        whatsapp_bot.detector = detector
+        local = threading.local()
+
+        def webhook(row):
+            if not hasattr(local, "client"):
+                local.client = whatsapp_bot.app.test_client()
+            local.client.post(
+                "/whatsapp",
+                data={
+                    "From": f"whatsapp:+{row['user_id']}",
+                    "Body": row["text"],
+                    "MessageSid": f"SM{row['message_id']}",
+                },
+            )
+
+        result["stages"]["whatsapp_webhook"] = run_stage(
+            webhook, rows, args.concurrency
+        )
+        if whatsapp_bot.consumers is not None:
+            # The webhook only queued the messages; time the rest
+            started = time.perf_counter()
+            whatsapp_bot.consumers.drain(timeout=600)
+            whatsapp_bot.outbox_consumers.drain(timeout=600)
+            result["stages"]["whatsapp_webhook"]["drain_seconds"] = (
+                time.perf_counter() - started
+            )
+            whatsapp_bot.consumers.close()
+            whatsapp_bot.outbox_consumers.close()
+            result["stages"]["whatsapp_webhook"]["ingest"] = whatsapp_bot.ingest.stats()
+            result["stages"]["whatsapp_webhook"]["outbox"] = whatsapp_bot.outbox.stats()
+        whatsapp_bot.alerts.close()
+        result["stages"]["whatsapp_webhook"]["alerts"] = whatsapp_bot.alerts.stats()
+        whatsapp_bot.db.close()
+
+    detector.close()
+    result["detector_stats"] = detector.stats()
+    result["peak_rss_mb"] = peak_rss_mb()
+
+    output = json.dumps(result, indent=2, default=str)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+
+def compare(args):
+    # Flags stages whose p95 latency rose or throughput fell by more than
+    # --tolerance (a fraction) between two stored runs.
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    regressions = []
+    report = {}
+    for stage, base in baseline["stages"].items():
+        new = candidate["stages"].get(stage)
+        if new is None:
+            continue
+        row = {}
+        for metric, higher_is_worse in (
+            ("p50_ms", True),
+            ("p95_ms", True),
+            ("p99_ms", True),
+            ("messages_per_sec", False),
+            ("peak_rss_mb", True),
+        ):
+            old_value, new_value = base[metric], new[metric]
+            change = (new_value - old_value) / old_value if old_value else 0.0
+            row[metric] = {
+                "baseline": old_value,
+                "candidate": new_value,
+                "change": change,
+            }
+            worse = (
+                change > args.tolerance if higher_is_worse else -change > args.tolerance
+            )
+            if worse and metric in ("p95_ms", "messages_per_sec"):
+                regressions.append(f"{stage}.{metric} {change:+.1%}")
+        report[stage] = row
+
+    print(json.dumps({"stages": report, "regressions": regressions}, indent=2))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Moderation pipeline replay benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="Write a synthetic JSONL corpus")
+    gen.add_argument("output")
+    gen.add_argument("--count", type=int, default=5000)
+    gen.add_argument("--groups", type=int, default=20)
+    gen.add_argument("--users", type=int, default=500)
+    gen.add_argument("--seed", type=int, default=7)
+
+    run_parser = sub.add_parser("run", help="Replay a corpus through each stage")
+    run_parser.add_argument("corpus")
+    run_parser.add_argument("--output", help="Where to store the run as JSON")
+    run_parser.add_argument("--limit", type=int)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--stage", action="append", choices=STAGES)
+    run_parser.add_argument(
+        "--twilio-latency",
+        type=float,
+        default=0.1,
+        help="Simulated Twilio round trip in seconds",
+    )
+    run_parser.add_argument(
+        "--env", action="append", help="Config override for this run, KEY=VALUE"
+    )
+
+    cmp_parser = sub.add_parser("compare", help="Compare two stored runs")
+    cmp_parser.add_argument("baseline")
+    cmp_parser.add_argument("candidate")
+    cmp_parser.add_argument("--tolerance", type=float, default=0.10)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args.output, args.count, args.groups, args.users, args.seed)
+    elif args.command == "run":
+        run(args)
+    else:
+        return compare(args)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,180 @@
+# benchmarks/shard_load.py
+# Load test for telegram_shards.py. A fake Telegram update source feeds the
+# shard router with 1, 2, 4, ... workers; each worker runs the real handlers
+# and database with a stub bot and a CPU-bound fake detector. Reports
+# messages/sec per worker count and the scaling efficiency against one
+# worker. --rebalance adds and removes a worker mid-stream and checks that
+# every chat's messages were still handled in order.
+#
+#   python -m benchmarks.shard_load --workers 1,2,4 --updates 20000
+#   python -m benchmarks.shard_load --workers 2 --rebalance
+import argparse
+import functools
+import glob
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from benchmarks.replay import BENIGN, TOXIC, StubBot
+
+
+class ShardStubBot(StubBot):
+    # What telegram.ext.Dispatcher and Message.reply_text expect of a bot
+    defaults = None
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._record("send_message")
+
+
+def stub_bot():
+    return ShardStubBot()
+
+
+def setup_worker(cpu_ms, record_dir):
+    # Runs in each worker: swaps the model for the fake detector
+    import telegram_bot
+    from benchmarks.fakes import FakeDetector
+
+    record_path = None
+    if record_dir:
+        record_path = os.path.join(record_dir, f"{os.getpid()}.log")
+    telegram_bot.detector = FakeDetector(cpu_ms, record_path=record_path)
+
+
+def generate_updates(count, groups, users, seed):
+    # Telegram Bot API updates; texts carry "<chat> <seq>" for order checks
+    rng = random.Random(seed)
+    sequence = {}
+    for i in range(count):
+        chat_id = -1000000000000 - rng.randrange(groups)
+        user_id = 1000 + rng.randrange(users)
+        seq = sequence[chat_id] = sequence.get(chat_id, 0) + 1
+        body = rng.choice(TOXIC) if rng.random() < 0.1 else rng.choice(BENIGN)
+        yield {
+            "update_id": i + 1,
+            "message": {
+                "message_id": seq,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "load"},
+                "from": {
+                    "id": user_id,
+                    "is_bot": False,
+                    "first_name": "load",
+                    "username": f"user{user_id}",
+                },
+                "text": f"{chat_id} {seq} {body}",
+            },
+        }
+
+
+def check_order(record_dir):
+    # Every chat's messages must have been scored in sequence order, even
+    # across workers
+    entries = []
+    for path in glob.glob(os.path.join(record_dir, "*.log")):
+        with open(path) as f:
+            for line in f:
+                at, text = line.rstrip("\n").split("\t", 1)
+                chat_id, seq, _ = text.split(" ", 2)
+                entries.append((float(at), int(chat_id), int(seq)))
+    entries.sort()
+    last = {}
+    violations = 0
+    for _, chat_id, seq in entries:
+        if seq <= last.get(chat_id, 0):
+            violations += 1
+        last[chat_id] = seq
+    return {"scored": len(entries), "out_of_order": violations}
+
+
+def run(workers, updates, cpu_ms, lanes, record_dir=None, rebalance=False):
+    from telegram_shards import ShardRouter
+
+    router = ShardRouter(
+        bot_factory=stub_bot,
+        lanes=lanes,
+        setup=functools.partial(setup_worker, cpu_ms, record_dir),
+    )
+    router.start(workers)
+    # Workers are up (imports done, handlers registered) once they ack
+    router.drain()
+
+    result = {"workers": workers, "messages": len(updates)}
+    started = time.perf_counter()
+    if rebalance:
+        third = len(updates) // 3
+        for update in updates[:third]:
+            router.route(update)
+        pause = time.perf_counter()
+        router.add_worker()
+        result["add_pause_seconds"] = time.perf_counter() - pause
+        for update in updates[third : 2 * third]:
+            router.route(update)
+        pause = time.perf_counter()
+        router.remove_worker()
+        result["remove_pause_seconds"] = time.perf_counter() - pause
+        for update in updates[2 * third :]:
+            router.route(update)
+    else:
+        for update in updates:
+            router.route(update)
+    router.drain(timeout=600)
+    elapsed = time.perf_counter() - started
+
+    result["seconds"] = elapsed
+    result["messages_per_sec"] = len(updates) / elapsed
+    result["routed"] = {str(k): v for k, v in router.routed.items()}
+    router.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded Telegram bot load test")
+    parser.add_argument(
+        "--workers", default="1,2,4", help="Comma-separated worker counts"
+    )
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument(
+        "--cpu-ms", type=float, default=1.0, help="Fake detector CPU time per text"
+    )
+    parser.add_argument("--lanes", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--rebalance", action="store_true")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="shard-load-")
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Spawned workers inherit the environment and the working directory
+    os.environ.setdefault("PREFILTER_LEXICON", os.path.join(repo_root, "lexicon.json"))
+    # Flood control would defer bursts and hide the scaling being measured
+    os.environ["FLOOD_ENABLED"] = "0"
+    os.environ["METRICS_PORT"] = "0"
+    os.chdir(workdir)
+    logging.disable(logging.INFO)
+
+    updates = list(generate_updates(args.updates, args.groups, args.users, args.seed))
+    runs = []
+    for workers in [int(part) for part in args.workers.split(",")]:
+        record_dir = None
+        if args.rebalance:
+            record_dir = os.path.join(workdir, f"order-{workers}")
+            os.makedirs(record_dir)
+        result = run(
+            workers, updates, args.cpu_ms, args.lanes, record_dir, args.rebalance
+        )
+        if record_dir:
+            result["order"] = check_order(record_dir)
+        runs.append(result)
+
+    base = runs[0]["messages_per_sec"] / runs[0]["workers"]
+    for result in runs:
+        result["efficiency"] = result["messages_per_sec"] / (base * result["workers"])
+    print(json.dumps({"cpu_ms": args.cpu_ms, "runs": runs}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
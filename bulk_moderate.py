@@ -0,0 +1,372 @@
+# bulk_moderate.py
+# Offline moderation of a chat export (e.g. when onboarding a group). The
+# export is streamed, scored by a pool of detector processes in large batches
+# and written to the database in bulk transactions together with a
+# checkpoint, so an interrupted scan resumes where it stopped.
+#
+#   python bulk_moderate.py result.json --group-id -1001234567890
+#   python bulk_moderate.py history.jsonl --workers 4 --batch-size 512
+#   python bulk_moderate.py export.csv --restart
+#
+# Formats: Telegram Desktop JSON export ({"messages": [...]}) or a top-level
+# JSON array, JSONL with one message per line, and CSV with a header row.
+from collections import deque, namedtuple
+import argparse
+import csv
+from datetime import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+Message = namedtuple(
+    "Message", ["group_id", "message_id", "user_id", "username", "timestamp", "text"]
+)
+# Field names seen in Telegram, WhatsApp (Twilio) and hand-made exports
+TEXT_FIELDS = ("text", "body", "Body", "message")
+USER_FIELDS = ("from_id", "user_id", "sender", "From", "from")
+NAME_FIELDS = ("from", "username", "sender_name", "name")
+GROUP_FIELDS = ("group_id", "chat_id")
+ID_FIELDS = ("id", "message_id", "MessageSid")
+TIME_FIELDS = ("date_unixtime", "timestamp", "date")
+
+_ARRAY_SEPARATOR = re.compile(r"[\s,]*")
+
+
+def iter_json_array(f, key=None, chunk_size=1 << 16):
+    # Yields the elements of a top-level JSON array, or of the array under
+    # key in a top-level object, reading the file in chunks.
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key) if key else r"\s*\[")
+    while True:
+        match = start.search(buf) if key else start.match(buf)
+        if match:
+            pos = match.end()
+            break
+        more = f.read(chunk_size)
+        if not more or not key:
+            raise ValueError(f"No {key or 'top-level'} array found")
+        # Keep a tail in case the key straddles two chunks
+        buf = buf[-len(key) - 16 :] + more
+
+    while True:
+        pos = _ARRAY_SEPARATOR.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Element continues in the next chunk (grow reads for huge ones)
+            more = f.read(max(chunk_size, len(buf) - pos))
+            if not more:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield item
+        pos = end
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+def _first(record, fields):
+    for field in fields:
+        value = record.get(field)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def _text(value):
+    # Telegram rich text is a list of strings and {"type", "text"} entities
+    if isinstance(value, list):
+        return "".join(
+            part if isinstance(part, str) else part.get("text", "") for part in value
+        )
+    return value or ""
+
+
+def _timestamp(value):
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+def to_message(record, position, group_id=None):
+    # Normalizes one export record, or returns None for service messages
+    if record.get("type", "message") != "message":
+        return None
+    user_id = _first(record, USER_FIELDS)
+    return Message(
+        group_id=str(group_id or _first(record, GROUP_FIELDS) or "export"),
+        message_id=str(_first(record, ID_FIELDS) or position),
+        user_id=str(user_id) if user_id is not None else "unknown",
+        username=_first(record, NAME_FIELDS),
+        timestamp=_timestamp(_first(record, TIME_FIELDS)),
+        text=_text(_first(record, TEXT_FIELDS)),
+    )
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".csv":
+        return "csv"
+    return "json"
+
+
+def iter_records(path, fmt):
+    with open(path, encoding="utf-8", newline="" if fmt == "csv" else None) as f:
+        if fmt == "jsonl":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            # Top-level array, or a Telegram export object with "messages"
+            head = f.read(1024).lstrip()
+            f.seek(0)
+            key = None if head.startswith("[") else "messages"
+            yield from iter_json_array(f, key)
+
+
+def iter_messages(path, fmt=None, group_id=None):
+    records = iter_records(path, fmt or detect_format(path))
+    for position, record in enumerate(records):
+        message = to_message(record, position, group_id)
+        if message is not None:
+            yield message
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# Per-process state of pool workers
+_worker = None
+
+
+def init_worker():
+    global _worker
+    from cascade import load_cascade
+    from hate_speech_model import HateSpeechDetector
+    from prefilter import LexiconPrefilter
+
+    prefilter = LexiconPrefilter.from_file() if config.PREFILTER_ENABLED else None
+    cascade = load_cascade() if config.CASCADE_ENABLED else None
+    _worker = (HateSpeechDetector(), prefilter, cascade)
+
+
+def score_texts(texts):
+    # Returns (is_hate, stage, scores) per text; scores is None when the
+    # lexicon prefilter or the cascade student decided without the model.
+    from prefilter import classify_many
+
+    if _worker is None:
+        init_worker()
+    detector, prefilter, cascade = _worker
+    return [tuple(d) for d in classify_many(texts, detector, prefilter, cascade)]
+
+
+class Progress:
+    def __init__(self, position, report_every):
+        self.started = time.monotonic()
+        self.start_position = position
+        self.position = position
+        self.flagged = 0
+        self.recorded = 0
+        self.report_every = report_every
+        self._last_report = self.started
+        self._last_position = position
+
+    def update(self, position, flagged, recorded):
+        self.position = position
+        self.flagged += flagged
+        self.recorded += recorded
+        now = time.monotonic()
+        if now - self._last_report >= self.report_every:
+            recent = (position - self._last_position) / (now - self._last_report)
+            logger.info(
+                f"{position} messages scanned ({recent:.0f}/s now, "
+                f"{self.rate():.0f}/s overall), {self.flagged} flagged"
+            )
+            self._last_report = now
+            self._last_position = position
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return (self.position - self.start_position) / elapsed if elapsed else 0.0
+
+
+def record_batch(db, source, batch, results, position, progress, score_log=None):
+    from database import Verdict
+
+    verdicts = [
+        Verdict(m.group_id, m.message_id, m.user_id, m.username, m.timestamp, *result)
+        for m, result in zip(batch, results)
+    ]
+    new = db.record_new_verdicts(verdicts, source, position)
+    # Only messages recorded now go to the log, so a resumed or --restart
+    # scan never logs a message twice
+    if score_log is not None and new:
+        from prefilter import Decision
+
+        score_log.append_many(
+            (
+                v.group_id,
+                v.message_id,
+                Decision(v.is_hate, v.stage, v.scores),
+                v.timestamp,
+            )
+            for v in new
+        )
+    # Messages scanned before a resume were counted by the earlier run
+    progress.update(position, sum(v.is_hate for v in new), len(new))
+
+
+def scan(
+    path,
+    db,
+    source,
+    workers,
+    batch_size,
+    fmt=None,
+    group_id=None,
+    restart=False,
+    report_every=10.0,
+    score_log=None,
+):
+    position = 0 if restart else db.get_checkpoint(source)
+    if position:
+        logger.info(f"Resuming {source} after {position} messages")
+    messages = itertools.islice(iter_messages(path, fmt, group_id), position, None)
+    progress = Progress(position, report_every)
+
+    if workers <= 0:
+        # In-process, e.g. for debugging
+        for batch in batched(messages, batch_size):
+            results = score_texts([m.text for m in batch])
+            position += len(batch)
+            record_batch(db, source, batch, results, position, progress, score_log)
+        return progress
+
+    # Spawned workers each load their own model; at most two batches per
+    # worker are in flight, which bounds memory however large the export is.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=init_worker) as pool:
+        in_flight = deque()
+        for batch in batched(messages, batch_size):
+            texts = [m.text for m in batch]
+            in_flight.append((batch, pool.apply_async(score_texts, (texts,))))
+            if len(in_flight) >= 2 * workers:
+                batch, result = in_flight.popleft()
+                position += len(batch)
+                record_batch(
+                    db, source, batch, result.get(), position, progress, score_log
+                )
+        while in_flight:
+            batch, result = in_flight.popleft()
+            position += len(batch)
+            record_batch(db, source, batch, result.get(), position, progress, score_log)
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan a chat export for hate speech")
+    parser.add_argument("export", help="JSON, JSONL or CSV chat export")
+    parser.add_argument("--format", choices=("json", "jsonl", "csv"))
+    parser.add_argument(
+        "--group-id", help="Group id for every message (default: from the export)"
+    )
+    parser.add_argument("--db", default="hate_speech.db")
+    parser.add_argument(
+        "--score-log",
+        default=config.SCORE_LOG_PATH,
+        help="Score log to append to (empty to skip)",
+    )
+    parser.add_argument(
+        "--source", help="Checkpoint name (default: the export's file name)"
+    )
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="Detector processes (0 scores in-process)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=1,
+        help="Torch/ONNX threads in each worker process",
+    )
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--report-every", type=float, default=10.0, help="Seconds between reports"
+    )
+    args = parser.parse_args()
+
+    # Spawned workers read their thread settings from the environment
+    for name in ("TORCH_NUM_THREADS", "ONNX_INTRA_OP_THREADS"):
+        os.environ.setdefault(name, str(args.threads_per_worker))
+
+    from database import Database
+    from score_log import ScoreLog
+
+    # Counters are committed with each batch, not buffered
+    db = Database(args.db, write_behind=False)
+    source = args.source or os.path.basename(args.export)
+    score_log = ScoreLog(args.score_log) if args.score_log else None
+    started = time.monotonic()
+    try:
+        progress = scan(
+            args.export,
+            db,
+            source,
+            args.workers,
+            args.batch_size,
+            fmt=args.format,
+            group_id=args.group_id,
+            restart=args.restart,
+            report_every=args.report_every,
+            score_log=score_log,
+        )
+    finally:
+        if score_log is not None:
+            score_log.close()
+        db.close()
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Done: {progress.position} messages ({progress.recorded} newly recorded, "
+        f"{progress.flagged} flagged) in {elapsed:.1f}s, {progress.rate():.0f}/s"
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
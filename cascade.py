@@ -0,0 +1,389 @@
+# cascade.py
+# Two-tier cascade in front of the model. A small student (logistic
+# regression over hashed word and character n-grams) is distilled from the
+# model's stored scores and decides every message it is confident about;
+# only messages whose student score falls inside the calibrated uncertainty
+# band go on to toxic-bert.
+#
+#   python cascade.py train export.json --score-log scores.bin
+#   python cascade.py train teacher.jsonl --output models/cascade_student.npz
+#   python cascade.py report holdout.jsonl --teacher-ms 40
+#
+# Training data is a chat export (any format bulk_moderate.py reads) whose
+# messages were scored into the score log, or JSONL with "text" and the
+# model's "scores" ({label: score}) per line.
+from collections import Counter
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+import numpy as np
+import config
+from hate_speech_model import HATE_LABELS
+from prefilter import Decision, fold_text
+
+logger = logging.getLogger(__name__)
+
+STUDENT_CLEAN = "cascade:clean"
+STUDENT_HATE = "cascade:hate"
+
+
+def hashed_features(text, dims):
+    # Sorted unique feature indices: words, word bigrams and character 3- and
+    # 4-grams of the leet-folded text. crc32 keeps them stable across runs.
+    folded = fold_text(text or "")
+    words = folded.split()
+    grams = [f"w:{word}" for word in words]
+    grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    padded = f" {' '.join(words)} "
+    for n in (3, 4):
+        grams += [padded[i : i + n] for i in range(len(padded) - n + 1)]
+    indices = [zlib.crc32(gram.encode("utf-8")) % dims for gram in grams]
+    return np.unique(np.array(indices, dtype=np.int64))
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-np.clip(x, -30.0, 30.0)))
+
+
+class StudentModel:
+    # Features are binary and scaled to unit length, so scoring is a sum of
+    # a few hundred weights.
+    def __init__(self, weights, bias, low, high, meta=None):
+        self.weights = weights
+        self.bias = float(bias)
+        self.dims = len(weights)
+        self.low = float(low)
+        self.high = float(high)
+        self.meta = meta or {}
+
+    def score(self, text):
+        indices = hashed_features(text, self.dims)
+        if not len(indices):
+            return float(_sigmoid(self.bias))
+        total = self.weights[indices].sum() / np.sqrt(len(indices))
+        return float(_sigmoid(total + self.bias))
+
+    def score_many(self, texts):
+        return np.array([self.score(text) for text in texts], dtype=np.float32)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez_compressed(
+            path,
+            weights=self.weights,
+            bias=self.bias,
+            band=np.array([self.low, self.high]),
+            meta=json.dumps(self.meta),
+        )
+
+    @classmethod
+    def load(cls, path=None):
+        with np.load(path or config.CASCADE_MODEL) as data:
+            low, high = data["band"]
+            return cls(
+                data["weights"],
+                data["bias"],
+                low,
+                high,
+                json.loads(str(data["meta"])),
+            )
+
+
+# Fast path stage used by prefilter.classify: a Decision when the student is
+# confident, None when the message has to escalate to the model.
+class Cascade:
+    def __init__(self, student, low=None, high=None):
+        self.student = student
+        self.low = student.low if low is None or low < 0 else low
+        self.high = student.high if high is None or high < 0 else high
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def check(self, text):
+        score = self.student.score(text)
+        if score < self.low:
+            decision = Decision(False, STUDENT_CLEAN)
+        elif score > self.high:
+            decision = Decision(True, STUDENT_HATE)
+        else:
+            decision = None
+        with self._stats_lock:
+            self.stats[decision.stage if decision else "escalated"] += 1
+        return decision
+
+    def stage_counts(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def escalation_rate(self):
+        with self._stats_lock:
+            total = sum(self.stats.values())
+            return self.stats["escalated"] / total if total else 0.0
+
+
+def load_cascade():
+    return Cascade(
+        StudentModel.load(config.CASCADE_MODEL),
+        low=config.CASCADE_LOW,
+        high=config.CASCADE_HIGH,
+    )
+
+
+def teacher_score(scores):
+    # The score the model's verdict is based on (see exceeds_threshold)
+    return max(scores.get(label, 0.0) for label in HATE_LABELS)
+
+
+def featurize(texts, dims):
+    # CSR-style (indptr, indices) over all texts
+    rows = [hashed_features(text, dims) for text in texts]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+    indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    return indptr, indices
+
+
+def _logits(weights, bias, indptr, indices, scale, batch):
+    starts, ends = indptr[batch], indptr[batch + 1]
+    lengths = ends - starts
+    positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+    owner = np.repeat(np.arange(len(batch)), lengths)
+    sums = np.bincount(owner, weights=weights[indices[positions]], minlength=len(batch))
+    return sums * scale[batch] + bias, positions, owner
+
+
+def train(texts, targets, dims=None, epochs=5, learning_rate=0.5, l2=1e-6, seed=0):
+    # Logistic regression on the model's scores as soft targets, with
+    # AdaGrad over mini-batches
+    dims = dims or config.CASCADE_DIMS
+    targets = np.asarray(targets, dtype=np.float64)
+    indptr, indices = featurize(texts, dims)
+    lengths = np.diff(indptr)
+    scale = 1.0 / np.sqrt(np.maximum(lengths, 1))
+    weights = np.zeros(dims, dtype=np.float64)
+    history = np.full(dims, 1e-8)
+    bias = float(np.log((targets.mean() + 1e-6) / (1 - targets.mean() + 1e-6)))
+    rng = np.random.default_rng(seed)
+    for epoch in range(epochs):
+        loss = 0.0
+        for batch in np.array_split(
+            rng.permutation(len(texts)), max(1, len(texts) // 256)
+        ):
+            logits, positions, owner = _logits(
+                weights, bias, indptr, indices, scale, batch
+            )
+            predicted = _sigmoid(logits)
+            error = predicted - targets[batch]
+            loss += float(
+                -np.sum(
+                    targets[batch] * np.log(predicted + 1e-9)
+                    + (1 - targets[batch]) * np.log(1 - predicted + 1e-9)
+                )
+            )
+            gradient = np.zeros(dims)
+            np.add.at(gradient, indices[positions], (error * scale[batch])[owner])
+            touched = np.unique(indices[positions])
+            gradient[touched] += l2 * weights[touched]
+            history[touched] += gradient[touched] ** 2
+            weights[touched] -= (
+                learning_rate * gradient[touched] / np.sqrt(history[touched])
+            )
+            bias -= learning_rate * 0.1 * float(error.mean())
+        logger.info(f"Epoch {epoch + 1}: log loss {loss / max(1, len(texts)):.4f}")
+    return weights.astype(np.float32), bias
+
+
+def calibrate(student_scores, teacher_hate, max_missed=None, max_false=None):
+    # Widest confident regions such that, on held-out data, the clean side
+    # (score < low) misses at most max_missed of the model's hate verdicts and
+    # the hate side (score > high) is wrong on at most max_false of the
+    # messages it flags.
+    max_missed = config.CASCADE_MAX_MISSED if max_missed is None else max_missed
+    max_false = config.CASCADE_MAX_FALSE if max_false is None else max_false
+    order = np.argsort(student_scores, kind="stable")
+    scores = np.asarray(student_scores)[order]
+    hate = np.asarray(teacher_hate, dtype=bool)[order]
+    total_hate = max(1, int(hate.sum()))
+
+    # Clean side: messages below index i are decided clean
+    missed = np.concatenate([[0], np.cumsum(hate)])
+    allowed = np.flatnonzero(missed <= max_missed * total_hate)
+    low_index = int(allowed[-1]) if len(allowed) else 0
+    low = float(scores[low_index]) if low_index < len(scores) else 1.0
+
+    # Hate side: messages from index j on are decided hate
+    flagged = np.arange(len(scores), -1, -1)
+    wrong = np.concatenate([np.cumsum((~hate)[::-1])[::-1], [0]])
+    ok = np.flatnonzero(
+        (wrong <= max_false * np.maximum(flagged, 1))
+        & (np.arange(len(scores) + 1) >= low_index)
+    )
+    high_index = int(ok[0]) if len(ok) else len(scores)
+    high = float(scores[high_index - 1]) if high_index > 0 else 0.0
+    return low, max(low, high)
+
+
+def evaluate(cascade, texts, teacher_hate, student_ms=None, teacher_ms=None):
+    # Escalation rate, agreement with the model and expected speedup of the
+    # cascade against running the model on everything
+    started = time.perf_counter()
+    decisions = [cascade.check(text) for text in texts]
+    measured_ms = (time.perf_counter() - started) * 1000.0 / max(1, len(texts))
+    student_ms = measured_ms if student_ms is None else student_ms
+    teacher_hate = np.asarray(teacher_hate, dtype=bool)
+    escalated = np.array([decision is None for decision in decisions])
+    # Escalated messages get the model's own verdict
+    verdicts = np.array(
+        [
+            hate if decision is None else decision.is_hate
+            for decision, hate in zip(decisions, teacher_hate)
+        ],
+        dtype=bool,
+    )
+    total = len(texts)
+    hate = int(teacher_hate.sum())
+    flagged = int(verdicts.sum())
+    agree_hate = int((verdicts & teacher_hate).sum())
+    report = {
+        "messages": total,
+        "band": [cascade.low, cascade.high],
+        "escalation_rate": float(escalated.mean()) if total else 0.0,
+        "agreement": float((verdicts == teacher_hate).mean()) if total else 1.0,
+        "recall_vs_model": agree_hate / hate if hate else 1.0,
+        "precision_vs_model": agree_hate / flagged if flagged else 1.0,
+        "student_ms": student_ms,
+    }
+    if teacher_ms:
+        cost = student_ms + report["escalation_rate"] * teacher_ms
+        report["teacher_ms"] = teacher_ms
+        report["speedup"] = teacher_ms / cost if cost else 0.0
+    return report
+
+
+def load_corpus(path, score_log_path=None, fmt=None, group_id=None):
+    # (texts, teacher scores) for the messages that have stored model scores
+    if path.endswith((".jsonl", ".ndjson")) and score_log_path is None:
+        texts, scores = [], []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    if row.get("scores"):
+                        texts.append(row["text"])
+                        scores.append(teacher_score(row["scores"]))
+        return texts, np.array(scores, dtype=np.float32)
+
+    from bulk_moderate import iter_messages
+    import score_log
+
+    labels, rows = score_log.load(score_log_path)
+    decisive = score_log.decisive_scores(labels, rows)
+    scored = ~np.isnan(decisive)
+    # The last stored score of each message
+    by_message = {
+        key: value
+        for key, value in zip(
+            zip(rows["group"][scored].tolist(), rows["message"][scored].tolist()),
+            decisive[scored].tolist(),
+        )
+    }
+    texts, scores = [], []
+    for message in iter_messages(path, fmt, group_id):
+        key = (score_log.int_id(message.group_id), score_log.int_id(message.message_id))
+        score = by_message.get(key)
+        if score is not None and message.text:
+            texts.append(message.text)
+            scores.append(score)
+    return texts, np.array(scores, dtype=np.float32)
+
+
+def _measure_teacher_ms(texts, sample):
+    from hate_speech_model import HateSpeechDetector
+
+    detector = HateSpeechDetector()
+    # Distinct texts so the verdict cache cannot answer
+    texts = list(dict.fromkeys(texts))[:sample]
+    detector.score_uncached(texts[:8])
+    started = time.perf_counter()
+    for start in range(0, len(texts), config.BATCH_MAX_SIZE):
+        detector.score_uncached(texts[start : start + config.BATCH_MAX_SIZE])
+    return (time.perf_counter() - started) * 1000.0 / max(1, len(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cascade student tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = sub.add_parser("train", help="Distill and calibrate a student")
+    train_parser.add_argument("corpus")
+    train_parser.add_argument("--score-log", help="Teacher scores for an export")
+    train_parser.add_argument("--format", choices=("json", "jsonl", "csv"))
+    train_parser.add_argument("--group-id")
+    train_parser.add_argument("--output", default=config.CASCADE_MODEL)
+    train_parser.add_argument("--dims", type=int, default=config.CASCADE_DIMS)
+    train_parser.add_argument("--epochs", type=int, default=5)
+    train_parser.add_argument("--holdout", type=float, default=0.2)
+    train_parser.add_argument("--max-missed", type=float)
+    train_parser.add_argument("--max-false", type=float)
+    train_parser.add_argument("--teacher-ms", type=float)
+
+    report_parser = sub.add_parser("report", help="Evaluate a trained student")
+    report_parser.add_argument("corpus")
+    report_parser.add_argument("--score-log")
+    report_parser.add_argument("--format", choices=("json", "jsonl", "csv"))
+    report_parser.add_argument("--group-id")
+    report_parser.add_argument("--model", default=config.CASCADE_MODEL)
+    report_parser.add_argument(
+        "--teacher-ms", type=float, help="Model cost per message (default: measured)"
+    )
+    report_parser.add_argument("--teacher-sample", type=int, default=256)
+    args = parser.parse_args()
+
+    texts, scores = load_corpus(args.corpus, args.score_log, args.format, args.group_id)
+    if not texts:
+        raise SystemExit("No messages with stored model scores found")
+    teacher_hate = scores > config.HATE_SPEECH_THRESHOLD
+
+    if args.command == "train":
+        rng = np.random.default_rng(0)
+        order = rng.permutation(len(texts))
+        cut = int(len(texts) * (1 - args.holdout))
+        fit, held = order[:cut], order[cut:]
+        weights, bias = train(
+            [texts[i] for i in fit], scores[fit], dims=args.dims, epochs=args.epochs
+        )
+        student = StudentModel(weights, bias, 0.0, 1.0)
+        held_texts = [texts[i] for i in held]
+        low, high = calibrate(
+            student.score_many(held_texts),
+            teacher_hate[held],
+            args.max_missed,
+            args.max_false,
+        )
+        student.low, student.high = low, high
+        student.meta = {
+            "trained_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "messages": len(fit),
+            "threshold": config.HATE_SPEECH_THRESHOLD,
+        }
+        student.save(args.output)
+        report = evaluate(
+            Cascade(student), held_texts, teacher_hate[held], teacher_ms=args.teacher_ms
+        )
+        report["saved"] = args.output
+    else:
+        cascade = Cascade(
+            StudentModel.load(args.model), config.CASCADE_LOW, config.CASCADE_HIGH
+        )
+        teacher_ms = args.teacher_ms or _measure_teacher_ms(texts, args.teacher_sample)
+        report = evaluate(cascade, texts, teacher_hate, teacher_ms=teacher_ms)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
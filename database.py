@@ -1,16 +1,280 @@
 # database.py
+from collections import namedtuple
+import atexit
+import json
+import re
 import sqlite3
+import threading
+import time
 from datetime import datetime
 import logging
+import config
+import metrics
+from admin_directory import AdminDirectory
+from violation_windows import ViolationWindows
 
 logger = logging.getLogger(__name__)
 
+DB_SECONDS = metrics.histogram(
+    "hate_speech_db_seconds", "Time spent in Database methods", ["method"]
+)
+
+UPSERT_MESSAGE_STATS = """
+    INSERT INTO message_stats (group_id, total_messages, hate_speech_messages)
+    VALUES (?, ?, ?)
+    ON CONFLICT(group_id) DO UPDATE SET
+        total_messages = total_messages + excluded.total_messages,
+        hate_speech_messages = hate_speech_messages + excluded.hate_speech_messages
+"""
+
+UPSERT_VIOLATIONS = """
+    INSERT INTO users (user_id, username, violation_count, last_violation_date)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        violation_count = violation_count + excluded.violation_count,
+        last_violation_date = excluded.last_violation_date
+"""
+
+# One classified message for record_verdicts(); timestamp is epoch seconds
+# or None
+Verdict = namedtuple(
+    "Verdict",
+    [
+        "group_id",
+        "message_id",
+        "user_id",
+        "username",
+        "timestamp",
+        "is_hate",
+        "stage",
+        "scores",
+    ],
+)
+
+
+def create_queue_table(cursor, table):
+    # A leased work queue (see ingest_queue.py); the outbox lives in the main
+    # database so its rows commit together with the verdicts behind them
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_key TEXT NOT NULL UNIQUE,
+            payload TEXT,
+            enqueued_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            finished_at REAL
+        )
+    """
+    )
+    # Consumers and lag reads only touch pending rows
+    cursor.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_pending
+        ON {table} (id) WHERE status = 'pending'
+    """
+    )
+    cursor.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_finished
+        ON {table} (finished_at) WHERE status != 'pending'
+    """
+    )
+
+
+OUTBOX_TABLE = "outbox"
+
+INSERT_OUTBOX = f"""
+    INSERT OR IGNORE INTO {OUTBOX_TABLE} (message_key, payload, enqueued_at)
+    VALUES (?, ?, ?)
+"""
+
+INSERT_VIOLATION_EVENT = """
+    INSERT INTO violations (group_id, user_id, ts, message_id) VALUES (?, ?, ?, ?)
+"""
+
+# Violations found by an export scan keep the scan's source: they are history,
+# and only rows without one count towards penalties
+INSERT_SCANNED_VIOLATION_EVENT = """
+    INSERT INTO violations (group_id, user_id, ts, message_id, source)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Rollup granularities in seconds, finest first. New counts land in minute
+# buckets; compaction folds old minutes into hours and old hours into days,
+# so every point in time is covered by exactly one granularity.
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+GRANULARITIES = (MINUTE, HOUR, DAY)
+
+SCOPE_GROUP = "group"
+SCOPE_USER = "user"
+
+UPSERT_ROLLUP = """
+    INSERT INTO stat_rollups
+        (scope, scope_id, granularity, bucket_start,
+         total_messages, hate_speech_messages)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(scope, scope_id, granularity, bucket_start) DO UPDATE SET
+        total_messages = total_messages + excluded.total_messages,
+        hate_speech_messages = hate_speech_messages + excluded.hate_speech_messages
+"""
+
+# Params: coarse, coarse, fine, cutoff, coarse
+COMPACT_ROLLUPS = """
+    INSERT INTO stat_rollups
+        (scope, scope_id, granularity, bucket_start,
+         total_messages, hate_speech_messages)
+    SELECT scope, scope_id, ?, bucket_start - bucket_start % ?,
+           SUM(total_messages), SUM(hate_speech_messages)
+    FROM stat_rollups
+    WHERE granularity = ? AND bucket_start < ?
+    GROUP BY scope, scope_id, bucket_start - bucket_start % ?
+    ON CONFLICT(scope, scope_id, granularity, bucket_start) DO UPDATE SET
+        total_messages = total_messages + excluded.total_messages,
+        hate_speech_messages = hate_speech_messages + excluded.hate_speech_messages
+"""
+
+# One index range per granularity on the primary key
+SELECT_WINDOW = f"""
+    SELECT COALESCE(SUM(total_messages), 0), COALESCE(SUM(hate_speech_messages), 0)
+    FROM stat_rollups
+    WHERE scope = ? AND scope_id = ?
+      AND granularity IN ({", ".join(map(str, GRANULARITIES))})
+      AND bucket_start >= ? AND bucket_start < ?
+"""
+
+WINDOW_UNITS = {"m": MINUTE, "h": HOUR, "d": DAY, "w": 7 * DAY}
+
+
+def parse_window(text):
+    # "30m", "24h", "7d", "2w" -> seconds
+    match = re.fullmatch(r"(\d+)\s*([mhdw])", text.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid window {text!r}; use e.g. 30m, 24h, 7d or 2w")
+    return int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+
+
+class ConnectionPool:
+    # Hands every thread its own sqlite3 connection. Connections of threads
+    # that have exited (e.g. Flask request threads) go back to an idle list
+    # and are reused, so the pool stays bounded under thread churn.
+    def __init__(self, db_name, max_idle=None):
+        self.db_name = db_name
+        self.max_idle = max_idle or config.DB_POOL_SIZE
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._owners = {}  # thread -> connection
+        self._idle = []
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._lock:
+                self._reclaim()
+                conn = self._idle.pop() if self._idle else self._connect()
+                self._owners[threading.current_thread()] = conn
+            self._local.conn = conn
+        return conn
+
+    def _connect(self):
+        # check_same_thread=False only so close_all() can run from any thread;
+        # each connection is otherwise used by its owning thread alone.
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=config.DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=config.DB_CACHED_STATEMENTS,
+        )
+        # WAL lets readers run concurrently with the single writer
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={config.DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _reclaim(self):
+        for thread in [t for t in self._owners if not t.is_alive()]:
+            conn = self._owners.pop(thread)
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+            else:
+                conn.close()
+
+    def close_all(self):
+        with self._lock:
+            for conn in list(self._owners.values()) + self._idle:
+                conn.close()
+            self._owners.clear()
+            self._idle.clear()
+        self._local = threading.local()
+
 
 class Database:
-    def __init__(self, db_name="hate_speech.db"):
-        # Use check_same_thread=False for simplicity in multi‑threaded environments
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+    def __init__(
+        self,
+        db_name="hate_speech.db",
+        write_behind=None,
+        flush_interval=None,
+        flush_size=None,
+        sync_violations=None,
+    ):
+        # Every thread gets its own pooled connection (see ConnectionPool)
+        self.pool = ConnectionPool(db_name)
         self.create_tables()
+        self.admins = AdminDirectory(self.get_group_admin_entries)
+        # Per-group violation counts within VIOLATION_WINDOW for penalties
+        self.violation_windows = ViolationWindows(self._load_violation_times)
+
+        # Write-behind mode keeps counter deltas in memory and flushes them in
+        # one transaction every flush_interval seconds (the maximum data-loss
+        # window) or once flush_size updates are pending.
+        self.write_behind = (
+            config.DB_WRITE_BEHIND if write_behind is None else write_behind
+        )
+        self.flush_interval = flush_interval or config.DB_FLUSH_INTERVAL
+        self.flush_size = flush_size or config.DB_FLUSH_SIZE
+        # Violation counts drive penalties; when several processes count the
+        # same users (shard workers), each violation is committed at once so
+        # every process sees the others' increments.
+        self.sync_violations = (
+            config.DB_SYNC_VIOLATIONS if sync_violations is None else sync_violations
+        )
+        # _lock guards the in-memory state below and is never held across a
+        # commit; _flush_lock serializes flushes.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Current values (stored + unflushed) of every counter touched since
+        # the last flush, so readers never wait for a flush to commit.
+        self._known_stats = {}  # group_id -> [total, hate]
+        self._known_violations = {}  # user_id -> count
+        self._dirty_stats = {}  # group_id -> [total delta, hate delta]
+        self._dirty_violations = {}  # user_id -> [delta, username, date]
+        self._dirty_rollups = {}  # (scope, scope_id) -> {minute: [total, hate]}
+        self._dirty_events = []  # violations rows
+        self._pending_updates = 0
+        self._flush_wanted = threading.Event()
+        self._closed = False
+
+        # Rollups older than the retention of their granularity are folded
+        # into the next coarser one every ROLLUP_COMPACT_INTERVAL seconds.
+        self.compact_interval = config.ROLLUP_COMPACT_INTERVAL
+        self._next_compaction = time.monotonic()
+        self._flusher = None
+        if self.write_behind or self.compact_interval:
+            self._flusher = threading.Thread(
+                target=self._maintenance_loop, name="db-maintenance", daemon=True
+            )
+            self._flusher.start()
+            atexit.register(self.close)
+
+    @property
+    def conn(self):
+        return self.pool.connection()
 
     def create_tables(self):
         cursor = self.conn.cursor()
@@ -43,31 +307,183 @@ class Database:
             )
         """
         )
+        # Windowed counters per group and per user; the primary key makes a
+        # window read a few index range scans regardless of history length
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stat_rollups (
+                scope TEXT,
+                scope_id TEXT,
+                granularity INTEGER,
+                bucket_start INTEGER,
+                total_messages INTEGER DEFAULT 0,
+                hate_speech_messages INTEGER DEFAULT 0,
+                PRIMARY KEY (scope, scope_id, granularity, bucket_start)
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_stat_rollups_age
+            ON stat_rollups (granularity, bucket_start)
+        """
+        )
+        # Offline scans of chat exports (see bulk_moderate.py)
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS message_verdicts (
+                group_id TEXT,
+                message_id TEXT,
+                user_id TEXT,
+                is_hate INTEGER,
+                stage TEXT,
+                scores TEXT,
+                created_at TEXT,
+                expires_at REAL,
+                PRIMARY KEY (group_id, message_id)
+            )
+        """
+        )
+        # Live messages are only kept while they may be replayed; rows from
+        # export scans have no expiry
+        columns = {
+            row[1] for row in cursor.execute("PRAGMA table_info(message_verdicts)")
+        }
+        if "expires_at" not in columns:
+            cursor.execute("ALTER TABLE message_verdicts ADD COLUMN expires_at REAL")
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_message_verdicts_expiry
+            ON message_verdicts (expires_at) WHERE expires_at IS NOT NULL
+        """
+        )
+        # Messages owed for new verdicts (alerts, replies), see
+        # record_new_verdicts()
+        create_queue_table(cursor, OUTBOX_TABLE)
+        # One row per violation, for per-group windowed counts; rows older
+        # than VIOLATION_RETENTION are deleted by compact_violations()
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS violations (
+                group_id TEXT,
+                user_id TEXT,
+                ts INTEGER,
+                message_id TEXT,
+                source TEXT
+            )
+        """
+        )
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(violations)")}
+        if "source" not in columns:
+            cursor.execute("ALTER TABLE violations ADD COLUMN source TEXT")
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_violations_member
+            ON violations (group_id, user_id, ts)
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_violations_ts ON violations (ts)
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scan_checkpoints (
+                source TEXT PRIMARY KEY,
+                position INTEGER,
+                updated_at TEXT
+            )
+        """
+        )
         self.conn.commit()
 
+    @DB_SECONDS.time(method="add_violation")
     def add_violation(self, user_id, username):
-        cursor = self.conn.cursor()
+        now = datetime.now().isoformat()
+        if self.write_behind and not self.sync_violations:
+            with self._lock:
+                count = self._known_violations.get(user_id)
+                if count is None:
+                    # No unflushed delta exists for an unknown user, so the
+                    # stored count is exact (WAL reads never block).
+                    count = self._stored_violation_count(user_id)
+                count += 1
+                self._known_violations[user_id] = count
+                dirty = self._dirty_violations.setdefault(user_id, [0, username, now])
+                dirty[0] += 1
+                dirty[2] = now
+                self._note_pending_update()
+            return count
+
+        # The UPSERT takes the write lock, so the SELECT in the same
+        # transaction sees exactly this increment.
+        conn = self.conn
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_VIOLATIONS, (user_id, username, 1, now))
         cursor.execute(
             "SELECT violation_count FROM users WHERE user_id = ?", (user_id,)
         )
-        row = cursor.fetchone()
-        now = datetime.now().isoformat()
-        if row:
-            count = row[0] + 1
-            cursor.execute(
-                "UPDATE users SET violation_count = ?, last_violation_date = ? WHERE user_id = ?",
-                (count, now, user_id),
-            )
-        else:
-            count = 1
-            cursor.execute(
-                "INSERT INTO users (user_id, username, violation_count, last_violation_date) VALUES (?, ?, ?, ?)",
-                (user_id, username, count, now),
+        count = cursor.fetchone()[0]
+        conn.commit()
+        return count
+
+    @DB_SECONDS.time(method="record_violation")
+    def record_violation(self, group_id, user_id, username, message_id=None, now=None):
+        # Records a violation in group_id and returns the user's violations
+        # there within VIOLATION_WINDOW, this one included. The all-time
+        # count in users is kept as well.
+        now = int(time.time() if now is None else now)
+        event = (group_id, user_id, now, message_id)
+        if self.write_behind and not self.sync_violations:
+            self.add_violation(user_id, username)
+            count = self.violation_windows.add(group_id, user_id, now)
+            with self._lock:
+                self._dirty_events.append(event)
+                self._note_pending_update()
+            return count
+
+        # Counted in memory before the insert, so loading the pair cannot
+        # read this violation back; the user and the event commit together
+        count = self.violation_windows.add(group_id, user_id, now)
+        conn = self.conn
+        try:
+            conn.execute(
+                UPSERT_VIOLATIONS, (user_id, username, 1, datetime.now().isoformat())
             )
-        self.conn.commit()
+            conn.execute(INSERT_VIOLATION_EVENT, event)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            self.violation_windows.forget(group_id, user_id)
+            raise
         return count
 
-    def get_violation_count(self, user_id):
+    @DB_SECONDS.time(method="get_recent_violations")
+    def get_recent_violations(self, group_id, user_id):
+        return self.violation_windows.count(group_id, user_id)
+
+    def _load_violation_times(self, group_id, user_id, since):
+        # Stored and not yet flushed violations of a user in a group
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT ts FROM violations
+            WHERE group_id = ? AND user_id = ? AND ts > ? AND source IS NULL
+            ORDER BY ts
+            """,
+            (group_id, user_id, since),
+        )
+        times = [row[0] for row in cursor.fetchall()]
+        with self._lock:
+            pending = [
+                e[2]
+                for e in self._dirty_events
+                if e[0] == group_id and e[1] == user_id and e[2] > since
+            ]
+        return sorted(times + pending) if pending else times
+
+    def _stored_violation_count(self, user_id):
         cursor = self.conn.cursor()
         cursor.execute(
             "SELECT violation_count FROM users WHERE user_id = ?", (user_id,)
@@ -75,77 +491,124 @@ class Database:
         row = cursor.fetchone()
         return row[0] if row else 0
 
+    @DB_SECONDS.time(method="get_violation_count")
+    def get_violation_count(self, user_id):
+        with self._lock:
+            count = self._known_violations.get(user_id)
+        if count is not None:
+            return count
+        return self._stored_violation_count(user_id)
+
+    @DB_SECONDS.time(method="get_group_admins")
     def get_group_admins(self, group_id):
-        cursor = self.conn.cursor()
+        # Served from the admin directory; SQLite is only read on a miss. A
+        # failed read is not cached, so the next alert tries again.
         try:
-            cursor.execute(
-                "SELECT DISTINCT admin_id FROM admins WHERE group_id = ?", (group_id,)
-            )
-            return [row[0] for row in cursor.fetchall()]
+            return self.admins.admin_ids(group_id)
         except Exception as e:
             logger.error(f"Database error getting admins: {e}")
             return []
 
-    def add_admin(self, admin_id, group_id, username):
+    @DB_SECONDS.time(method="get_group_admin_entries")
+    def get_group_admin_entries(self, group_id):
+        # Raises on errors: an empty list would be cached as "no admins"
         cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT admin_id, username FROM admins WHERE group_id = ?",
+            (group_id,),
+        )
+        return cursor.fetchall()
+
+    @DB_SECONDS.time(method="load_all_admins")
+    def load_all_admins(self):
+        # Warms the admin directory for every group with a single query
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT group_id, admin_id, username FROM admins")
+        admins_by_group = {}
+        for group_id, admin_id, username in cursor.fetchall():
+            admins_by_group.setdefault(group_id, []).append((admin_id, username))
+        self.admins.prime(admins_by_group)
+        return admins_by_group
+
+    @DB_SECONDS.time(method="add_admin")
+    def add_admin(self, admin_id, group_id, username):
+        conn = self.conn
+        cursor = conn.cursor()
         try:
             cursor.execute(
                 """
-                INSERT OR REPLACE INTO admins (admin_id, group_id, username) 
+                INSERT OR REPLACE INTO admins (admin_id, group_id, username)
                 VALUES (?, ?, ?)
                 """,
                 (admin_id, group_id, username),
             )
-            self.conn.commit()
+            conn.commit()
+            self.admins.invalidate(group_id)
             return True
         except Exception as e:
             logger.error(f"Database error adding admin: {e}")
-            self.conn.rollback()
+            conn.rollback()
             return False
 
+    @DB_SECONDS.time(method="remove_admin")
     def remove_admin(self, admin_id, group_id):
-        cursor = self.conn.cursor()
+        conn = self.conn
+        cursor = conn.cursor()
         cursor.execute(
             "DELETE FROM admins WHERE admin_id = ? AND group_id = ?",
             (admin_id, group_id),
         )
-        self.conn.commit()
+        conn.commit()
+        self.admins.invalidate(group_id)
 
-    def increment_message_stats(self, group_id, is_hate_speech=False):
+    @DB_SECONDS.time(method="increment_message_stats")
+    def increment_message_stats(self, group_id, is_hate_speech=False, user_id=None):
+        hate = 1 if is_hate_speech else 0
+        minute = int(time.time()) // MINUTE * MINUTE
+        scopes = [(SCOPE_GROUP, group_id)]
+        if user_id is not None:
+            scopes.append((SCOPE_USER, user_id))
+        if self.write_behind:
+            with self._lock:
+                known = self._known_stats.get(group_id)
+                if known is None:
+                    known = list(self._stored_stats(group_id))
+                    self._known_stats[group_id] = known
+                known[0] += 1
+                known[1] += hate
+                dirty = self._dirty_stats.setdefault(group_id, [0, 0])
+                dirty[0] += 1
+                dirty[1] += hate
+                for scope in scopes:
+                    buckets = self._dirty_rollups.setdefault(scope, {})
+                    bucket = buckets.setdefault(minute, [0, 0])
+                    bucket[0] += 1
+                    bucket[1] += hate
+                self._note_pending_update()
+            return
+        conn = self.conn
         try:
-            cursor = self.conn.cursor()
-            # First, ensure the group exists in stats
-            cursor.execute(
-                """
-                INSERT OR IGNORE INTO message_stats (group_id, total_messages, hate_speech_messages)
-                VALUES (?, 0, 0)
-            """,
-                (group_id,),
-            )
-
-            # Then update the counters
-            cursor.execute(
-                """
-                UPDATE message_stats 
-                SET total_messages = total_messages + 1,
-                    hate_speech_messages = hate_speech_messages + ?
-                WHERE group_id = ?
-            """,
-                (1 if is_hate_speech else 0, group_id),
+            # Single UPSERT creates the group row and bumps the counters
+            conn.execute(UPSERT_MESSAGE_STATS, (group_id, 1, hate))
+            conn.executemany(
+                UPSERT_ROLLUP,
+                [
+                    (scope, scope_id, MINUTE, minute, 1, hate)
+                    for scope, scope_id in scopes
+                ],
             )
-
-            self.conn.commit()
+            conn.commit()
         except Exception as e:
             logger.error(f"Error incrementing message stats: {e}")
-            self.conn.rollback()
+            conn.rollback()
 
-    def get_stats(self, group_id):
+    def _stored_stats(self, group_id):
         try:
             cursor = self.conn.cursor()
             cursor.execute(
                 """
-                SELECT total_messages, hate_speech_messages 
-                FROM message_stats 
+                SELECT total_messages, hate_speech_messages
+                FROM message_stats
                 WHERE group_id = ?
             """,
                 (group_id,),
@@ -155,3 +618,342 @@ class Database:
         except Exception as e:
             logger.error(f"Error getting stats: {e}")
             return (0, 0)
+
+    @DB_SECONDS.time(method="get_stats")
+    def get_stats(self, group_id):
+        with self._lock:
+            known = self._known_stats.get(group_id)
+            if known is not None:
+                return tuple(known)
+        return self._stored_stats(group_id)
+
+    @DB_SECONDS.time(method="get_window_stats")
+    def get_window_stats(self, scope, scope_id, seconds, now=None):
+        # (total, hate) for scope_id (a group or user id) over the last
+        # seconds. Windows start on the bucket boundary of the data at that
+        # age: exact to the minute for recent history, to the hour or day
+        # for older history that has been compacted.
+        now = int(time.time() if now is None else now)
+        start = now - seconds
+        end = now // MINUTE * MINUTE + MINUTE
+        cursor = self.conn.cursor()
+        cursor.execute(SELECT_WINDOW, (scope, scope_id, start, end))
+        total, hate = cursor.fetchone()
+        with self._lock:
+            # Counts not yet flushed (write-behind)
+            pending = self._dirty_rollups.get((scope, scope_id), {})
+            for minute, (pending_total, pending_hate) in pending.items():
+                if start <= minute < end:
+                    total += pending_total
+                    hate += pending_hate
+        return total, hate
+
+    @DB_SECONDS.time(method="compact_rollups")
+    def compact_rollups(self, now=None):
+        # Folds minute buckets older than ROLLUP_MINUTE_RETENTION into hours
+        # and hour buckets older than ROLLUP_HOUR_RETENTION into days, one
+        # transaction; only whole coarse buckets are folded. Day buckets are
+        # dropped after ROLLUP_DAY_RETENTION (0 keeps them forever).
+        now = int(time.time() if now is None else now)
+        conn = self.conn
+        folded = 0
+        try:
+            cursor = conn.cursor()
+            for fine, coarse, retention in (
+                (MINUTE, HOUR, config.ROLLUP_MINUTE_RETENTION),
+                (HOUR, DAY, config.ROLLUP_HOUR_RETENTION),
+            ):
+                cutoff = (now - retention) // coarse * coarse
+                cursor.execute(COMPACT_ROLLUPS, (coarse, coarse, fine, cutoff, coarse))
+                cursor.execute(
+                    "DELETE FROM stat_rollups WHERE granularity = ? AND bucket_start < ?",
+                    (fine, cutoff),
+                )
+                folded += cursor.rowcount
+            if config.ROLLUP_DAY_RETENTION:
+                cursor.execute(
+                    "DELETE FROM stat_rollups WHERE granularity = ? AND bucket_start < ?",
+                    (DAY, now - config.ROLLUP_DAY_RETENTION),
+                )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error compacting stat rollups: {e}")
+            conn.rollback()
+            return 0
+        if folded:
+            logger.info(f"Compacted {folded} stat rollup rows")
+        return folded
+
+    @DB_SECONDS.time(method="compact_violations")
+    def compact_violations(self, now=None):
+        # Deletes violation rows older than VIOLATION_RETENTION; the all-time
+        # counts in users are unaffected
+        now = int(time.time() if now is None else now)
+        conn = self.conn
+        try:
+            cursor = conn.execute(
+                "DELETE FROM violations WHERE ts < ?",
+                (now - max(config.VIOLATION_RETENTION, config.VIOLATION_WINDOW),),
+            )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error compacting violations: {e}")
+            conn.rollback()
+            return 0
+        if cursor.rowcount:
+            logger.info(f"Deleted {cursor.rowcount} expired violation rows")
+        return cursor.rowcount
+
+    @DB_SECONDS.time(method="prune_verdicts")
+    def prune_verdicts(self, now=None):
+        # Deletes message_verdicts rows whose retention has passed
+        conn = self.conn
+        try:
+            cursor = conn.execute(
+                "DELETE FROM message_verdicts WHERE expires_at < ?",
+                (time.time() if now is None else now,),
+            )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error pruning message verdicts: {e}")
+            conn.rollback()
+            return 0
+        return cursor.rowcount
+
+    @DB_SECONDS.time(method="record_verdicts")
+    def record_verdicts(self, verdicts, source=None, position=None):
+        # Bulk path for offline scans. verdicts have group_id, message_id,
+        # user_id, username, timestamp (epoch seconds or None), is_hate, stage
+        # and scores. Verdict rows, counters, violations, rollups and the scan
+        # checkpoint are written in one transaction; messages already recorded
+        # are skipped, so a re-run never counts a message twice.
+        return len(self._record_verdicts(verdicts, source, position))
+
+    @DB_SECONDS.time(method="record_new_verdicts")
+    def record_new_verdicts(
+        self, verdicts, source=None, position=None, outbox=None, retention=None
+    ):
+        # Like record_verdicts(), returning the verdicts that were not
+        # recorded before (see ingest_queue.py). outbox(verdict) is called for
+        # each of them and returns (key, payload) pairs, which are queued in
+        # the outbox table in the same transaction. Rows expire after
+        # retention seconds (see prune_verdicts()) when it is given.
+        expires_at = time.time() + retention if retention else None
+        return self._record_verdicts(verdicts, source, position, outbox, expires_at)
+
+    def _record_verdicts(
+        self, verdicts, source=None, position=None, outbox=None, expires_at=None
+    ):
+        now = datetime.now().isoformat()
+        stats, violations, rollups = {}, {}, {}
+        events = []
+        messages = []
+        conn = self.conn
+        try:
+            cursor = conn.cursor()
+            recorded = []
+            for v in verdicts:
+                cursor.execute(
+                    """
+                    INSERT OR IGNORE INTO message_verdicts
+                        (group_id, message_id, user_id, is_hate, stage, scores,
+                         created_at, expires_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        v.group_id,
+                        v.message_id,
+                        v.user_id,
+                        1 if v.is_hate else 0,
+                        v.stage,
+                        json.dumps(v.scores) if v.scores is not None else None,
+                        now,
+                        expires_at,
+                    ),
+                )
+                if cursor.rowcount != 1:
+                    continue
+                recorded.append(v)
+                if outbox is not None:
+                    messages += [
+                        (key, json.dumps(payload), time.time())
+                        for key, payload in outbox(v)
+                    ]
+                hate = 1 if v.is_hate else 0
+                counts = stats.setdefault(v.group_id, [0, 0])
+                counts[0] += 1
+                counts[1] += hate
+                if v.is_hate:
+                    entry = violations.setdefault(v.user_id, [0, v.username, now])
+                    entry[0] += 1
+                    ts = int(v.timestamp if v.timestamp is not None else time.time())
+                    events.append((v.group_id, v.user_id, ts, v.message_id, source))
+                if v.timestamp is not None:
+                    minute = int(v.timestamp) // MINUTE * MINUTE
+                    for scope in ((SCOPE_GROUP, v.group_id), (SCOPE_USER, v.user_id)):
+                        bucket = rollups.setdefault(scope + (minute,), [0, 0])
+                        bucket[0] += 1
+                        bucket[1] += hate
+            cursor.executemany(
+                UPSERT_MESSAGE_STATS,
+                [(group_id, d[0], d[1]) for group_id, d in stats.items()],
+            )
+            cursor.executemany(
+                UPSERT_VIOLATIONS,
+                [(user_id, d[1], d[0], d[2]) for user_id, d in violations.items()],
+            )
+            cursor.executemany(
+                UPSERT_ROLLUP,
+                [
+                    (scope, scope_id, MINUTE, minute, total, hate)
+                    for (scope, scope_id, minute), (total, hate) in rollups.items()
+                ],
+            )
+            cursor.executemany(INSERT_SCANNED_VIOLATION_EVENT, events)
+            cursor.executemany(INSERT_OUTBOX, messages)
+            if source is not None:
+                cursor.execute(
+                    """
+                    INSERT OR REPLACE INTO scan_checkpoints (source, position, updated_at)
+                    VALUES (?, ?, ?)
+                    """,
+                    (source, position, now),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        # Known values of the counters just written are stale. Without a
+        # flush in flight they are the stored value plus the unflushed delta,
+        # or just the stored value, read on demand, when there is none.
+        with self._flush_lock, self._lock:
+            for group_id in stats:
+                dirty = self._dirty_stats.get(group_id)
+                if dirty is None:
+                    self._known_stats.pop(group_id, None)
+                else:
+                    stored = self._stored_stats(group_id)
+                    self._known_stats[group_id] = [
+                        stored[0] + dirty[0],
+                        stored[1] + dirty[1],
+                    ]
+            for user_id in violations:
+                dirty = self._dirty_violations.get(user_id)
+                if dirty is None:
+                    self._known_violations.pop(user_id, None)
+                else:
+                    self._known_violations[user_id] = (
+                        self._stored_violation_count(user_id) + dirty[0]
+                    )
+        for group_id, user_id, ts, _, scanned in events:
+            if scanned is None:
+                self.violation_windows.observe(group_id, user_id, ts)
+        return recorded
+
+    def get_checkpoint(self, source):
+        # Position reached by an earlier scan of source, or 0
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT position FROM scan_checkpoints WHERE source = ?", (source,)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _note_pending_update(self):
+        self._pending_updates += 1
+        if self._pending_updates >= self.flush_size:
+            self._flush_wanted.set()
+
+    @DB_SECONDS.time(method="flush")
+    def flush(self):
+        # Writes all pending deltas in one transaction. Known values already
+        # include them, so readers see the same numbers before and after.
+        with self._flush_lock:
+            with self._lock:
+                stats, self._dirty_stats = self._dirty_stats, {}
+                violations, self._dirty_violations = self._dirty_violations, {}
+                rollups, self._dirty_rollups = self._dirty_rollups, {}
+                events, self._dirty_events = self._dirty_events, []
+                self._pending_updates = 0
+            if not stats and not violations and not rollups and not events:
+                return
+
+            conn = self.conn
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    UPSERT_MESSAGE_STATS,
+                    [(group_id, d[0], d[1]) for group_id, d in stats.items()],
+                )
+                cursor.executemany(
+                    UPSERT_VIOLATIONS,
+                    [(user_id, d[1], d[0], d[2]) for user_id, d in violations.items()],
+                )
+                cursor.executemany(
+                    UPSERT_ROLLUP,
+                    [
+                        (scope, scope_id, MINUTE, minute, total, hate)
+                        for (scope, scope_id), buckets in rollups.items()
+                        for minute, (total, hate) in buckets.items()
+                    ],
+                )
+                cursor.executemany(INSERT_VIOLATION_EVENT, events)
+                conn.commit()
+            except Exception as e:
+                # Put the deltas back; the next flush retries them
+                logger.error(f"Error flushing pending writes: {e}")
+                conn.rollback()
+                with self._lock:
+                    self._merge_back(stats, violations, rollups)
+                    self._dirty_events[:0] = events
+                    self._pending_updates += len(events)
+                return
+
+            with self._lock:
+                # Counters with nothing left to flush match the table again
+                for group_id in stats:
+                    if group_id not in self._dirty_stats:
+                        self._known_stats.pop(group_id, None)
+                for user_id in violations:
+                    if user_id not in self._dirty_violations:
+                        self._known_violations.pop(user_id, None)
+
+    def _merge_back(self, stats, violations, rollups):
+        for group_id, (total, hate) in stats.items():
+            dirty = self._dirty_stats.setdefault(group_id, [0, 0])
+            dirty[0] += total
+            dirty[1] += hate
+        for user_id, (delta, username, date) in violations.items():
+            dirty = self._dirty_violations.setdefault(user_id, [0, username, date])
+            dirty[0] += delta
+        for scope, buckets in rollups.items():
+            merged = self._dirty_rollups.setdefault(scope, {})
+            for minute, (total, hate) in buckets.items():
+                bucket = merged.setdefault(minute, [0, 0])
+                bucket[0] += total
+                bucket[1] += hate
+        self._pending_updates += len(stats) + len(violations)
+
+    def _maintenance_loop(self):
+        # Write-behind flushes and scheduled rollup compaction
+        wait = self.flush_interval if self.write_behind else self.compact_interval
+        while not self._closed:
+            self._flush_wanted.wait(wait)
+            self._flush_wanted.clear()
+            if self.write_behind:
+                self.flush()
+            if self.compact_interval and time.monotonic() >= self._next_compaction:
+                self._next_compaction = time.monotonic() + self.compact_interval
+                self.compact_rollups()
+                self.compact_violations()
+                self.prune_verdicts()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._flusher is not None:
+            self._flush_wanted.set()
+            self._flusher.join()
+        self.flush()
+        self.pool.close_all()
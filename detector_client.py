@@ -0,0 +1,89 @@
+# detector_client.py
+import json
+import logging
+import socket
+import threading
+import config
+from detector_server import parse_address
+from hate_speech_model import exceeds_threshold
+
+logger = logging.getLogger(__name__)
+
+
+# Thin client for detector_server.py with the same interface as
+# HateSpeechDetector. Each thread lazily opens its own connection on first
+# use; the server batches requests from all of them.
+class RemoteDetector:
+    def __init__(self, address=None, timeout=None):
+        self.address = address or config.DETECTOR_SERVER_ADDRESS
+        self.timeout = timeout or config.DETECTOR_SERVER_TIMEOUT
+        self.threshold = config.HATE_SPEECH_THRESHOLD
+        self._local = threading.local()
+
+    def _connect(self):
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(target)
+        return sock, sock.makefile("rb")
+
+    def _request(self, payload):
+        data = json.dumps(payload).encode("utf-8") + b"\n"
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            try:
+                if conn is None:
+                    conn = self._connect()
+                    self._local.conn = conn
+                sock, reader = conn
+                sock.sendall(data)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("detector server closed the connection")
+                break
+            except OSError as e:
+                # Stale connection (e.g. server restarted): reconnect once
+                self._close_connection()
+                if attempt:
+                    raise
+                logger.info(f"Reconnecting to detector server: {e}")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Detector server error: {response['error']}")
+        return response
+
+    def _close_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            sock, reader = conn
+            reader.close()
+            sock.close()
+
+    def lookup(self, text):
+        # Caching happens server-side
+        return None
+
+    def score_many(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        return self._request({"op": "score", "texts": texts})["scores"]
+
+    def score_uncached(self, texts):
+        return self.score_many(texts)
+
+    def is_hate_speech(self, scores):
+        return exceeds_threshold(scores, self.threshold)
+
+    def detect(self, text):
+        return self.is_hate_speech(self.score_many([text])[0])
+
+    def detect_many(self, texts):
+        return [self.is_hate_speech(scores) for scores in self.score_many(texts)]
+
+    def stats(self):
+        return self._request({"op": "stats"})["stats"]
+
+    def close(self):
+        self._close_connection()
@@ -0,0 +1,118 @@
+# detector_server.py
+# Standalone detector service: loads the model once and serves batched
+# classify requests to every bot process over a Unix socket or localhost TCP.
+#
+#   python detector_server.py --address unix:/tmp/hate_speech_detector.sock
+#
+# Protocol: one JSON object per line in each direction.
+#   {"op": "score", "texts": [...]}  ->  {"scores": [{label: score}, ...]}
+#   {"op": "stats"}                  ->  {"stats": {...}}
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import config
+import metrics
+from batching import BatchingDetector
+from hate_speech_model import HateSpeechDetector
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address):
+    # "unix:/path/to.sock" -> (AF_UNIX, path); "host:port" -> (AF_INET, (host, port))
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class DetectorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        detector = self.server.detector
+        while True:
+            line = self.rfile.readline(config.DETECTOR_SERVER_MAX_REQUEST)
+            if not line:
+                return
+            if not line.endswith(b"\n"):
+                # Oversized (or cut off): the rest of it would be read as
+                # further requests, so answer once and drop the connection
+                logger.error(
+                    f"Detector request over {config.DETECTOR_SERVER_MAX_REQUEST} "
+                    f"bytes or not terminated; closing the connection"
+                )
+                self._reply({"error": "request too large or not terminated"})
+                return
+            try:
+                request = json.loads(line)
+                op = request.get("op")
+                if op == "score":
+                    # Concurrent connections share the server's batching queue
+                    response = {"scores": detector.score_many(request["texts"])}
+                elif op == "stats":
+                    response = {"stats": detector.stats()}
+                else:
+                    response = {"error": f"unknown op {op!r}"}
+            except Exception as e:
+                logger.error(f"Detector request failed: {e}")
+                response = {"error": str(e)}
+            self._reply(response)
+
+    def _reply(self, response):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, detector):
+    family, target = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            os.unlink(target)
+        server = ThreadingUnixServer(target, DetectorRequestHandler)
+    else:
+        server = ThreadingTCPServer(target, DetectorRequestHandler)
+    server.detector = detector
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared hate speech detector")
+    parser.add_argument(
+        "--address",
+        default=config.DETECTOR_SERVER_ADDRESS or "127.0.0.1:8765",
+        help='"unix:/path/to.sock" or "host:port"',
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve Prometheus metrics (tokenize/forward timings) on this port",
+    )
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    detector = BatchingDetector(HateSpeechDetector())
+    server = make_server(args.address, detector)
+    logger.info(f"Detector server listening on {args.address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        detector.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,174 @@
+# export_onnx.py
+# Exports unitary/toxic-bert to ONNX, quantizes it to int8 and checks score
+# parity of both graphs against the torch backend on a reference corpus.
+#
+#   python export_onnx.py --corpus reference.txt
+import argparse
+import json
+import logging
+import os
+import time
+import config
+from backends import ONNX_FILES, MAX_SEQUENCE_LENGTH, OnnxBackend, TorchBackend
+from hate_speech_model import exceeds_threshold
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CORPUS = [
+    "Hello everyone, the meeting starts at 10.",
+    "Thanks for sharing, this is really helpful!",
+    "You are an idiot and nobody wants you here.",
+    "I will find you and hurt you.",
+    "What a stupid idea, shut up.",
+    "Happy birthday! 🎉🎂",
+]
+
+
+def export(output_dir, opset=17):
+    import torch
+
+    backend = TorchBackend()
+    os.makedirs(output_dir, exist_ok=True)
+    backend.tokenizer.save_pretrained(output_dir)
+    backend.model_config.save_pretrained(output_dir)
+
+    sample = backend.tokenizer(
+        ["export sample", "a slightly longer export sample sentence"],
+        padding=True,
+        truncation=True,
+        max_length=MAX_SEQUENCE_LENGTH,
+        return_tensors="pt",
+    )
+    input_names = list(sample.keys())
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    path = os.path.join(output_dir, ONNX_FILES["onnx"])
+    with torch.no_grad():
+        torch.onnx.export(
+            backend.model,
+            tuple(sample[name] for name in input_names),
+            path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+    logger.info(f"Exported ONNX graph to {path}")
+    return backend
+
+
+def quantize(output_dir):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    source = os.path.join(output_dir, ONNX_FILES["onnx"])
+    target = os.path.join(output_dir, ONNX_FILES["onnx-int8"])
+    quantize_dynamic(source, target, weight_type=QuantType.QInt8)
+    logger.info(f"Wrote dynamically int8-quantized graph to {target}")
+
+
+def load_corpus(path):
+    if not path:
+        return list(DEFAULT_CORPUS)
+    texts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            # Accept plain text lines or JSONL rows with a "text" field
+            if line.startswith("{"):
+                line = json.loads(line).get("text", "")
+            if line:
+                texts.append(line)
+    return texts
+
+
+def score_corpus(backend, texts, batch_size):
+    scores = []
+    started = time.perf_counter()
+    for start in range(0, len(texts), batch_size):
+        scores.extend(backend.score_many(texts[start : start + batch_size]))
+    return scores, time.perf_counter() - started
+
+
+def parity_report(reference, candidate, threshold):
+    max_delta = 0.0
+    flipped = 0
+    for ref, cand in zip(reference, candidate):
+        for label, score in ref.items():
+            max_delta = max(max_delta, abs(score - cand.get(label, 0.0)))
+        if exceeds_threshold(ref, threshold) != exceeds_threshold(cand, threshold):
+            flipped += 1
+    return {"max_score_delta": max_delta, "flipped_verdicts": flipped}
+
+
+def check_parity(torch_backend, output_dir, texts, batch_size, threshold):
+    reference, torch_seconds = score_corpus(torch_backend, texts, batch_size)
+    report = {
+        "corpus_size": len(texts),
+        "threshold": threshold,
+        "torch": {"seconds": torch_seconds},
+    }
+    for variant in ONNX_FILES:
+        if not os.path.exists(os.path.join(output_dir, ONNX_FILES[variant])):
+            continue
+        backend = OnnxBackend(variant=variant, model_dir=output_dir)
+        candidate, seconds = score_corpus(backend, texts, batch_size)
+        report[variant] = parity_report(reference, candidate, threshold)
+        report[variant]["seconds"] = seconds
+        report[variant]["speedup"] = torch_seconds / seconds if seconds else 0.0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export toxic-bert to ONNX and check score parity"
+    )
+    parser.add_argument("--output-dir", default=config.ONNX_MODEL_DIR)
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument(
+        "--corpus", help="Reference texts (one per line, or JSONL with 'text')"
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threshold", type=float, default=config.HATE_SPEECH_THRESHOLD)
+    parser.add_argument("--skip-export", action="store_true")
+    parser.add_argument("--skip-quantize", action="store_true")
+    parser.add_argument(
+        "--max-flips",
+        type=int,
+        default=0,
+        help="Exit non-zero if any backend flips more verdicts than this",
+    )
+    args = parser.parse_args()
+
+    if args.skip_export:
+        torch_backend = TorchBackend()
+    else:
+        torch_backend = export(args.output_dir, args.opset)
+    if not args.skip_quantize:
+        quantize(args.output_dir)
+
+    report = check_parity(
+        torch_backend,
+        args.output_dir,
+        load_corpus(args.corpus),
+        args.batch_size,
+        args.threshold,
+    )
+    print(json.dumps(report, indent=2))
+
+    worst = max(
+        (
+            report[variant]["flipped_verdicts"]
+            for variant in ONNX_FILES
+            if variant in report
+        ),
+        default=0,
+    )
+    return 1 if worst > args.max_flips else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(main())
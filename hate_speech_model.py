@@ -1,24 +1,256 @@
 # hate_speech_model.py
-from transformers import pipeline
+from collections import Counter
+import logging
+import threading
 import config
+import metrics
+from backends import INFERENCE_SECONDS, MAX_SEQUENCE_LENGTH, load_backend
+from near_duplicate import NearDuplicateIndex
+from verdict_cache import VerdictCache, normalize_text
 
+logger = logging.getLogger(__name__)
 
-class HateSpeechDetector:
+# Labels whose score counts towards the hate speech verdict.
+HATE_LABELS = ("toxic", "hate")
+# Set in the scores of a long text whose remaining windows were skipped once
+# one crossed the threshold: they are lower bounds, and only the verdict at
+# the current threshold is known
+PARTIAL = "partial"
+
+SCORED_TEXTS = metrics.counter(
+    "hate_speech_scored_texts_total", "Texts scored, by source", ["source"]
+)
+
+
+def exceeds_threshold(scores, threshold):
+    # Here we assume labels like "toxic" indicate hate speech.
+    return any(scores.get(label, 0.0) > threshold for label in HATE_LABELS)
+
+
+def is_partial(scores):
+    return bool(scores.get(PARTIAL))
+
+
+def merge_max(scores, other):
+    return {label: max(score, other.get(label, 0.0)) for label, score in scores.items()}
+
+
+class CostProfile:
+    # Per-message token and window counts, to see where inference time goes
     def __init__(self):
-        # Initialize the classifier; this loads a relatively small, fast model.
-        self.classifier = pipeline(
-            "text-classification", model="unitary/toxic-bert", return_all_scores=True
-        )
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.tokens = 0
+        self.windows = 0
+        self.early_exits = 0
+        self.windows_per_message = Counter()
+        self.tokens_per_message = Counter()  # power-of-two buckets
+
+    def record(self, tokens, windows, early_exit=False):
+        logger.debug(f"Scored message: {tokens} tokens, {windows} windows")
+        with self._lock:
+            self.messages += 1
+            self.tokens += tokens
+            self.windows += windows
+            self.early_exits += 1 if early_exit else 0
+            self.windows_per_message[windows] += 1
+            self.tokens_per_message[1 << max(tokens - 1, 0).bit_length()] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "messages": self.messages,
+                "tokens": self.tokens,
+                "windows": self.windows,
+                "early_exits": self.early_exits,
+                "windows_per_message": dict(sorted(self.windows_per_message.items())),
+                "tokens_per_message": dict(sorted(self.tokens_per_message.items())),
+            }
+
+
+class HateSpeechDetector:
+    def __init__(self, backend=None):
+        # Initialize the classifier backend selected by config.MODEL_BACKEND
+        # (torch, onnx or onnx-int8); all serve unitary/toxic-bert scores.
+        self.backend = backend or load_backend()
         self.threshold = config.HATE_SPEECH_THRESHOLD
+        self.cache = None
+        if config.VERDICT_CACHE_SIZE > 0:
+            self.cache = VerdictCache(db_path=config.VERDICT_CACHE_DB or None)
+        # Raid variants that miss the exact cache reuse a recent verdict
+        self.near_duplicates = NearDuplicateIndex() if config.NEAR_DUP_ENABLED else None
+
+        # Long texts are split into overlapping windows of window_size tokens
+        # (special tokens included) instead of being truncated.
+        self.long_text_mode = config.LONG_TEXT_MODE
+        specials = self.backend.tokenizer.num_special_tokens_to_add(pair=False)
+        self.window_body = min(config.WINDOW_SIZE, MAX_SEQUENCE_LENGTH) - specials
+        self.window_step = max(1, self.window_body - config.WINDOW_OVERLAP)
+        self.window_batch = config.WINDOW_BATCH
+        self.max_batch = config.BATCH_MAX_SIZE
+        self.cost = CostProfile()
+
+    @INFERENCE_SECONDS.time(stage="tokenize")
+    def encode(self, text):
+        # Token ids without special tokens, as _score_batch() cuts windows
+        # from; BatchingDetector buckets by their length and passes them on
+        return self.backend.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def lookup(self, text):
+        # Cached scores for text (or a recent near-duplicate of it), or None
+        # if it has to go through the model.
+        if self.cache is not None:
+            scores = self.cache.get(text)
+            if scores is not None:
+                SCORED_TEXTS.inc(source="cache")
+                return scores
+        if self.near_duplicates is not None:
+            scores = self.near_duplicates.lookup(text)
+            if scores is not None:
+                SCORED_TEXTS.inc(source="near_duplicate")
+                return scores
+        return None
+
+    def score_uncached(self, texts, token_ids=None):
+        # One forward pass over the distinct (normalized) texts, returning a
+        # {label: score} dict per text. token_ids, from encode(), saves
+        # tokenizing the texts again.
+        keys = [normalize_text(text) for text in texts]
+        unique = {}
+        for i, key in enumerate(keys):
+            unique.setdefault(key, i)
+        if not unique:
+            return []
+        batch = [texts[i] for i in unique.values()]
+        if token_ids is not None:
+            token_ids = [token_ids[i] for i in unique.values()]
+        SCORED_TEXTS.inc(len(batch), source="model")
+        with INFERENCE_SECONDS.time(stage="batch"):
+            scored = self._score_batch(batch, token_ids)
+        if self.cache is not None:
+            # Partial scores would mislead under another threshold after a
+            # restart, so they are only kept in memory
+            self.cache.put_many(
+                batch, scored, persist=[not is_partial(s) for s in scored]
+            )
+        if self.near_duplicates is not None:
+            self.near_duplicates.add_many(
+                batch, scored, [self.is_hate_speech(scores) for scores in scored]
+            )
+        by_key = dict(zip(unique, scored))
+        return [by_key[key] for key in keys]
+
+    def _score_batch(self, texts, token_ids=None):
+        # Tokenize once; windows are cut from these ids.
+        if token_ids is None:
+            with INFERENCE_SECONDS.time(stage="tokenize"):
+                token_ids = self.backend.tokenizer(texts, add_special_tokens=False)[
+                    "input_ids"
+                ]
+        scored = [None] * len(texts)
+        single = [i for i, ids in enumerate(token_ids) if len(ids) <= self.window_body]
+        # Sorting by length lets each forward pass pad only to similar lengths
+        single.sort(key=lambda i: len(token_ids[i]))
+        for start in range(0, len(single), self.max_batch):
+            chunk = single[start : start + self.max_batch]
+            results = self.backend.score_ids([self._wrap(token_ids[i]) for i in chunk])
+            for i, scores in zip(chunk, results):
+                scored[i] = scores
+                self.cost.record(len(token_ids[i]), 1)
+        for i, ids in enumerate(token_ids):
+            if scored[i] is None:
+                scored[i] = self._score_long(ids)
+        return scored
+
+    def _wrap(self, ids):
+        return self.backend.tokenizer.build_inputs_with_special_tokens(ids)
+
+    def _windows(self, ids):
+        if not self.long_text_mode:
+            return [ids[: self.window_body]]
+        windows = []
+        for start in range(0, len(ids), self.window_step):
+            windows.append(ids[start : start + self.window_body])
+            if start + self.window_body >= len(ids):
+                break
+        return windows
+
+    def _score_long(self, ids):
+        # Windows run in small batches and stop as soon as one crosses the
+        # threshold; scores are the per-label max over the windows seen,
+        # marked PARTIAL if any were skipped.
+        windows = self._windows(ids)
+        merged = None
+        used = 0
+        for start in range(0, len(windows), self.window_batch):
+            chunk = windows[start : start + self.window_batch]
+            for scores in self.backend.score_ids([self._wrap(w) for w in chunk]):
+                merged = scores if merged is None else merge_max(merged, scores)
+            used += len(chunk)
+            if self.is_hate_speech(merged):
+                break
+        self.cost.record(len(ids), used, early_exit=used < len(windows))
+        if used < len(windows):
+            merged = {**merged, PARTIAL: True}
+        return merged
+
+    def stats(self):
+        return {
+            "verdict_cache": self.cache.stats() if self.cache else None,
+            "near_duplicates": (
+                self.near_duplicates.stats() if self.near_duplicates else None
+            ),
+            "cost": self.cost.stats(),
+        }
+
+    def score_many(self, texts):
+        results = [self.lookup(text) for text in texts]
+        misses = [text for text, scores in zip(texts, results) if scores is None]
+        fresh = iter(self.score_uncached(misses))
+        return [scores if scores is not None else next(fresh) for scores in results]
+
+    def is_hate_speech(self, scores):
+        return exceeds_threshold(scores, self.threshold)
 
     def detect(self, text):
-        results = self.classifier(text)
-        # The classifier returns a list (per sample) of dicts with 'label' and 'score'
-        for result in results[0]:
-            # Here we assume labels like "toxic" indicate hate speech.
-            if (
-                result["label"].lower() in ["toxic", "hate"]
-                and result["score"] > self.threshold
-            ):
-                return True
-        return False
+        return self.is_hate_speech(self.score_many([text])[0])
+
+    def detect_many(self, texts):
+        return [self.is_hate_speech(scores) for scores in self.score_many(texts)]
+
+
+# Builds the real detector on first use, so importing a bot does not load
+# the model.
+class LazyDetector:
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def stats(self):
+        if self._target is None:
+            return {"loaded": False}
+        return self._target.stats()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def load_detector():
+    # A client for the shared detector server when one is configured,
+    # otherwise an in-process batching detector loaded on first use.
+    if config.DETECTOR_SERVER_ADDRESS:
+        from detector_client import RemoteDetector
+
+        return RemoteDetector()
+
+    from batching import BatchingDetector
+
+    return LazyDetector(lambda: BatchingDetector(HateSpeechDetector()))
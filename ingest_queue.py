@@ -0,0 +1,268 @@
+# ingest_queue.py
+# Durable queue between the WhatsApp webhook and the detector. The webhook
+# commits each message to a local SQLite file and answers Twilio at once; a
+# pool of consumer threads leases pending messages in batches, runs them
+# through the detector and the database, then marks them done.
+#
+# Delivery is at least once: a batch leased by a consumer (or process) that
+# dies becomes visible again when its lease expires, and pending messages
+# are picked up after a restart. Processing is idempotent per message SID:
+# the SID is unique in the queue, so Twilio's retries are dropped at
+# enqueue, and verdicts are recorded with Database.record_new_verdicts, so a
+# replayed message is never counted twice. The alerts and replies a new
+# verdict calls for are written to an outbox table in the same transaction
+# and drained by a second queue, which completes each message only once it
+# has been delivered.
+from collections import Counter, namedtuple
+import json
+import logging
+import threading
+import time
+import config
+import metrics
+from database import ConnectionPool, create_queue_table
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+DEAD = "dead"
+
+INGEST_EVENTS = metrics.counter(
+    "hate_speech_ingest_events_total", "Ingest queue events", ["queue", "event"]
+)
+
+Job = namedtuple("Job", ["id", "key", "payload", "enqueued_at", "attempts"])
+
+
+# A leased queue in one SQLite table. The same class drains the outbox that
+# Database.record_new_verdicts fills (table="outbox" in the main database).
+class IngestQueue:
+    def __init__(
+        self, path=None, table="ingest_queue", lease_seconds=None, max_attempts=None
+    ):
+        self.path = path or config.INGEST_QUEUE_PATH
+        self.table = table
+        self.lease_seconds = lease_seconds or config.INGEST_LEASE_SECONDS
+        self.max_attempts = max_attempts or config.INGEST_MAX_ATTEMPTS
+        self.pool = ConnectionPool(self.path)
+        # Set on every enqueue so idle consumers in this process wake at once
+        self.available = threading.Event()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self.create_table()
+
+    @property
+    def conn(self):
+        return self.pool.connection()
+
+    def create_table(self):
+        cursor = self.conn.cursor()
+        create_queue_table(cursor, self.table)
+        self.conn.commit()
+
+    def _count(self, event, n=1):
+        with self._lock:
+            self.counters[event] += n
+        INGEST_EVENTS.inc(n, queue=self.table, event=event)
+
+    def enqueue(self, key, payload, now=None):
+        # Commits the message; False if key was queued (or done) before
+        conn = self.conn
+        cursor = conn.execute(
+            f"""
+            INSERT OR IGNORE INTO {self.table} (message_key, payload, enqueued_at)
+            VALUES (?, ?, ?)
+            """,
+            (key, json.dumps(payload), now or time.time()),
+        )
+        conn.commit()
+        if cursor.rowcount != 1:
+            self._count("duplicate")
+            return False
+        self._count("enqueued")
+        self.available.set()
+        return True
+
+    def claim(self, limit, now=None):
+        # Leases up to limit pending messages, oldest first. Messages that
+        # have used up their attempts are set aside as dead instead.
+        now = now or time.time()
+        conn = self.conn
+        try:
+            # Taking the write lock up front keeps two consumers from reading
+            # the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                f"""
+                SELECT id, message_key, payload, enqueued_at, attempts
+                FROM {self.table}
+                WHERE status = 'pending' AND lease_until <= ?
+                ORDER BY id LIMIT ?
+                """,
+                (now, limit),
+            ).fetchall()
+            dead = [row for row in rows if row[4] >= self.max_attempts]
+            jobs = [
+                Job(row[0], row[1], json.loads(row[2]), row[3], row[4] + 1)
+                for row in rows
+                if row[4] < self.max_attempts
+            ]
+            conn.executemany(
+                f"""
+                UPDATE {self.table} SET status = 'dead', finished_at = ?
+                WHERE id = ?
+                """,
+                [(now, row[0]) for row in dead],
+            )
+            conn.executemany(
+                f"""
+                UPDATE {self.table} SET lease_until = ?, attempts = attempts + 1
+                WHERE id = ?
+                """,
+                [(now + self.lease_seconds, job.id) for job in jobs],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        for row in dead:
+            logger.error(f"Giving up on message {row[1]} after {row[4]} attempts")
+        if dead:
+            self._count("dead", len(dead))
+        retried = sum(1 for job in jobs if job.attempts > 1)
+        if retried:
+            self._count("retried", retried)
+        return jobs
+
+    def complete(self, jobs, now=None):
+        conn = self.conn
+        conn.executemany(
+            f"""
+            UPDATE {self.table} SET status = 'done', finished_at = ?, payload = NULL
+            WHERE id = ? AND status = 'pending'
+            """,
+            [(now or time.time(), job.id) for job in jobs],
+        )
+        conn.commit()
+        self._count("completed", len(jobs))
+
+    def prune(self, now=None):
+        # Finished rows are kept for INGEST_QUEUE_RETENTION seconds, which is
+        # how long a repeated SID is still recognized
+        now = now or time.time()
+        conn = self.conn
+        cursor = conn.execute(
+            f"DELETE FROM {self.table} WHERE status != 'pending' AND finished_at < ?",
+            (now - config.INGEST_QUEUE_RETENTION,),
+        )
+        conn.commit()
+        return cursor.rowcount
+
+    def lag(self, now=None):
+        now = now or time.time()
+        pending, oldest, leased = self.conn.execute(
+            f"""
+            SELECT COUNT(*), MIN(enqueued_at), COALESCE(SUM(lease_until > ?), 0)
+            FROM {self.table} WHERE status = 'pending'
+            """,
+            (now,),
+        ).fetchone()
+        return {
+            "pending": pending,
+            "leased": leased,
+            "lag_seconds": now - oldest if oldest is not None else 0.0,
+        }
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {**self.lag(), **counters}
+
+    def close(self):
+        self.pool.close_all()
+
+
+# Threads that drain the queue in batches through handle(jobs). A batch that
+# fails is retried one message at a time, so one bad message cannot hold
+# back the rest; a message that keeps failing is retried when its lease
+# expires, up to INGEST_MAX_ATTEMPTS times. With complete=False handle()
+# only starts the work and completes the jobs itself once it is done.
+class IngestConsumers:
+    def __init__(
+        self,
+        queue,
+        handle,
+        workers=None,
+        batch_size=None,
+        poll_interval=None,
+        complete=True,
+        name="ingest-consumer",
+    ):
+        self.queue = queue
+        self.handle = handle
+        self.complete = complete
+        self.batch_size = batch_size or config.INGEST_BATCH_SIZE
+        self.poll_interval = poll_interval or config.INGEST_POLL_INTERVAL
+        self._stop = threading.Event()
+        self._next_prune = time.monotonic()
+        self._threads = [
+            threading.Thread(
+                target=self._run, args=(i,), name=f"{name}-{i}", daemon=True
+            )
+            for i in range(workers or config.INGEST_WORKERS)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _run(self, index):
+        while not self._stop.is_set():
+            # Cleared before claiming, so an enqueue in between is not missed
+            self.queue.available.clear()
+            try:
+                jobs = self.queue.claim(self.batch_size)
+            except Exception as e:
+                logger.error(f"Failed to claim queued messages: {e}")
+                jobs = []
+            if jobs:
+                self._process(jobs)
+            else:
+                self.queue.available.wait(self.poll_interval)
+            if index == 0 and time.monotonic() >= self._next_prune:
+                self._next_prune = time.monotonic() + config.INGEST_PRUNE_INTERVAL
+                try:
+                    self.queue.prune()
+                except Exception as e:
+                    logger.error(f"Failed to prune the ingest queue: {e}")
+
+    def _process(self, jobs):
+        try:
+            self.handle(jobs)
+        except Exception as e:
+            if len(jobs) > 1:
+                for job in jobs:
+                    self._process([job])
+                return
+            logger.error(f"Message {jobs[0].key} failed: {e}")
+            return
+        if self.complete:
+            self.queue.complete(jobs)
+
+    def drain(self, timeout=None):
+        # Waits until nothing is pending (or timeout seconds have passed)
+        deadline = time.monotonic() + (timeout or config.INGEST_LEASE_SECONDS)
+        while self.queue.lag()["pending"]:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=10.0):
+        # Finishes the batches in hand; anything else stays queued on disk
+        self._stop.set()
+        self.queue.available.set()
+        for thread in self._threads:
+            thread.join(timeout)
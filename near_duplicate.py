@@ -0,0 +1,259 @@
+# near_duplicate.py
+# Near-duplicate index over recently classified messages. Raid variants
+# (one character changed, emoji added, spacing shuffled) miss the exact
+# verdict cache but share most of their character 3-grams with the original,
+# so a MinHash signature finds the original and its verdict is reused
+# instead of running the model again.
+from collections import OrderedDict
+import logging
+import re
+import threading
+import time
+import numpy as np
+import config
+from prefilter import fold_text
+
+logger = logging.getLogger(__name__)
+
+SHINGLE_SIZE = 3
+# Spacing, punctuation and emoji carry no signal for raid variants
+_NON_WORD = re.compile(r"[\W_]+")
+_SHIFT = np.uint64(32)
+
+
+class MinHasher:
+    # num_perm multiply-shift hash functions over the set of character
+    # 3-grams of the folded text. Shingles use the built-in str hash, so
+    # signatures are only comparable within one process.
+    def __init__(self, num_perm, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) * np.uint64(
+            2
+        ) + np.uint64(1)
+        self._b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+    def signature(self, text, min_chars):
+        # uint32 signature, or None if the text is too short to compare
+        folded = _NON_WORD.sub("", fold_text(text or ""))
+        if len(folded) < max(min_chars, SHINGLE_SIZE):
+            return None
+        shingles = {
+            hash(folded[i : i + SHINGLE_SIZE])
+            for i in range(len(folded) - SHINGLE_SIZE + 1)
+        }
+        hashes = np.fromiter(shingles, dtype=np.int64, count=len(shingles))
+        products = np.multiply.outer(hashes.view(np.uint64), self._a)
+        products += self._b
+        return (products.min(axis=0) >> _SHIFT).astype(np.uint32)
+
+
+class _Entry:
+    __slots__ = ("signature", "scores", "is_hate", "created", "cluster")
+
+    def __init__(self, signature, scores, is_hate, created, cluster):
+        self.signature = signature
+        self.scores = scores
+        self.is_hate = is_hate
+        self.created = created
+        self.cluster = cluster
+
+
+class _Cluster:
+    __slots__ = ("size", "first_seen", "last_seen", "sample", "is_hate")
+
+    def __init__(self, sample, is_hate, now):
+        self.size = 1
+        self.first_seen = now
+        self.last_seen = now
+        self.sample = sample
+        self.is_hate = is_hate
+
+
+# Bounded, time-windowed MinHash index with LSH bands: signatures are split
+# into bands of rows hashes, and only entries sharing a whole band with the
+# query are compared. With 8 bands of 4 rows a pair at 0.8 similarity is
+# found with 98.5% probability (0.9: >99.9%) and one at 0.2 is almost never
+# compared. Memory is about 1.2 KB per entry with the default bands.
+class NearDuplicateIndex:
+    def __init__(
+        self,
+        min_similarity=None,
+        bands=None,
+        rows=None,
+        max_entries=None,
+        ttl_seconds=None,
+        reuse_clean=None,
+        raid_size=None,
+        max_clusters=None,
+    ):
+        self.min_similarity = min_similarity or config.NEAR_DUP_MIN_SIMILARITY
+        self.bands = bands or config.NEAR_DUP_BANDS
+        self.rows = rows or config.NEAR_DUP_ROWS
+        self.max_entries = max_entries or config.NEAR_DUP_MAX_ENTRIES
+        self.ttl = ttl_seconds if ttl_seconds is not None else config.NEAR_DUP_TTL
+        self.min_chars = config.NEAR_DUP_MIN_CHARS
+        # Reusing clean verdicts would let a slur slip into a known-clean
+        # message, so by default only hate verdicts are reused
+        self.reuse_clean = (
+            reuse_clean if reuse_clean is not None else config.NEAR_DUP_REUSE_CLEAN
+        )
+        self.raid_size = raid_size or config.NEAR_DUP_RAID_SIZE
+        self.max_clusters = max_clusters or config.NEAR_DUP_MAX_CLUSTERS
+
+        self.hasher = MinHasher(self.bands * self.rows)
+        # Each band's rows are mixed into one 64-bit bucket key
+        rng = np.random.default_rng(2)
+        self._row_mix = rng.integers(1, 2**63, self.rows, dtype=np.uint64)
+        self._band_salt = rng.integers(0, 2**63, self.bands, dtype=np.uint64)
+        self._entries = OrderedDict()  # id -> _Entry, oldest first
+        # band key -> entry id, or a list of ids once several share it
+        self._buckets = {}
+        self._clusters = OrderedDict()  # cluster id -> _Cluster, least recent first
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _band_keys(self, signature):
+        bands = signature.reshape(self.bands, self.rows).astype(np.uint64)
+        return ((bands * self._row_mix).sum(axis=1) + self._band_salt).tolist()
+
+    def lookup(self, text, now=None):
+        # Scores of a recent near-duplicate of text, or None
+        signature = self.hasher.signature(text, self.min_chars)
+        if signature is None:
+            return None
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for key in self._band_keys(signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    continue
+                if isinstance(bucket, list):
+                    candidates.update(bucket)
+                else:
+                    candidates.add(bucket)
+            best = None
+            best_similarity = self.min_similarity
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if now - entry.created > self.ttl:
+                    continue
+                similarity = np.count_nonzero(entry.signature == signature) / len(
+                    signature
+                )
+                if similarity >= best_similarity:
+                    best, best_similarity = entry, similarity
+            if best is None:
+                return None
+            self.hits += 1
+            # Matches are counted against the original message's cluster but
+            # not indexed themselves, so matching cannot drift away from the
+            # verdict that was actually computed
+            self._record_match(best.cluster, now)
+            return best.scores
+
+    def add(self, text, scores, is_hate, now=None):
+        if not (is_hate or self.reuse_clean):
+            return
+        signature = self.hasher.signature(text, self.min_chars)
+        if signature is None:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(signature, scores, is_hate, now, entry_id)
+            for key in self._band_keys(signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    self._buckets[key] = entry_id
+                elif isinstance(bucket, list):
+                    bucket.append(entry_id)
+                else:
+                    self._buckets[key] = [bucket, entry_id]
+            self._clusters[entry_id] = _Cluster(text[:80], is_hate, now)
+            self.inserts += 1
+            while len(self._entries) > self.max_entries:
+                self._remove_oldest()
+                self.evictions += 1
+            while len(self._clusters) > self.max_clusters:
+                self._clusters.popitem(last=False)
+
+    def add_many(self, texts, scored, verdicts):
+        for text, scores, is_hate in zip(texts, scored, verdicts):
+            self.add(text, scores, is_hate)
+
+    def _expire(self, now):
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if now - entry.created <= self.ttl:
+                return
+            self._remove_oldest()
+            self.expirations += 1
+
+    def _remove_oldest(self):
+        entry_id, entry = self._entries.popitem(last=False)
+        for key in self._band_keys(entry.signature):
+            bucket = self._buckets[key]
+            if isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+            else:
+                del self._buckets[key]
+
+    def _record_match(self, cluster_id, now):
+        cluster = self._clusters.get(cluster_id)
+        if cluster is None:
+            return
+        cluster.size += 1
+        cluster.last_seen = now
+        self._clusters.move_to_end(cluster_id)
+        if cluster.size == self.raid_size:
+            logger.warning(
+                f"Near-duplicate cluster {cluster_id}: {cluster.size} messages in "
+                f"{now - cluster.first_seen:.0f}s, e.g. {cluster.sample!r}"
+            )
+
+    def clusters(self, min_size=2, limit=10):
+        # Largest recent clusters of near-duplicate messages (likely raids)
+        with self._lock:
+            found = [
+                (cluster_id, cluster)
+                for cluster_id, cluster in self._clusters.items()
+                if cluster.size >= min_size
+            ]
+            found.sort(key=lambda item: item[1].size, reverse=True)
+            return [
+                {
+                    "cluster": cluster_id,
+                    "size": cluster.size,
+                    "duration_seconds": cluster.last_seen - cluster.first_seen,
+                    "is_hate": cluster.is_hate,
+                    "sample": cluster.sample,
+                }
+                for cluster_id, cluster in found[:limit]
+            ]
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "inserts": self.inserts,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+        stats["top_clusters"] = self.clusters(limit=5)
+        return stats
@@ -0,0 +1,301 @@
+# prefilter.py
+# Lexicon fast path that runs before the transformer. Trivial messages
+# (empty, emoji-only, exactly an allow-listed phrase or a deny-list term, and
+# optionally short with no lexicon hit) are decided here; everything else,
+# including longer messages that merely contain a deny term, falls through to
+# the model.
+#
+#   python prefilter.py report corpus.jsonl
+from collections import Counter, deque, namedtuple
+import argparse
+import json
+import logging
+import os
+import re
+import string
+import threading
+import time
+import config
+import metrics
+from verdict_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Every verdict carries the stage that produced it, e.g. "prefilter:emoji_only"
+# or "model", and the model's label scores when the model ran.
+Decision = namedtuple("Decision", ["is_hate", "stage", "scores"], defaults=(None,))
+
+MODEL_STAGE = "model"
+
+# Common character swaps used to dodge word filters ("1d10t", "$tupid")
+LEET_FOLD = str.maketrans("0134@5$789", "oieaasstbg")
+_MASKING = re.compile(r"(?<=\w)[*._\-]+(?=\w)")
+_WORD = re.compile(r"\w")
+
+
+def fold_text(text):
+    # Normalized, leet-folded text with in-word masking characters removed
+    return _MASKING.sub("", normalize_text(text).translate(LEET_FOLD))
+
+
+class AhoCorasick:
+    # Multi-pattern matcher: one pass over the text finds every occurrence of
+    # every pattern. Patterns are (string, payload) pairs.
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern, payload in patterns:
+            if pattern:
+                self._add(pattern, payload)
+        self._build()
+
+    def _add(self, pattern, payload):
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append((len(pattern), payload))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text):
+        # Yields (start, end, payload) for every match
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, payload in out[state]:
+                yield index + 1 - length, index + 1, payload
+
+
+class LexiconPrefilter:
+    def __init__(self, deny=(), allow=(), variants=(), short_max_words=None):
+        self.short_max_words = (
+            short_max_words
+            if short_max_words is not None
+            else config.PREFILTER_SHORT_MAX_WORDS
+        )
+        patterns = [(fold_text(term), "deny") for term in deny]
+        patterns += [(fold_text(term), "deny") for term in variants]
+        patterns += [(fold_text(phrase), "allow") for phrase in allow]
+        self.automaton = AhoCorasick(patterns)
+        self.stats = Counter()
+        # Handler threads share one prefilter
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path=None, **kwargs):
+        path = path or config.PREFILTER_LEXICON
+        if not os.path.exists(path):
+            # Without terms a "short and clean" shortcut would cost recall
+            logger.warning(f"Lexicon {path} not found; prefilter uses no terms")
+            kwargs["short_max_words"] = 0
+            return cls(**kwargs)
+        with open(path, encoding="utf-8") as f:
+            lexicon = json.load(f)
+        return cls(
+            deny=lexicon.get("deny", []),
+            allow=lexicon.get("allow", []),
+            variants=lexicon.get("variants", []),
+            **kwargs,
+        )
+
+    def check(self, text):
+        # Returns a Decision for trivial messages, or None if the model must run.
+        decision = self._check(text or "")
+        with self._stats_lock:
+            self.stats[decision.stage if decision else MODEL_STAGE] += 1
+        return decision
+
+    def _check(self, text):
+        if not text.strip():
+            return Decision(False, "prefilter:empty")
+        if not _WORD.search(text):
+            return Decision(False, "prefilter:emoji_only")
+
+        folded = fold_text(text)
+        core = folded.strip(string.punctuation + " ")
+        flagged = False
+        allow_hit = False
+        for start, end, kind in self.automaton.iter_matches(folded):
+            if kind == "allow":
+                allow_hit = allow_hit or folded[start:end] == core
+            elif folded[start:end] == core:
+                # The whole message is a deny term
+                return Decision(True, "prefilter:deny_term")
+            else:
+                # A deny term inside a longer message may be quoted, reclaimed
+                # or part of another word: only the model can tell
+                flagged = True
+
+        if flagged:
+            return None
+        if allow_hit:
+            return Decision(False, "prefilter:allow_phrase")
+        if len(folded.split()) <= self.short_max_words:
+            return Decision(False, "prefilter:short_clean")
+        return None
+
+    def stage_counts(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def shortcut_rate(self):
+        with self._stats_lock:
+            total = sum(self.stats.values())
+            return 1.0 - self.stats[MODEL_STAGE] / total if total else 0.0
+
+
+DECISIONS = metrics.counter(
+    "hate_speech_decisions_total", "Verdicts by deciding stage", ["stage", "verdict"]
+)
+CLASSIFY_SECONDS = metrics.histogram(
+    "hate_speech_classify_seconds", "Time to a verdict by deciding stage", ["stage"]
+)
+
+
+def model_decision(detector, scores):
+    return Decision(detector.is_hate_speech(scores), MODEL_STAGE, scores)
+
+
+def classify(text, detector, prefilter=None, cascade=None):
+    # Stage-tagged verdict for text, using the fast paths that are configured:
+    # the lexicon, then the cascade student, then the model
+    started = time.perf_counter()
+    decision = prefilter.check(text) if prefilter is not None else None
+    if decision is None and not text:
+        decision = Decision(False, "empty")
+    if decision is None and cascade is not None:
+        decision = cascade.check(text)
+    if decision is None:
+        decision = model_decision(detector, detector.score_many([text])[0])
+    CLASSIFY_SECONDS.observe(time.perf_counter() - started, stage=decision.stage)
+    DECISIONS.inc(stage=decision.stage, verdict="hate" if decision.is_hate else "clean")
+    return decision
+
+
+def classify_many(texts, detector, prefilter=None, cascade=None):
+    # Like classify() for several texts, with one detector call for the rest
+    started = time.perf_counter()
+    decisions = [None] * len(texts)
+    pending = []
+    for i, text in enumerate(texts):
+        decision = prefilter.check(text) if prefilter is not None else None
+        if decision is None and not text:
+            decision = Decision(False, "empty")
+        if decision is None and cascade is not None:
+            decision = cascade.check(text)
+        if decision is None:
+            pending.append(i)
+        else:
+            decisions[i] = decision
+    if pending:
+        scored = detector.score_many([texts[i] for i in pending])
+        for i, scores in zip(pending, scored):
+            decisions[i] = model_decision(detector, scores)
+    # Per text, so the histogram stays comparable with classify()
+    elapsed = (time.perf_counter() - started) / max(1, len(texts))
+    for decision in decisions:
+        CLASSIFY_SECONDS.observe(elapsed, stage=decision.stage)
+        DECISIONS.inc(
+            stage=decision.stage, verdict="hate" if decision.is_hate else "clean"
+        )
+    return decisions
+
+
+def agreement_report(prefilter, texts, model_verdicts):
+    # Compares fast-path decisions with model verdicts for the same texts.
+    # Misses (fast path said clean, model said hate) are lost recall.
+    per_stage = {}
+    for text, model_is_hate in zip(texts, model_verdicts):
+        decision = prefilter.check(text)
+        if decision is None:
+            continue
+        row = per_stage.setdefault(
+            decision.stage, {"decided": 0, "agree": 0, "missed_hate": 0}
+        )
+        row["decided"] += 1
+        row["agree"] += decision.is_hate == model_is_hate
+        row["missed_hate"] += model_is_hate and not decision.is_hate
+
+    total = len(texts)
+    decided = sum(row["decided"] for row in per_stage.values())
+    agree = sum(row["agree"] for row in per_stage.values())
+    model_hate = sum(1 for verdict in model_verdicts if verdict)
+    missed = sum(row["missed_hate"] for row in per_stage.values())
+    return {
+        "messages": total,
+        "shortcut_rate": decided / total if total else 0.0,
+        "agreement": agree / decided if decided else 1.0,
+        "recall_loss": missed / model_hate if model_hate else 0.0,
+        "stages": per_stage,
+    }
+
+
+def _read_corpus(path):
+    texts, verdicts = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line) if line.startswith("{") else {"text": line}
+            texts.append(row.get("text", ""))
+            verdicts.append(row.get("is_hate"))
+    return texts, verdicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lexicon prefilter tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report = sub.add_parser(
+        "report", help="Measure how often the fast path agrees with the model"
+    )
+    report.add_argument(
+        "corpus", help="Text lines, or JSONL with 'text' and optional 'is_hate'"
+    )
+    report.add_argument("--lexicon", default=config.PREFILTER_LEXICON)
+    report.add_argument("--short-max-words", type=int)
+    args = parser.parse_args()
+
+    prefilter = LexiconPrefilter.from_file(
+        args.lexicon, short_max_words=args.short_max_words
+    )
+    texts, verdicts = _read_corpus(args.corpus)
+    if any(verdict is None for verdict in verdicts):
+        # Only label the rows that lack a stored verdict
+        from hate_speech_model import HateSpeechDetector
+
+        detector = HateSpeechDetector()
+        missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        for start in range(0, len(missing), config.BATCH_MAX_SIZE):
+            chunk = missing[start : start + config.BATCH_MAX_SIZE]
+            for i, verdict in zip(
+                chunk, detector.detect_many([texts[i] for i in chunk])
+            ):
+                verdicts[i] = verdict
+    print(json.dumps(agreement_report(prefilter, texts, verdicts), indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
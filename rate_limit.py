@@ -0,0 +1,196 @@
+# rate_limit.py
+from array import array
+from collections import Counter, namedtuple
+import threading
+import time
+import config
+import metrics
+
+
+class TokenBucket:
+    # Classic token bucket: holds up to capacity tokens, refilled at rate per
+    # second. Not thread-safe; callers guard it with their own lock.
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity=None, now=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def available(self, now=None, tokens=1.0):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= tokens
+
+    def try_acquire(self, now=None, tokens=1.0):
+        if self.available(now, tokens):
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, now=None, tokens=1.0):
+        # Seconds until tokens will be available
+        self._refill(time.monotonic() if now is None else now)
+        missing = tokens - self.tokens
+        return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
+
+    def is_full(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.capacity
+
+
+class BucketTable:
+    # Token buckets for many keys in fixed-size arrays: a key hashes to a set
+    # of `ways` slots, and a new key takes the least recently used slot of its
+    # set. Evicting an idle key loses nothing (a refilled bucket is the same
+    # as a new one), so memory stays at about 24 bytes per slot however many
+    # distinct keys are seen. Not thread-safe.
+    def __init__(self, rate, capacity, slots, ways=4):
+        self.rate = rate
+        self.capacity = capacity
+        self.ways = ways
+        self.sets = max(1, slots // ways)
+        size = self.sets * ways
+        self._keys = array("Q", bytes(8 * size))  # 0 marks a free slot
+        self._tokens = array("f", bytes(4 * size))
+        self._updated = array("d", bytes(8 * size))
+        self._excess = array("I", bytes(4 * size))
+        self.evictions = 0
+        self.active_evictions = 0
+
+    def _slot(self, key, now):
+        fingerprint = (hash(key) & 0xFFFFFFFFFFFFFFFF) | 1
+        start = (fingerprint >> 1) % self.sets * self.ways
+        keys, updated = self._keys, self._updated
+        slot = start
+        for candidate in range(start, start + self.ways):
+            if keys[candidate] == fingerprint:
+                return candidate
+            if updated[candidate] < updated[slot]:
+                slot = candidate
+        if keys[slot]:
+            self.evictions += 1
+            if self._refilled(slot, now) < self.capacity:
+                self.active_evictions += 1
+        keys[slot] = fingerprint
+        self._tokens[slot] = self.capacity
+        updated[slot] = now
+        self._excess[slot] = 0
+        return slot
+
+    def _refilled(self, slot, now):
+        elapsed = max(0.0, now - self._updated[slot])
+        return min(self.capacity, self._tokens[slot] + elapsed * self.rate)
+
+    def acquire(self, key, now):
+        # Takes a token for key. Returns 0 if one was available, otherwise the
+        # number of messages over the limit since the bucket was last full.
+        slot = self._slot(key, now)
+        tokens = self._refilled(slot, now)
+        self._updated[slot] = now
+        if tokens >= self.capacity:
+            self._excess[slot] = 0
+        if tokens >= 1.0:
+            self._tokens[slot] = tokens - 1.0
+            return 0
+        self._tokens[slot] = tokens
+        self._excess[slot] += 1
+        return self._excess[slot]
+
+    def __len__(self):
+        return len(self._keys) - self._keys.count(0)
+
+    def nbytes(self):
+        return sum(
+            len(values) * values.itemsize
+            for values in (self._keys, self._tokens, self._updated, self._excess)
+        )
+
+
+FLOOD_ALLOW = "allow"
+FLOOD_SAMPLE = "sample"
+FLOOD_DEFER = "defer"
+
+FloodDecision = namedtuple("FloodDecision", ["action", "penalize"])
+
+FLOOD_DECISIONS = metrics.counter(
+    "hate_speech_flood_decisions_total",
+    "Flood control decisions ahead of the detector",
+    ["action"],
+)
+
+
+# Flood control ahead of the detector, with one bucket per (group, sender) and
+# one per group. Messages within both limits are allowed. Of the messages over
+# a limit, every sample_every-th is classified right away (sample) and the
+# rest are deferred for batch classification, so every message is still
+# checked. A sender whose excess reaches penalty_excess is flagged once for a
+# flood penalty.
+class FloodLimiter:
+    def __init__(
+        self,
+        user_rate=None,
+        user_burst=None,
+        group_rate=None,
+        group_burst=None,
+        sample_every=None,
+        penalty_excess=None,
+        slots=None,
+    ):
+        slots = slots or config.FLOOD_MAX_KEYS
+        self.users = BucketTable(
+            user_rate or config.FLOOD_USER_RATE,
+            user_burst or config.FLOOD_USER_BURST,
+            slots,
+        )
+        self.groups = BucketTable(
+            group_rate or config.FLOOD_GROUP_RATE,
+            group_burst or config.FLOOD_GROUP_BURST,
+            max(64, slots // 16),
+        )
+        self.sample_every = max(1, sample_every or config.FLOOD_SAMPLE_EVERY)
+        self.penalty_excess = (
+            penalty_excess
+            if penalty_excess is not None
+            else config.FLOOD_PENALTY_EXCESS
+        )
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def check(self, group_id, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            excess = self.users.acquire((group_id, user_id), now)
+            penalize = bool(self.penalty_excess) and excess == self.penalty_excess
+            if not excess:
+                # Only messages within the sender's own limit count for the group
+                excess = self.groups.acquire(group_id, now)
+            if not excess:
+                action = FLOOD_ALLOW
+            elif excess % self.sample_every == 0:
+                action = FLOOD_SAMPLE
+            else:
+                action = FLOOD_DEFER
+            self.counters[action] += 1
+            self.counters["penalties"] += penalize
+        FLOOD_DECISIONS.inc(action=action)
+        return FloodDecision(action, penalize)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.counters,
+                "tracked_senders": len(self.users),
+                "tracked_groups": len(self.groups),
+                "evictions": self.users.evictions + self.groups.evictions,
+                "active_evictions": self.users.active_evictions
+                + self.groups.active_evictions,
+                "bytes": self.users.nbytes() + self.groups.nbytes(),
+            }
@@ -0,0 +1,468 @@
+# score_log.py
+# Append-only log of every classification's label scores, so threshold
+# changes can be evaluated without running the model again. Rows are fixed
+# width (timestamp, group and message ids, stage flags, one float16 per
+# label) after a small JSON header, and reports memory-map the file and scan
+# it with NumPy. Float16 keeps about three significant digits, so a score
+# within ~0.0005 of a threshold may be judged differently than it was live.
+#
+#   python score_log.py sweep --thresholds 0.5,0.6,0.7,0.8
+#   python score_log.py what-if --threshold 0.6
+#   python score_log.py pr labels.jsonl
+from hashlib import blake2b
+import argparse
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+import config
+from hate_speech_model import HATE_LABELS, PARTIAL
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HSSCORE1"
+HEADER_SIZE = 4096
+
+# Stage flags; model rows have scores, rows decided without the model (lexicon
+# prefilter or cascade student) have NaN
+FLAG_PREFILTER = 1
+FLAG_PREFILTER_HATE = 2
+# Model scores of a long text cut short at the live threshold (lower bounds);
+# reports leave these rows out unless asked to include them
+FLAG_PARTIAL = 4
+
+DEFAULT_THRESHOLDS = tuple(round(0.05 * i, 2) for i in range(6, 20))
+
+
+def row_dtype(labels):
+    return np.dtype(
+        [
+            ("ts", "<u4"),
+            ("group", "<i8"),
+            ("message", "<i8"),
+            ("flags", "u1"),
+            ("scores", "<f2", (len(labels),)),
+        ]
+    )
+
+
+def int_id(value):
+    # Telegram ids are integers; other ids (WhatsApp MessageSids, "whatsapp")
+    # are stored as a stable 63-bit hash of the string.
+    try:
+        number = int(value)
+        if -(1 << 63) <= number < (1 << 63):
+            return number
+    except (TypeError, ValueError):
+        pass
+    digest = blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") >> 1
+
+
+def _names_path(path):
+    return path + ".names"
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        raise ValueError(f"{path} is not a score log")
+    return json.loads(header[len(MAGIC) :].decode("utf-8"))
+
+
+def _write_header(path, labels):
+    # O_EXCL: when two processes start together, one creates the file and
+    # the other reads its header
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+    body = MAGIC + json.dumps({"labels": labels, "created": time.time()}).encode()
+    if len(body) > HEADER_SIZE:
+        raise ValueError("Too many labels for the score log header")
+    with os.fdopen(fd, "wb") as f:
+        f.write(body.ljust(HEADER_SIZE, b" "))
+
+
+class ScoreLog:
+    # Buffers rows and appends them in blocks. Every write is a whole number
+    # of rows to a file opened with O_APPEND under a shared flock, so several
+    # processes can share one log. A background thread flushes every
+    # flush_interval seconds, so unflushed rows (at most flush_size, or
+    # flush_interval seconds' worth) are lost only on a crash. The label
+    # columns come from the header, or from labels (SCORE_LOG_LABELS) for a
+    # new file.
+    def __init__(self, path=None, flush_size=None, flush_interval=None, labels=None):
+        self.path = path or config.SCORE_LOG_PATH
+        self.flush_size = flush_size or config.SCORE_LOG_FLUSH_SIZE
+        self.flush_interval = (
+            flush_interval
+            if flush_interval is not None
+            else config.SCORE_LOG_FLUSH_INTERVAL
+        )
+        self._pending = 0
+        self._names = set()
+        self._unknown = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self.rows = 0
+        self.dropped = 0  # rows lost to failed writes
+        if os.path.exists(self.path):
+            self._set_labels(read_header(self.path)["labels"])
+            self._repair()
+        else:
+            _write_header(self.path, list(labels or config.SCORE_LOG_LABELS))
+            self._set_labels(read_header(self.path)["labels"])
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="score-log-flush", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _repair(self):
+        # A torn row from a crash would misalign every row after it. Writers
+        # hold a shared lock while appending, so under the exclusive lock the
+        # tail is not a write in progress.
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            torn = (size - HEADER_SIZE) % self.dtype.itemsize
+            if torn:
+                logger.warning(f"Dropping a torn row at the end of {self.path}")
+                os.ftruncate(fd, size - torn)
+        finally:
+            os.close(fd)
+
+    def _set_labels(self, labels):
+        self.labels = list(labels)
+        self.dtype = row_dtype(self.labels)
+        self._buffer = np.zeros(self.flush_size, dtype=self.dtype)
+
+    def append(self, group_id, message_id, decision, timestamp=None):
+        self.append_many([(group_id, message_id, decision, timestamp)])
+
+    def append_many(self, rows):
+        # rows: (group_id, message_id, Decision, timestamp or None)
+        with self._lock:
+            for group_id, message_id, decision, timestamp in rows:
+                self._add(group_id, message_id, decision, timestamp)
+
+    def _add(self, group_id, message_id, decision, timestamp):
+        row = self._buffer[self._pending]
+        row["ts"] = int(timestamp if timestamp is not None else time.time())
+        row["group"] = int_id(group_id)
+        row["message"] = int_id(message_id)
+        if decision.scores is None:
+            row["flags"] = FLAG_PREFILTER | (FLAG_PREFILTER_HATE * decision.is_hate)
+            row["scores"] = np.nan
+        else:
+            row["flags"] = FLAG_PARTIAL if decision.scores.get(PARTIAL) else 0
+            row["scores"] = [decision.scores.get(label, 0.0) for label in self.labels]
+            unknown = (
+                decision.scores.keys() - set(self.labels) - {PARTIAL} - self._unknown
+            )
+            if unknown:
+                self._unknown |= unknown
+                logger.error(
+                    f"Score log {self.path} has no column for labels "
+                    f"{sorted(unknown)}; their scores are not logged"
+                )
+        if group_id not in self._names and str(row["group"]) != str(group_id):
+            self._remember_name(group_id, int(row["group"]))
+        self._pending += 1
+        if self._pending == self.flush_size:
+            self._flush()
+
+    def _remember_name(self, name, number):
+        # Reports show hashed group ids under their original names
+        self._names.add(name)
+        with open(_names_path(self.path), "a", encoding="utf-8") as f:
+            f.write(f"{number}\t{name}\n")
+
+    def _flush(self):
+        # The buffer is emptied whether or not the write succeeds: the log is
+        # analytics, and a full disk must not make every later append fail
+        if not self._pending:
+            return
+        data = memoryview(self._buffer[: self._pending].tobytes())
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                while data:
+                    data = data[os.write(fd, data) :]
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.dropped += self._pending
+            logger.error(
+                f"Failed to write {self._pending} rows to score log {self.path}: {e}"
+            )
+        else:
+            self.rows += self._pending
+        self._pending = 0
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+
+def load(path=None):
+    # (labels, rows) with rows a read-only memmap; a torn last row from a
+    # crash is ignored
+    path = path or config.SCORE_LOG_PATH
+    labels = read_header(path)["labels"]
+    dtype = row_dtype(labels)
+    count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if count <= 0:
+        return labels, np.zeros(0, dtype=dtype)
+    rows = np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+    return labels, rows
+
+
+def load_names(path=None):
+    names = {}
+    names_path = _names_path(path or config.SCORE_LOG_PATH)
+    if os.path.exists(names_path):
+        with open(names_path, encoding="utf-8") as f:
+            for line in f:
+                number, _, name = line.rstrip("\n").partition("\t")
+                names[int(number)] = name
+    return names
+
+
+def decisive_scores(labels, rows):
+    # The score compared with the threshold (max over HATE_LABELS), as float32;
+    # NaN for prefilter rows
+    columns = [i for i, label in enumerate(labels) if label in HATE_LABELS]
+    scores = rows["scores"]
+    if not columns:
+        return np.full(len(rows), np.nan, dtype=np.float32)
+    return scores[:, columns].astype(np.float32).max(axis=1)
+
+
+def flagged_at(decisive, flags, threshold):
+    # Verdicts at threshold: model rows by score, prefilter rows as decided
+    prefilter_hate = (flags & FLAG_PREFILTER_HATE) != 0
+    return np.where(np.isnan(decisive), prefilter_hate, decisive > threshold)
+
+
+def sweep(labels, rows, thresholds):
+    decisive = decisive_scores(labels, rows)
+    model = ~np.isnan(decisive)
+    ordered = np.sort(decisive[model])
+    prefilter_hate = int(np.count_nonzero(rows["flags"] & FLAG_PREFILTER_HATE))
+    total = len(rows)
+    result = []
+    for threshold in thresholds:
+        # Float16 scores are compared as stored, like flagged_at()
+        above = len(ordered) - int(np.searchsorted(ordered, threshold, side="right"))
+        flagged = above + prefilter_hate
+        result.append(
+            {
+                "threshold": threshold,
+                "flagged": flagged,
+                "flagged_by_model": above,
+                "rate": flagged / total if total else 0.0,
+            }
+        )
+    return {
+        "messages": total,
+        "model_scored": int(np.count_nonzero(model)),
+        "prefilter_hate": prefilter_hate,
+        "thresholds": result,
+    }
+
+
+def what_if(labels, rows, threshold, current=None, top=20, names=None):
+    # Per-group flagged counts at the current and the proposed threshold,
+    # largest changes first
+    current = config.HATE_SPEECH_THRESHOLD if current is None else current
+    names = names or {}
+    decisive = decisive_scores(labels, rows)
+    groups, inverse = np.unique(np.asarray(rows["group"]), return_inverse=True)
+    totals = np.bincount(inverse, minlength=len(groups))
+    before = np.bincount(
+        inverse,
+        weights=flagged_at(decisive, rows["flags"], current),
+        minlength=len(groups),
+    ).astype(np.int64)
+    after = np.bincount(
+        inverse,
+        weights=flagged_at(decisive, rows["flags"], threshold),
+        minlength=len(groups),
+    ).astype(np.int64)
+    change = after - before
+    order = np.argsort(-np.abs(change), kind="stable")[:top]
+    return {
+        "current_threshold": current,
+        "threshold": threshold,
+        "messages": int(totals.sum()),
+        "flagged_current": int(before.sum()),
+        "flagged": int(after.sum()),
+        "groups": [
+            {
+                "group": names.get(int(groups[i]), int(groups[i])),
+                "messages": int(totals[i]),
+                "flagged_current": int(before[i]),
+                "flagged": int(after[i]),
+                "change": int(change[i]),
+            }
+            for i in order
+        ],
+    }
+
+
+def read_labels(path):
+    # JSONL or CSV with group_id, message_id and is_hate (true/false/1/0)
+    import csv
+
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            records = list(csv.DictReader(f))
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+    labels = {}
+    for record in records:
+        value = str(record["is_hate"]).strip().lower()
+        key = (int_id(record["group_id"]), int_id(record["message_id"]))
+        labels[key] = value in ("1", "true", "yes")
+    return labels
+
+
+def precision_recall(labels, rows, truth, thresholds):
+    # Only rows with a human label count; the last row logged for a message
+    # wins if it was classified more than once
+    messages = np.fromiter((key[1] for key in truth), dtype=np.int64, count=len(truth))
+    candidates = np.flatnonzero(np.isin(rows["message"], messages))
+    matched = {}
+    for index in candidates.tolist():
+        key = (int(rows["group"][index]), int(rows["message"][index]))
+        if key in truth:
+            matched[key] = index
+    indices = np.fromiter(matched.values(), dtype=np.int64, count=len(matched))
+    actual = np.fromiter(
+        (truth[key] for key in matched), dtype=bool, count=len(matched)
+    )
+    subset = rows[indices]
+    decisive = decisive_scores(labels, subset)
+
+    table = []
+    for threshold in thresholds:
+        predicted = flagged_at(decisive, subset["flags"], threshold)
+        tp = int(np.count_nonzero(predicted & actual))
+        fp = int(np.count_nonzero(predicted & ~actual))
+        fn = int(np.count_nonzero(~predicted & actual))
+        precision = tp / (tp + fp) if tp + fp else 1.0
+        recall = tp / (tp + fn) if tp + fn else 1.0
+        f1 = (
+            2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        )
+        table.append(
+            {
+                "threshold": threshold,
+                "tp": tp,
+                "fp": fp,
+                "fn": fn,
+                "precision": precision,
+                "recall": recall,
+                "f1": f1,
+            }
+        )
+    return {
+        "labeled": len(truth),
+        "matched": len(matched),
+        "positives": int(np.count_nonzero(actual)),
+        "thresholds": table,
+    }
+
+
+def _select(rows, since, include_partial=False):
+    # (rows, number of partial rows left out)
+    if since:
+        from database import parse_window
+
+        cutoff = int(time.time()) - parse_window(since)
+        rows = rows[np.asarray(rows["ts"]) >= cutoff]
+    if include_partial:
+        return rows, 0
+    complete = (np.asarray(rows["flags"]) & FLAG_PARTIAL) == 0
+    return rows[complete], int(len(rows) - np.count_nonzero(complete))
+
+
+def _thresholds(value):
+    if not value:
+        return list(DEFAULT_THRESHOLDS)
+    return [float(part) for part in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score log reports")
+    parser.add_argument("--log", default=config.SCORE_LOG_PATH)
+    parser.add_argument("--since", help="Only rows from the last window, e.g. 7d")
+    parser.add_argument(
+        "--include-partial",
+        action="store_true",
+        help="Also use long texts scored only up to the live threshold",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sweep_parser = sub.add_parser("sweep", help="Flagged messages per threshold")
+    sweep_parser.add_argument("--thresholds", help="Comma-separated thresholds")
+
+    what_if_parser = sub.add_parser(
+        "what-if", help="Per-group change for a proposed threshold"
+    )
+    what_if_parser.add_argument("--threshold", type=float, required=True)
+    what_if_parser.add_argument(
+        "--current", type=float, help="Default: HATE_SPEECH_THRESHOLD"
+    )
+    what_if_parser.add_argument("--top", type=int, default=20)
+
+    pr_parser = sub.add_parser("pr", help="Precision and recall against labels")
+    pr_parser.add_argument(
+        "labels", help="JSONL or CSV with group_id, message_id, is_hate"
+    )
+    pr_parser.add_argument("--thresholds", help="Comma-separated thresholds")
+
+    args = parser.parse_args()
+    started = time.perf_counter()
+    labels, rows = load(args.log)
+    rows, partial = _select(rows, args.since, args.include_partial)
+    if args.command == "sweep":
+        report = sweep(labels, rows, _thresholds(args.thresholds))
+    elif args.command == "what-if":
+        report = what_if(
+            labels,
+            rows,
+            args.threshold,
+            current=args.current,
+            top=args.top,
+            names=load_names(args.log),
+        )
+    else:
+        report = precision_recall(
+            labels, rows, read_labels(args.labels), _thresholds(args.thresholds)
+        )
+    report["partial_excluded"] = partial
+    report["scan_seconds"] = time.perf_counter() - started
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -9,9 +9,17 @@ from telegram.ext import (
 )
 from datetime import datetime, timedelta
 import logging
+import threading
 import config
-from database import Database
-from hate_speech_model import HateSpeechDetector
+import metrics
+from database import SCOPE_GROUP, SCOPE_USER, Database, parse_window
+from hate_speech_model import load_detector
+from cascade import load_cascade
+from prefilter import LexiconPrefilter, classify, classify_many
+from action_scheduler import ModerationScheduler
+from rate_limit import FLOOD_DEFER, FloodLimiter
+from score_log import ScoreLog
+from violation_windows import PENALTY_BAN, PENALTY_RESTRICT, penalty_for
 
 # Setup logging
 logging.basicConfig(
@@ -21,7 +29,31 @@ logger = logging.getLogger(__name__)
 
 
 db = Database()
-detector = HateSpeechDetector()
+# Concurrent handlers share one batching queue in front of the model (or the
+# shared detector server); nothing is loaded until the first message.
+detector = load_detector()
+prefilter = LexiconPrefilter.from_file() if config.PREFILTER_ENABLED else None
+# Confident student verdicts skip the model
+cascade = load_cascade() if config.CASCADE_ENABLED else None
+# Moderation actions are queued and sent within Telegram's rate limits
+scheduler = ModerationScheduler()
+# Flooding senders are throttled before the detector; their excess messages
+# wait here (group_id -> [(message_id, user_id, username, text)]) and are
+# classified in batches
+flood = FloodLimiter() if config.FLOOD_ENABLED else None
+deferred = {}
+deferred_lock = threading.Lock()
+# Label scores of every verdict, for re-thresholding offline
+score_log = ScoreLog() if config.SCORE_LOG_PATH else None
+
+HANDLER_SECONDS = metrics.histogram(
+    "hate_speech_handler_seconds", "End-to-end message handling time", ["handler"]
+)
+metrics.gauge(
+    "hate_speech_telegram_action_queue_depth",
+    "Moderation actions waiting to be sent",
+    function=lambda: scheduler.stats()["queue_depth"],
+)
 
 
 def start(update: Update, context: CallbackContext):
@@ -32,17 +64,36 @@ def stats(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
     group_id = str(update.message.chat_id)
 
+    # Optional window argument, e.g. /stats 7d (default: last 24 hours)
+    window = context.args[0] if context.args else "24h"
+    try:
+        seconds = parse_window(window)
+    except ValueError:
+        update.message.reply_text("Usage: /stats [window], e.g. /stats 1h or /stats 7d")
+        return
+
     # Get user violations
     user_violations = db.get_violation_count(user_id)
+    recent_violations = db.get_recent_violations(group_id, user_id)
 
     # Get group stats
     total_msgs, hate_msgs = db.get_stats(group_id)
 
+    # Windowed totals from the rollup tables
+    window_msgs, window_hate = db.get_window_stats(SCOPE_GROUP, group_id, seconds)
+    user_msgs, user_hate = db.get_window_stats(SCOPE_USER, user_id, seconds)
+    rate = window_hate / window_msgs * 100 if window_msgs else 0.0
+
     stats_message = (
         f"📊 Group Statistics:\n"
         f"Total Messages: {total_msgs}\n"
         f"Hate Speech Messages: {hate_msgs}\n"
-        f"Your Violations: {user_violations}"
+        f"Your Violations: {user_violations} "
+        f"({recent_violations} here in the last {config.VIOLATION_WINDOW // 3600}h)\n\n"
+        f"🕒 Last {window}:\n"
+        f"Messages: {window_msgs}\n"
+        f"Hate Speech Messages: {window_hate} ({rate:.1f}%)\n"
+        f"Your Messages: {user_msgs} ({user_hate} flagged)"
     )
     update.message.reply_text(stats_message)
 
@@ -184,30 +235,25 @@ def remove_admin(update: Update, context: CallbackContext):
 def list_admins(update: Update, context: CallbackContext):
     try:
         group_id = str(update.message.chat_id)
-        admins = db.get_group_admins(group_id)
+        # One query for ids and usernames, Telegram lookups resolved in a batch
+        entries = db.admins.get(group_id)
 
-        if not admins:
+        if not entries:
             update.message.reply_text("📋 No registered admins found for this group.")
             return
 
-        admin_list = "📋 Registered Group Admins:\n"
-        for admin_id in admins:
-            cursor = db.conn.cursor()
-            cursor.execute(
-                "SELECT username FROM admins WHERE admin_id = ? AND group_id = ?",
-                (admin_id, group_id),
-            )
-            result = cursor.fetchone()
-            username = result[0] if result and result[0] else "Unknown"
+        members = db.admins.resolve_members(context.bot, group_id)
 
-            # Get Telegram user info if possible
-            try:
-                user = context.bot.get_chat_member(group_id, admin_id).user
+        admin_list = "📋 Registered Group Admins:\n"
+        for admin_id, stored_name in entries:
+            username = stored_name or "Unknown"
+            user = members.get(admin_id)
+            if user is not None:
                 actual_username = (
                     f"@{user.username}" if user.username else user.first_name
                 )
                 admin_list += f"• {actual_username} ({username}) - ID: {admin_id}\n"
-            except:
+            else:
                 admin_list += f"• {username} - ID: {admin_id}\n"
 
         update.message.reply_text(admin_list)
@@ -217,6 +263,7 @@ def list_admins(update: Update, context: CallbackContext):
         update.message.reply_text("❌ Failed to fetch admin list.")
 
 
+@HANDLER_SECONDS.time(handler="telegram_message")
 def handle_message(update: Update, context: CallbackContext):
     message = update.message
     text = message.text
@@ -224,46 +271,115 @@ def handle_message(update: Update, context: CallbackContext):
     user_id = str(message.from_user.id)
     username = message.from_user.username or message.from_user.first_name
 
-    # Track total messages
-    db.increment_message_stats(group_id)
+    if flood is not None:
+        flood_decision = flood.check(group_id, user_id)
+        if flood_decision.penalize:
+            penalize_flood(group_id, user_id, username)
+        if flood_decision.action == FLOOD_DEFER:
+            defer_message(group_id, user_id, username, message.message_id, text)
+            return
 
-    if text and detector.detect(text):
-        # Increment hate speech counter
-        db.increment_message_stats(group_id, is_hate_speech=True)
-        # Record violation in the database
-        violation_count = db.add_violation(user_id, username)
-        # Attempt to delete the offending message (bot must be admin)
+    decision = classify(text, detector, prefilter, cascade)
+    logger.debug(f"Message {message.message_id} decided by {decision.stage}")
+    moderate(group_id, user_id, username, message.message_id, text, decision)
+
+
+def moderate(group_id, user_id, username, message_id, text, decision):
+    enforce(group_id, user_id, username, message_id, text, decision)
+    # Only after enforcement, so a failing side log never blocks moderation
+    if score_log is not None:
         try:
-            context.bot.delete_message(chat_id=group_id, message_id=message.message_id)
+            score_log.append(group_id, message_id, decision)
         except Exception as e:
-            logger.error(f"Error deleting message: {e}")
+            logger.error(f"Failed to log scores of message {message_id}: {e}")
+
+
+def enforce(group_id, user_id, username, message_id, text, decision):
+    # Track the message once, with its verdict, for the group and the sender
+    db.increment_message_stats(
+        group_id, is_hate_speech=decision.is_hate, user_id=user_id
+    )
+
+    if decision.is_hate:
+        # Record the violation; penalties look at this group's recent ones
+        violation_count = db.record_violation(group_id, user_id, username, message_id)
+        # Attempt to delete the offending message (bot must be admin)
+        scheduler.delete_message(group_id, message_id)
         # Notify group admins (from the database)
         admins = db.get_group_admins(group_id)
         for admin in admins:
-            context.bot.send_message(
-                chat_id=admin,
-                text=f"⚠️ Alert: User @{username} sent hate speech:\n{text}",
+            scheduler.alert_admin(
+                admin, f"⚠️ Alert: User @{username} sent hate speech:\n{text}"
+            )
+        penalty = penalty_for(violation_count)
+        if penalty == PENALTY_RESTRICT:
+            until_date = datetime.now() + timedelta(
+                seconds=config.PENALTY_RESTRICT_SECONDS
             )
-        # Apply penalties based on violation count
-        if violation_count == 25:
-            until_date = datetime.now() + timedelta(days=7)
-            context.bot.restrict_chat_member(
-                chat_id=group_id,
-                user_id=user_id,
+            scheduler.restrict_chat_member(
+                group_id,
+                user_id,
                 permissions=ChatPermissions(can_send_messages=False),
                 until_date=until_date,
             )
-            context.bot.send_message(
-                chat_id=group_id, text=f"User @{username} is restricted for 7 days."
+            scheduler.send_message(
+                group_id,
+                f"User @{username} is restricted for "
+                f"{config.PENALTY_RESTRICT_SECONDS // 86400} days.",
             )
-        elif violation_count > 6:
-            context.bot.kick_chat_member(chat_id=group_id, user_id=user_id)
-            context.bot.send_message(
-                chat_id=group_id,
-                text=f"User @{username} has been banned due to repeated violations.",
+        elif penalty == PENALTY_BAN:
+            scheduler.kick_chat_member(group_id, user_id)
+            scheduler.send_message(
+                group_id,
+                f"User @{username} has been banned due to repeated violations.",
             )
 
 
+def penalize_flood(group_id, user_id, username):
+    until_date = datetime.now() + timedelta(seconds=config.FLOOD_MUTE_SECONDS)
+    scheduler.restrict_chat_member(
+        group_id,
+        user_id,
+        permissions=ChatPermissions(can_send_messages=False),
+        until_date=until_date,
+    )
+    scheduler.send_message(
+        group_id,
+        f"User @{username} is muted for {config.FLOOD_MUTE_SECONDS // 60} "
+        f"minutes for flooding.",
+    )
+
+
+def defer_message(group_id, user_id, username, message_id, text):
+    with deferred_lock:
+        batch = deferred.setdefault(group_id, [])
+        batch.append((message_id, user_id, username, text))
+        if len(batch) < config.FLOOD_BATCH_SIZE:
+            return
+        del deferred[group_id]
+    classify_deferred(group_id, batch)
+
+
+def classify_deferred(group_id, batch):
+    decisions = classify_many(
+        [text for *_, text in batch], detector, prefilter, cascade
+    )
+    for (message_id, user_id, username, text), decision in zip(batch, decisions):
+        moderate(group_id, user_id, username, message_id, text, decision)
+
+
+def flush_deferred(context=None):
+    # Runs every FLOOD_BATCH_WAIT seconds so deferred messages never wait long
+    with deferred_lock:
+        batches = list(deferred.items())
+        deferred.clear()
+    for group_id, batch in batches:
+        try:
+            classify_deferred(group_id, batch)
+        except Exception as e:
+            logger.error(f"Failed to classify deferred messages in {group_id}: {e}")
+
+
 def error_handler(update: Update, context: CallbackContext):
     logger.error(f"Update {update} caused error {context.error}")
     if update.message:
@@ -272,10 +388,7 @@ def error_handler(update: Update, context: CallbackContext):
         )
 
 
-def main():
-    updater = Updater(token=config.TELEGRAM_API_TOKEN, use_context=True)
-    dp = updater.dispatcher
-
+def add_handlers(dp, run_async=True):
     # Add all handlers - include both versions of commands (with and without underscores)
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("stats", stats))
@@ -290,16 +403,63 @@ def main():
     dp.add_handler(CommandHandler("listadmins", list_admins))
     dp.add_handler(CommandHandler("list_admins", list_admins))
 
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    # Messages run asynchronously so concurrent detections can share a batch
+    # (shard workers order them per chat themselves, see telegram_shards.py)
+    dp.add_handler(
+        MessageHandler(
+            Filters.text & ~Filters.command, handle_message, run_async=run_async
+        )
+    )
 
     # Add error handler
     dp.add_error_handler(error_handler)
 
+
+def schedule_jobs(job_queue):
+    # Classify messages held back by flood control
+    if flood is not None:
+        job_queue.run_repeating(flush_deferred, interval=config.FLOOD_BATCH_WAIT)
+
+
+def shutdown():
+    # Send queued moderation actions and flush write-behind counters
+    flush_deferred()
+    if flood is not None:
+        logger.info(f"Flood control stats: {flood.stats()}")
+    scheduler.close()
+    logger.info(f"Moderation scheduler stats: {scheduler.stats()}")
+    if score_log is not None:
+        score_log.close()
+    db.close()
+
+
+def main():
+    updater = Updater(
+        token=config.TELEGRAM_API_TOKEN,
+        use_context=True,
+        workers=config.TELEGRAM_WORKERS,
+    )
+    dp = updater.dispatcher
+
+    # Load every group's admins up front so alerts never wait on SQLite
+    db.load_all_admins()
+
+    add_handlers(dp)
+
+    # Prometheus scrape target on its own port (Telegram uses long polling)
+    if config.METRICS_PORT:
+        metrics.serve(config.METRICS_PORT)
+
+    schedule_jobs(updater.job_queue)
+
     # Start the bot
+    scheduler.start(updater.bot)
     updater.start_polling()
     logger.info("Telegram bot started.")
     updater.idle()
 
+    shutdown()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,432 @@
+# telegram_shards.py
+# Webhook ingest for the Telegram bot across worker processes. A Flask
+# front end receives updates and routes each one by consistent hashing on
+# its chat_id to one of N workers. Every worker runs the usual handlers with
+# its own detector and batching queue against the shared SQLite database,
+# and handles each chat's updates in order, so one group is always processed
+# by one process in arrival order.
+#
+#   python telegram_shards.py --workers 4 --port 8443 \
+#       --webhook-url https://bot.example.com
+#
+# kill -USR1 <pid> adds a worker and kill -USR2 removes one. Before the
+# ring changes, updates of the chats that move are held back until their
+# current owners have finished what they were sent, so a chat that moves
+# never has updates processed out of order; other chats are routed as usual.
+from bisect import bisect, insort
+from collections import Counter, namedtuple
+from hashlib import blake2b
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from flask import Flask, Response, jsonify, request
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry a chat
+MESSAGE_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post")
+MEMBER_FIELDS = ("my_chat_member", "chat_member", "chat_join_request")
+
+ROUTED = metrics.counter(
+    "hate_speech_shard_updates_total", "Updates routed to each worker", ["worker"]
+)
+REBALANCE_SECONDS = metrics.histogram(
+    "hate_speech_shard_rebalance_seconds", "Time routing paused for a ring change"
+)
+
+
+def chat_id_of(update):
+    # The chat an update (a decoded JSON dict) belongs to, or None
+    for field in MESSAGE_FIELDS:
+        message = update.get(field)
+        if message:
+            return message["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"]["chat"]["id"]
+    for field in MEMBER_FIELDS:
+        member = update.get(field)
+        if member:
+            return member["chat"]["id"]
+    return None
+
+
+def _hash(value):
+    digest = blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HashRing:
+    # Consistent hashing with `replicas` points per node: adding or removing
+    # a node moves only about 1/N of the keys.
+    def __init__(self, replicas=None):
+        self.replicas = replicas or config.SHARD_RING_REPLICAS
+        self._points = []  # sorted (hash, node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            insort(self._points, (_hash(f"{node}#{i}"), node))
+
+    def remove(self, node):
+        self._points = [point for point in self._points if point[1] != node]
+
+    def copy(self):
+        ring = HashRing(self.replicas)
+        ring._points = list(self._points)
+        return ring
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError("Hash ring is empty")
+        index = bisect(self._points, (_hash(key),))
+        return self._points[index % len(self._points)][1]
+
+    @property
+    def nodes(self):
+        return sorted({node for _, node in self._points})
+
+
+def telegram_bot_factory():
+    from telegram import Bot
+
+    return Bot(config.TELEGRAM_API_TOKEN)
+
+
+def run_worker(worker_id, updates, acks, bot_factory, lanes, setup=None):
+    # Process entry point: feeds routed updates to the bot's handlers. Chats
+    # are pinned to one of `lanes` threads, which keeps each chat in order
+    # while other chats are handled (and batched by the detector) in parallel.
+    logging.basicConfig(
+        format=f"%(asctime)s - shard-{worker_id} - %(name)s - %(levelname)s - "
+        f"%(message)s",
+        level=logging.INFO,
+    )
+    from telegram import Update
+    from telegram.ext import Dispatcher, JobQueue
+    import telegram_bot
+
+    if setup is not None:
+        setup()
+    bot = bot_factory()
+    # Other workers count the same users' violations
+    telegram_bot.db.sync_violations = True
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, None, workers=1, job_queue=job_queue)
+    telegram_bot.add_handlers(dispatcher, run_async=False)
+    telegram_bot.db.load_all_admins()
+    telegram_bot.schedule_jobs(job_queue)
+    telegram_bot.scheduler.start(bot)
+    job_queue.start()
+    if config.METRICS_PORT:
+        metrics.serve(config.METRICS_PORT + 1 + worker_id)
+
+    def drain(lane):
+        while True:
+            data = lane.get()
+            try:
+                if data is None:
+                    return
+                dispatcher.process_update(Update.de_json(data, bot))
+            except Exception as e:
+                logger.error(f"Update {data.get('update_id')} failed: {e}")
+            finally:
+                lane.task_done()
+
+    lane_queues = [queue.Queue() for _ in range(lanes)]
+    threads = [
+        threading.Thread(target=drain, args=(lane,), name=f"lane-{i}", daemon=True)
+        for i, lane in enumerate(lane_queues)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info(f"Shard worker {worker_id} started (pid {os.getpid()})")
+
+    while True:
+        kind, payload = updates.get()
+        if kind == "update":
+            chat_id = chat_id_of(payload)
+            lane = hash(chat_id if chat_id is not None else 0) % lanes
+            lane_queues[lane].put(payload)
+        elif kind == "barrier":
+            # Everything routed here so far is handled and visible to the
+            # worker that may own these chats next
+            for lane in lane_queues:
+                lane.join()
+            telegram_bot.flush_deferred()
+            telegram_bot.db.flush()
+            # Admin lists and violation windows of chats that just moved
+            # here may be stale
+            telegram_bot.db.admins.invalidate()
+            telegram_bot.db.violation_windows.invalidate()
+            acks.put((worker_id, payload))
+        elif kind == "stop":
+            break
+
+    for lane in lane_queues:
+        lane.put(None)
+    for thread in threads:
+        thread.join()
+    job_queue.stop()
+    telegram_bot.shutdown()
+    logger.info(f"Shard worker {worker_id} stopped")
+
+
+_Worker = namedtuple("_Worker", ["process", "updates"])
+
+
+# Routes updates to worker processes and changes the set of workers without
+# reordering any chat's updates.
+class ShardRouter:
+    def __init__(self, bot_factory=None, lanes=None, replicas=None, setup=None):
+        self.bot_factory = bot_factory or telegram_bot_factory
+        self.lanes = lanes or config.SHARD_LANES
+        self.setup = setup
+        self.ring = HashRing(replicas)
+        self._context = multiprocessing.get_context("spawn")
+        self._acks = self._context.Queue()
+        self._workers = {}  # worker id -> _Worker
+        self._next_id = 0
+        self._barrier_seq = 0
+        # While a ring change waits for the old owners, updates of chats that
+        # move are held back here, in arrival order
+        self._next_ring = None
+        self._held = []
+        # _lock guards routing and is only held briefly; _change_lock
+        # serializes ring changes and barriers
+        self._lock = threading.RLock()
+        self._change_lock = threading.Lock()
+        self.routed = Counter()
+        self.restarts = 0
+
+    def _spawn(self, worker_id, updates=None):
+        # A restarted worker keeps its queue, so nothing routed to it is lost
+        updates = updates or self._context.Queue()
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                worker_id,
+                updates,
+                self._acks,
+                self.bot_factory,
+                self.lanes,
+                self.setup,
+            ),
+            name=f"shard-{worker_id}",
+        )
+        process.start()
+        self._workers[worker_id] = _Worker(process, updates)
+
+    def start(self, workers=None):
+        with self._lock:
+            for _ in range(workers or config.SHARD_WORKERS):
+                self._spawn(self._next_id)
+                self.ring.add(self._next_id)
+                self._next_id += 1
+        logger.info(f"Started {len(self._workers)} shard workers")
+
+    def route(self, update):
+        chat_id = chat_id_of(update)
+        key = chat_id if chat_id is not None else update.get("update_id", 0)
+        with self._lock:
+            worker_id = self.ring.node_for(key)
+            if self._next_ring is not None:
+                next_id = self._next_ring.node_for(key)
+                if next_id != worker_id:
+                    self._held.append(update)
+                    return next_id
+            return self._send(worker_id, update)
+
+    def _send(self, worker_id, update):
+        with self._lock:
+            worker = self._workers[worker_id]
+            if not worker.process.is_alive():
+                logger.error(f"Shard worker {worker_id} died; restarting it")
+                self.restarts += 1
+                self._spawn(worker_id, worker.updates)
+                worker = self._workers[worker_id]
+            worker.updates.put(("update", update))
+            self.routed[worker_id] += 1
+        ROUTED.inc(worker=str(worker_id))
+        return worker_id
+
+    def drain(self, timeout=None):
+        # Waits until every update routed so far has been handled
+        with self._change_lock:
+            with self._lock:
+                worker_ids = list(self._workers)
+            return self._barrier(worker_ids, timeout)
+
+    def _barrier(self, worker_ids, timeout=None):
+        timeout = timeout or config.SHARD_REBALANCE_TIMEOUT
+        self._barrier_seq += 1
+        seq = self._barrier_seq
+        for worker_id in worker_ids:
+            self._workers[worker_id].updates.put(("barrier", seq))
+        waiting = set(worker_ids)
+        deadline = time.monotonic() + timeout
+        while waiting:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Shard workers {sorted(waiting)} did not drain in time")
+                return False
+            try:
+                worker_id, acked = self._acks.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if acked == seq:
+                waiting.discard(worker_id)
+        return True
+
+    def _change_ring(self, next_ring, worker_ids):
+        # Holds back the chats that move while worker_ids finish what they
+        # were sent, then switches to next_ring, or keeps the current ring if
+        # they do not finish in time. Held updates go out before any newer
+        # ones. Call with _change_lock held.
+        started = time.monotonic()
+        with self._lock:
+            self._next_ring = next_ring
+        drained = self._barrier(worker_ids)
+        with self._lock:
+            if drained:
+                self.ring = next_ring
+            self._next_ring = None
+            held, self._held = self._held, []
+            for update in held:
+                self.route(update)
+        REBALANCE_SECONDS.observe(time.monotonic() - started)
+        return drained
+
+    def add_worker(self):
+        with self._change_lock:
+            with self._lock:
+                worker_id = self._next_id
+                self._next_id += 1
+                self._spawn(worker_id)
+                old = [w for w in self._workers if w != worker_id]
+                next_ring = self.ring.copy()
+                next_ring.add(worker_id)
+            # Chats moving to the new worker must be finished where they are
+            if not self._change_ring(next_ring, old):
+                with self._lock:
+                    worker = self._workers.pop(worker_id)
+                worker.updates.put(("stop", None))
+                logger.error(f"Not adding shard worker {worker_id}; drain timed out")
+                return None
+        logger.info(f"Added shard worker {worker_id}")
+        return worker_id
+
+    def remove_worker(self, worker_id=None):
+        with self._change_lock:
+            with self._lock:
+                if len(self._workers) <= 1:
+                    raise ValueError("Cannot remove the last shard worker")
+                if worker_id is None:
+                    worker_id = max(self._workers)
+                next_ring = self.ring.copy()
+                next_ring.remove(worker_id)
+            # Its chats move to other workers once its queue is handled
+            if not self._change_ring(next_ring, [worker_id]):
+                logger.error(f"Not removing shard worker {worker_id}; drain timed out")
+                return None
+            with self._lock:
+                worker = self._workers.pop(worker_id)
+            worker.updates.put(("stop", None))
+        worker.process.join(config.SHARD_REBALANCE_TIMEOUT)
+        logger.info(f"Removed shard worker {worker_id}")
+        return worker_id
+
+    def stats(self):
+        with self._lock:
+            workers = {}
+            for worker_id, worker in self._workers.items():
+                try:
+                    depth = worker.updates.qsize()
+                except NotImplementedError:  # macOS
+                    depth = None
+                workers[worker_id] = {
+                    "pid": worker.process.pid,
+                    "alive": worker.process.is_alive(),
+                    "routed": self.routed[worker_id],
+                    "queue_depth": depth,
+                }
+            return {"workers": workers, "restarts": self.restarts}
+
+    def close(self, timeout=30.0):
+        # Handles what is queued, then stops every worker
+        with self._lock:
+            for worker in self._workers.values():
+                worker.updates.put(("stop", None))
+            for worker in self._workers.values():
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            self._workers.clear()
+
+
+def create_app(router, path):
+    app = Flask(__name__)
+
+    @app.route(path, methods=["POST"])
+    def telegram_webhook():
+        update = request.get_json(force=True, silent=True)
+        if not isinstance(update, dict):
+            return Response(status=400)
+        router.route(update)
+        return Response(status=200)
+
+    @app.route("/shards", methods=["GET"])
+    def shards():
+        return jsonify(router.stats())
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Telegram bot webhook ingest over worker processes"
+    )
+    parser.add_argument("--workers", type=int, default=config.SHARD_WORKERS)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument(
+        "--webhook-url", help="Public base URL; registers the webhook with Telegram"
+    )
+    args = parser.parse_args()
+
+    # The token in the path keeps strangers from posting updates
+    path = f"/telegram/{config.TELEGRAM_API_TOKEN}"
+    router = ShardRouter()
+    router.start(args.workers)
+
+    def on_signal(signum, frame):
+        change = router.add_worker if signum == signal.SIGUSR1 else router.remove_worker
+        threading.Thread(target=change, name="shard-rebalance").start()
+
+    signal.signal(signal.SIGUSR1, on_signal)
+    signal.signal(signal.SIGUSR2, on_signal)
+
+    if args.webhook_url:
+        telegram_bot_factory().set_webhook(url=args.webhook_url.rstrip("/") + path)
+    try:
+        create_app(router, path).run(host=args.host, port=args.port, threaded=True)
+    finally:
+        router.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
@@ -0,0 +1,226 @@
+# verdict_cache.py
+from collections import OrderedDict
+import atexit
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import config
+from database import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    # Case-folded, whitespace-collapsed, NFKC-normalized form of a message
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def cache_key(text):
+    return hashlib.blake2b(
+        normalize_text(text).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+# Bounded LRU+TTL cache of per-label score vectors keyed by normalized text.
+# Scores (not verdicts) are stored so threshold changes never invalidate it.
+# With db_path set, entries are also written to SQLite and survive restarts:
+# new entries are committed in blocks (VERDICT_CACHE_DB_FLUSH_SIZE entries or
+# VERDICT_CACHE_DB_FLUSH_INTERVAL seconds), and every
+# VERDICT_CACHE_DB_PRUNE_INTERVAL seconds expired rows are deleted and the
+# table is cut to the newest VERDICT_CACHE_DB_MAX_ROWS.
+class VerdictCache:
+    def __init__(self, max_entries=None, ttl_seconds=None, db_path=None):
+        self.max_entries = max_entries or config.VERDICT_CACHE_SIZE
+        self.ttl = ttl_seconds if ttl_seconds is not None else config.VERDICT_CACHE_TTL
+        self.max_rows = config.VERDICT_CACHE_DB_MAX_ROWS
+        self.flush_size = config.VERDICT_CACHE_DB_FLUSH_SIZE
+        self.flush_interval = config.VERDICT_CACHE_DB_FLUSH_INTERVAL
+        self.prune_interval = config.VERDICT_CACHE_DB_PRUNE_INTERVAL
+        self._entries = OrderedDict()
+        self._unsaved = {}  # cache_key -> (scores json, created_at)
+        self._last_flush = time.monotonic()
+        self._next_prune = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.conn = None
+        self.readers = None
+        if db_path:
+            # Writes go through one connection, serialized by self._lock (hence
+            # check_same_thread=False); lookups use per-thread connections
+            # outside the lock, and WAL keeps them from blocking on a flush
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.create_tables()
+            self.readers = ConnectionPool(db_path)
+            atexit.register(self.close)
+
+    def create_tables(self):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS verdict_cache (
+                cache_key TEXT PRIMARY KEY,
+                scores TEXT,
+                created_at REAL
+            )
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_verdict_cache_created
+            ON verdict_cache (created_at)
+        """
+        )
+        self.conn.commit()
+
+    def get(self, text):
+        key = cache_key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, scores = entry
+                if now - created_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return scores
+                del self._entries[key]
+                self.expirations += 1
+
+            # Written since the last flush, then evicted from memory
+            unsaved = self._unsaved.get(key)
+            if unsaved is not None and now - unsaved[1] < self.ttl:
+                scores = json.loads(unsaved[0])
+                self._store(key, unsaved[1], scores)
+                self.persistent_hits += 1
+                return scores
+            readers = self.readers
+
+        # The SQLite read happens without the lock, so a slow disk never
+        # stalls lookups that hit memory
+        row = self._load(readers, key) if readers is not None else None
+        with self._lock:
+            if row is not None and now - row[1] < self.ttl:
+                scores = json.loads(row[0])
+                if key not in self._entries:
+                    self._store(key, row[1], scores)
+                self.persistent_hits += 1
+                return scores
+            self.misses += 1
+            return None
+
+    def put_many(self, texts, results, persist=None):
+        # persist: per text, whether it may go to the SQLite tier (default all)
+        now = time.time()
+        if persist is None:
+            persist = [True] * len(texts)
+        with self._lock:
+            for text, scores, durable in zip(texts, results, persist):
+                key = cache_key(text)
+                self._store(key, now, scores)
+                if self.conn is not None and durable:
+                    self._unsaved[key] = (json.dumps(scores), now)
+            if self.conn is not None and (
+                len(self._unsaved) >= self.flush_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def put(self, text, scores):
+        self.put_many([text], [scores])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (
+                    (self.hits + self.persistent_hits) / lookups if lookups else 0.0
+                ),
+            }
+
+    def flush(self):
+        with self._lock:
+            if self.conn is not None:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self._flush()
+                self.conn.close()
+                self.conn = None
+                self.readers.close_all()
+                self.readers = None
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        rows = [
+            (key, scores, created_at)
+            for key, (scores, created_at) in self._unsaved.items()
+        ]
+        self._unsaved.clear()
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO verdict_cache (cache_key, scores, created_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            if self._last_flush >= self._next_prune:
+                self._next_prune = self._last_flush + self.prune_interval
+                self._prune()
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Error persisting verdict cache entries: {e}")
+            self.conn.rollback()
+
+    def _prune(self):
+        self.conn.execute(
+            "DELETE FROM verdict_cache WHERE created_at < ?", (time.time() - self.ttl,)
+        )
+        self.conn.execute(
+            """
+            DELETE FROM verdict_cache WHERE created_at < (
+                SELECT created_at FROM verdict_cache
+                ORDER BY created_at DESC LIMIT 1 OFFSET ?
+            )
+            """,
+            (self.max_rows - 1,),
+        )
+
+    def _store(self, key, created_at, scores):
+        self._entries[key] = (created_at, scores)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, readers, key):
+        # Returns the stored (scores json, created_at) row, or None
+        try:
+            conn = readers.connection()
+            return conn.execute(
+                "SELECT scores, created_at FROM verdict_cache WHERE cache_key = ?",
+                (key,),
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Error reading verdict cache: {e}")
+            return None
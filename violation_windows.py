@@ -0,0 +1,115 @@
+# violation_windows.py
+from bisect import insort
+from collections import deque
+import threading
+import time
+import config
+
+PENALTY_NONE = "none"
+PENALTY_RESTRICT = "restrict"
+PENALTY_BAN = "ban"
+
+
+def penalty_for(violation_count):
+    # The penalty due for a user's violations in a group within
+    # VIOLATION_WINDOW, counting the one just recorded
+    if violation_count >= config.PENALTY_BAN_AT:
+        return PENALTY_BAN
+    if violation_count >= config.PENALTY_RESTRICT_AT:
+        return PENALTY_RESTRICT
+    return PENALTY_NONE
+
+
+# Sliding-window violation counts per (group, user), kept in memory so a
+# penalty decision never queries SQLite. A pair is loaded from the
+# violations table (one index range scan) the first time it is seen; after
+# that, adding and counting only append and expire timestamps. Pairs with
+# nothing left in the window are dropped.
+class ViolationWindows:
+    def __init__(self, loader, window=None):
+        # loader(group_id, user_id, since) -> ascending timestamps >= since
+        self._loader = loader
+        self.window = window or config.VIOLATION_WINDOW
+        self._events = {}  # (group_id, user_id) -> deque of timestamps
+        self._lock = threading.Lock()
+        self._next_prune = 0.0
+        self.loads = 0
+
+    def _expire(self, events, now):
+        cutoff = now - self.window
+        while events and events[0] <= cutoff:
+            events.popleft()
+
+    def _get(self, key, now):
+        events = self._events.get(key)
+        if events is None:
+            # Read outside the lock; a concurrent load of the same pair wins
+            self._lock.release()
+            try:
+                loaded = deque(self._loader(key[0], key[1], now - self.window))
+            finally:
+                self._lock.acquire()
+            self.loads += 1
+            events = self._events.setdefault(key, loaded)
+        self._expire(events, now)
+        return events
+
+    def add(self, group_id, user_id, ts=None):
+        # Records a violation and returns the count in the window
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            events = self._get((group_id, user_id), ts)
+            self._insert(events, ts)
+            count = len(events)
+            if ts >= self._next_prune:
+                self._prune(ts)
+        return count
+
+    def count(self, group_id, user_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return len(self._get((group_id, user_id), now))
+
+    def observe(self, group_id, user_id, ts):
+        # A violation already stored by someone else (e.g. a bulk write);
+        # pairs not in memory will read it when they are loaded
+        with self._lock:
+            events = self._events.get((group_id, user_id))
+            if events is not None:
+                self._insert(events, ts)
+
+    def _insert(self, events, ts):
+        if not events or ts >= events[-1]:
+            events.append(ts)
+        else:
+            # Late arrival; rare enough to sort
+            ordered = list(events)
+            insort(ordered, ts)
+            events.clear()
+            events.extend(ordered)
+
+    def _prune(self, now):
+        for key in list(self._events):
+            events = self._events[key]
+            self._expire(events, now)
+            if not events:
+                del self._events[key]
+        self._next_prune = now + min(self.window, 3600)
+
+    def forget(self, group_id, user_id):
+        # Reloaded from the table on next use, e.g. after a failed write
+        with self._lock:
+            self._events.pop((group_id, user_id), None)
+
+    def invalidate(self):
+        # E.g. when chats move between shard workers
+        with self._lock:
+            self._events.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pairs": len(self._events),
+                "events": sum(len(events) for events in self._events.values()),
+                "loads": self.loads,
+            }
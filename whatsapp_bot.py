@@ -2,10 +2,29 @@
 from flask import Flask, request, Response
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from requests.adapters import HTTPAdapter
+from collections import Counter
 import logging
-from database import Database
-from hate_speech_model import HateSpeechDetector
+import time
+import uuid
+from database import (
+    OUTBOX_TABLE,
+    SCOPE_GROUP,
+    SCOPE_USER,
+    Database,
+    Verdict,
+    parse_window,
+)
+from hate_speech_model import load_detector
+from cascade import load_cascade
+from prefilter import Decision, LexiconPrefilter, classify, classify_many
+from alert_dispatcher import AlertDispatcher
+from ingest_queue import IngestConsumers, IngestQueue
+from score_log import ScoreLog
+from violation_windows import PENALTY_BAN, PENALTY_RESTRICT, penalty_for
 import config
+import metrics
 
 app = Flask(__name__)
 
@@ -14,17 +33,85 @@ TWILIO_ACCOUNT_SID = config.TWILIO_ACCOUNT_SID
 TWILIO_AUTH_TOKEN = config.TWILIO_AUTH_TOKEN
 TWILIO_WHATSAPP_NUMBER = config.TWILIO_WHATSAPP_NUMBER
 
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+# Pooled HTTP connections sized to the alert worker pool
+http_client = TwilioHttpClient(pool_connections=True)
+http_client.session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=config.ALERT_WORKERS),
+)
+client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
 
 # Initialize shared modules
-detector = HateSpeechDetector()
+detector = load_detector()
+prefilter = LexiconPrefilter.from_file() if config.PREFILTER_ENABLED else None
+# Confident student verdicts skip the model
+cascade = load_cascade() if config.CASCADE_ENABLED else None
 db = Database()
+# Label scores of every verdict, for re-thresholding offline
+score_log = ScoreLog() if config.SCORE_LOG_PATH else None
+
+HANDLER_SECONDS = metrics.histogram(
+    "hate_speech_handler_seconds", "End-to-end message handling time", ["handler"]
+)
+TWILIO_SECONDS = metrics.histogram(
+    "hate_speech_twilio_api_seconds", "Twilio message send latency", ["outcome"]
+)
+metrics.gauge(
+    "hate_speech_alert_queue_depth",
+    "Alerts waiting for a dispatcher worker",
+    function=lambda: alerts.stats()["queued"],
+)
+metrics.gauge(
+    "hate_speech_ingest_queue_depth",
+    "Messages waiting in the ingest queue",
+    function=lambda: ingest.lag()["pending"] if ingest else 0,
+)
+metrics.gauge(
+    "hate_speech_ingest_queue_lag_seconds",
+    "Age of the oldest message waiting in the ingest queue",
+    function=lambda: ingest.lag()["lag_seconds"] if ingest else 0,
+)
+
+# WhatsApp traffic is tracked as a single group in the stats tables
+WHATSAPP_GROUP_ID = "whatsapp"
 
 # Define monitoring numbers (in E.164 format, e.g., "+1234567890")
 monitoring_numbers = ["+1234567890"]  # Replace with your WhatsApp admin numbers
 
 
+def send_whatsapp(to, body):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        client.messages.create(
+            from_=f"whatsapp:{TWILIO_WHATSAPP_NUMBER}",
+            to=f"whatsapp:{to}",
+            body=body,
+        )
+        outcome = "ok"
+    finally:
+        TWILIO_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+
+
+# Alerts are delivered in the background so the webhook returns immediately
+alerts = AlertDispatcher(send_whatsapp)
+
+
+def violation_reply(violation_count):
+    reply = "Your message was flagged as hate speech and recorded. "
+    penalty = penalty_for(violation_count)
+    if penalty == PENALTY_RESTRICT:
+        days = config.PENALTY_RESTRICT_SECONDS // 86400
+        reply += f"You are restricted from sending messages for {days} days."
+    elif penalty == PENALTY_BAN:
+        reply += "You have been banned from the group due to repeated violations."
+    else:
+        reply += f"Violation count: {violation_count}."
+    return reply
+
+
 @app.route("/whatsapp", methods=["POST"])
+@HANDLER_SECONDS.time(handler="whatsapp_webhook")
 def whatsapp_webhook():
     sender = request.values.get("From", "")
     message_text = request.values.get("Body", "")
@@ -32,38 +119,200 @@ def whatsapp_webhook():
     app.logger.info(f"Received message from {sender}: {message_text}")
 
     resp = MessagingResponse()
-    reply = ""
+    if ingest is not None:
+        # Once the message is on disk Twilio can have its answer; the verdict
+        # reply follows from a consumer. A retried SID is only queued once.
+        sid = request.values.get("MessageSid") or uuid.uuid4().hex
+        ingest.enqueue(sid, {"from": sender, "body": message_text})
+        resp.message("Message received.")
+        return Response(str(resp), mimetype="application/xml")
+
+    decision = classify(message_text, detector, prefilter, cascade)
+    app.logger.debug(f"Message from {sender} decided by {decision.stage}")
+    db.increment_message_stats(
+        WHATSAPP_GROUP_ID, is_hate_speech=decision.is_hate, user_id=sender
+    )
 
-    if message_text and detector.detect(message_text):
+    if decision.is_hate:
         # For WhatsApp we record the violation (using sender’s number as the user ID)
-        violation_count = db.add_violation(sender, sender)
+        violation_count = db.record_violation(
+            WHATSAPP_GROUP_ID, sender, sender, request.values.get("MessageSid")
+        )
         # Notify each monitoring number via WhatsApp message
-        for admin in monitoring_numbers:
-            client.messages.create(
-                from_=f"whatsapp:{TWILIO_WHATSAPP_NUMBER}",
-                to=f"whatsapp:{admin}",
-                body=f"⚠️ Alert: Sender {sender} sent hate speech:\n{message_text}",
-            )
-        reply += "Your message was flagged as hate speech and recorded. "
-        if violation_count == 6:
-            reply += "You are restricted from sending messages for 7 days."
-        elif violation_count > 6:
-            reply += "You have been banned from the group due to repeated violations."
-        else:
-            reply += f"Violation count: {violation_count}."
+        alerts.submit_all(monitoring_numbers, sender, message_text)
+        reply = violation_reply(violation_count)
     else:
-        reply += "Message received."
+        reply = "Message received."
+    log_scores(
+        [(WHATSAPP_GROUP_ID, request.values.get("MessageSid", ""), decision, None)]
+    )
 
     resp.message(reply)
     return Response(str(resp), mimetype="application/xml")
 
 
+@HANDLER_SECONDS.time(handler="whatsapp_ingest")
+def process_ingested(jobs):
+    # Consumer side of the webhook: one detector call and one transaction per
+    # batch. Messages recorded by an earlier attempt are skipped.
+    texts = [job.payload["body"] for job in jobs]
+    decisions = classify_many(texts, detector, prefilter, cascade)
+    verdicts = [
+        Verdict(
+            WHATSAPP_GROUP_ID,
+            job.key,
+            job.payload["from"],
+            job.payload["from"],
+            job.enqueued_at,
+            decision.is_hate,
+            decision.stage,
+            decision.scores,
+        )
+        for job, decision in zip(jobs, decisions)
+    ]
+    texts_by_id = {job.key: job.payload["body"] for job in jobs}
+    # The stored counts do not include the batch yet, so each message of a
+    # sender gets the count it had when it was sent
+    earlier = Counter()
+
+    def owed(v):
+        # Alerts and the reply for a new verdict, queued in the outbox with
+        # the verdict itself and keyed by SID so each goes out once
+        if not v.is_hate:
+            return []
+        sender = v.user_id
+        earlier[sender] += 1
+        violation_count = (
+            db.get_recent_violations(WHATSAPP_GROUP_ID, sender) + earlier[sender]
+        )
+        text = texts_by_id[v.message_id]
+        return [
+            (
+                f"{v.message_id}:alert:{to}",
+                {"kind": "alert", "to": to, "sender": sender, "text": text},
+            )
+            for to in monitoring_numbers
+        ] + [
+            (
+                f"{v.message_id}:reply",
+                {
+                    "kind": "reply",
+                    "to": sender.removeprefix("whatsapp:"),
+                    "body": violation_reply(violation_count),
+                },
+            )
+        ]
+
+    new = db.record_new_verdicts(
+        verdicts, outbox=owed, retention=config.INGEST_QUEUE_RETENTION
+    )
+    if any(v.is_hate for v in new):
+        outbox.available.set()
+    log_scores(
+        (v.group_id, v.message_id, Decision(v.is_hate, v.stage, v.scores), v.timestamp)
+        for v in new
+    )
+
+
+def log_scores(rows):
+    # Called after the verdicts are acted on; a failing side log never
+    # blocks moderation
+    if score_log is None:
+        return
+    try:
+        score_log.append_many(rows)
+    except Exception as e:
+        app.logger.error(f"Failed to log scores: {e}")
+
+
+def deliver_outbox(jobs):
+    # Hands queued alerts and replies to the dispatcher; a message is marked
+    # done once it has been sent, and is retried when its lease expires
+    # otherwise
+    for job in jobs:
+
+        def done(delivered, job=job):
+            if delivered:
+                outbox.complete([job])
+
+        message = job.payload
+        if message["kind"] == "alert":
+            alerts.submit(message["to"], message["sender"], message["text"], done)
+        else:
+            alerts.submit_message(message["to"], message["body"], done)
+
+
+# Webhook messages go through a durable queue unless INGEST_QUEUE_ENABLED=0
+ingest = None
+consumers = None
+outbox = None
+outbox_consumers = None
+if config.INGEST_QUEUE_ENABLED:
+    ingest = IngestQueue()
+    consumers = IngestConsumers(ingest, process_ingested).start()
+    outbox = IngestQueue(
+        db.pool.db_name, OUTBOX_TABLE, lease_seconds=config.OUTBOX_LEASE_SECONDS
+    )
+    outbox_consumers = IngestConsumers(
+        outbox, deliver_outbox, workers=1, complete=False, name="outbox-consumer"
+    ).start()
+
+
+def window_totals(scope, scope_id, seconds):
+    total, hate = db.get_window_stats(scope, scope_id, seconds)
+    return {
+        "total_messages": total,
+        "hate_speech_messages": hate,
+        "hate_speech_rate": hate / total if total else 0.0,
+    }
+
+
 @app.route("/stats", methods=["GET"])
 def stats():
-    # Simple endpoint to view some stats (can be extended)
-    return {"message": "Stats endpoint not fully implemented."}
+    # /stats?window=7d&sender=whatsapp:+1234567890 (window defaults to 24h)
+    window = request.args.get("window", "24h")
+    try:
+        seconds = parse_window(window)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    total, hate = db.get_stats(WHATSAPP_GROUP_ID)
+    sender = request.args.get("sender")
+    return {
+        "all_time": {"total_messages": total, "hate_speech_messages": hate},
+        "window": window,
+        "group": window_totals(SCOPE_GROUP, WHATSAPP_GROUP_ID, seconds),
+        "sender": window_totals(SCOPE_USER, sender, seconds) if sender else None,
+        "detector": detector.stats(),
+        "alerts": alerts.stats(),
+        "ingest": ingest.stats() if ingest else None,
+        "outbox": outbox.stats() if outbox else None,
+        "prefilter": (
+            {
+                "stages": prefilter.stage_counts(),
+                "shortcut_rate": prefilter.shortcut_rate(),
+            }
+            if prefilter
+            else None
+        ),
+        "cascade": (
+            {
+                "stages": cascade.stage_counts(),
+                "escalation_rate": cascade.escalation_rate(),
+            }
+            if cascade
+            else None
+        ),
+    }
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # Prometheus scrape target
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    app.run(debug=True, port=5000)
+    # No reloader: it re-imports this module in a child process, which would
+    # start a second set of queue consumers and send every alert twice
+    app.run(debug=True, use_reloader=False, port=5000, threaded=True)